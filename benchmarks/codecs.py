@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#
+# Compares the export compression codecs' throughput and ratio on a synthetic
+# mysqldump-style dump, by running each codec's compress pipe exactly as
+# exports do. Codecs whose command isn't installed are skipped.
+#
+#   python3 benchmarks/codecs.py --size-mb 256 --level 3
+#
+# The dump is generated with a fixed seed, so runs are comparable.
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from datascrubber.compression import CODECS, get_codec  # noqa: E402
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit vestibulum eget '
+    'metus leo integer gravida magna pretium vehicula praesent ultrices eros '
+    'guidance publication consultation department policy attachment edition'
+).split()
+
+
+def write_dump(path, size):
+    rng = random.Random(42)
+    written = 0
+    row_id = 0
+    with open(path, 'w') as f:
+        f.write('CREATE TABLE `editions` (`id` int, `title` varchar(255), `body` text);\n')
+        while written < size:
+            rows = []
+            for _ in range(100):
+                row_id += 1
+                rows.append("({0},'{1}','{2}')".format(
+                    row_id,
+                    ' '.join(rng.choice(WORDS) for _ in range(8)),
+                    ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 200))),
+                ))
+            line = 'INSERT INTO `editions` VALUES {0};\n'.format(','.join(rows))
+            f.write(line)
+            written += len(line)
+
+
+def benchmark(codec, dump_path, output_path):
+    command = 'set -o pipefail; cat {0}{1} > {2}'.format(
+        dump_path, codec.get_compress_pipe(), output_path,
+    )
+    started = time.monotonic()
+    subprocess.check_call(command, shell=True, executable='/bin/bash')
+    return (time.monotonic() - started, os.path.getsize(output_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark export compression codecs")
+    parser.add_argument('--size-mb', type=int, default=128, help="Size of the synthetic dump (default: 128)")
+    parser.add_argument('--level', type=int, help="Compression level (default: each codec's own)")
+    parser.add_argument('--codecs', nargs='+', default=sorted(CODECS.keys()))
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='datascrubber-benchmark-')
+    try:
+        dump_path = os.path.join(work_dir, 'dump.sql')
+        write_dump(dump_path, args.size_mb * 1024 * 1024)
+        dump_size = os.path.getsize(dump_path)
+
+        print('{0:<6} {1:>6} {2:>10} {3:>12} {4:>8}'.format(
+            'codec', 'level', 'seconds', 'MiB/s', 'ratio'
+        ))
+        for name in args.codecs:
+            try:
+                codec = get_codec(name, args.level if name != 'none' else None)
+            except Exception as e:
+                print('{0:<6} skipped, {1}'.format(name, e))
+                continue
+
+            if codec.compress_command is not None and shutil.which(codec.compress_command[0]) is None:
+                print('{0:<6} skipped, {1} not installed'.format(name, codec.compress_command[0]))
+                continue
+
+            (seconds, size) = benchmark(codec, dump_path, os.path.join(work_dir, 'out'))
+            print('{0:<6} {1:>6} {2:>10.2f} {3:>12.1f} {4:>8.2f}'.format(
+                name,
+                str(codec.level or '-'),
+                seconds,
+                dump_size / 1024 / 1024 / seconds,
+                dump_size / size,
+            ))
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
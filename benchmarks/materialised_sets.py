@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+#
+# Compares scrubbing a synthetic Whitehall-shaped Postgres database with the
+# ruleset's shared sets materialised once into tables against the same rules
+# with each set's query inlined as a subquery wherever it's used. Both use
+# the per-table plan, so only the handling of sets differs.
+#
+#   python3 benchmarks/materialised_sets.py --dsn postgresql://localhost/benchmark --scale 10
+#
+# The tables it creates (see whitehall_schema.py) are dropped and recreated
+# for each variant, so use a scratch database.
+
+import argparse
+
+import psycopg2
+
+import whitehall_schema
+from datascrubber.rules import Ruleset
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark materialised sets")
+    parser.add_argument('--dsn', help="Postgres connection string (default: DATASCRUBBER_BENCHMARK_POSTGRES)")
+    parser.add_argument('--scale', type=int, default=10, help="Size of the data, in thousands of documents (default: 10)")
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(whitehall_schema.get_dsn(args.dsn))
+    spec = whitehall_schema.load_whitehall_ruleset()
+    inlined = whitehall_schema.inline_sets(spec)
+
+    def ruleset(spec):
+        return Ruleset(
+            'whitehall', 'postgres', spec['rules'], sets=spec['sets'], indexes=spec.get('indexes', []),
+        )
+
+    variants = [
+        ('sets inlined as subqueries', ruleset(inlined).scrub),
+        ('sets materialised', ruleset(spec).scrub),
+    ]
+
+    results = []
+    for (name, scrub) in variants:
+        whitehall_schema.reset_schema(connection, args.scale)
+        results.append((name, whitehall_schema.measure(connection, scrub, args.batch_size)))
+
+    whitehall_schema.print_results(results)
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# Compares scrubbing a synthetic Whitehall-shaped Postgres database with the
+# statements the hand-written whitehall task ran before it became a ruleset
+# (one UPDATE per concern, some of them on the same table) against the
+# ruleset's per-table plan, in which each table is rewritten in as few passes
+# as possible. Both are run in batches, with the same conditions and with
+# shared sets inlined as subqueries, so only the planning differs.
+#
+#   python3 benchmarks/rule_passes.py --dsn postgresql://localhost/benchmark --scale 10
+#
+# The tables it creates (see whitehall_schema.py) are dropped and recreated
+# for each variant, so use a scratch database.
+
+import argparse
+
+import psycopg2
+
+import whitehall_schema
+from datascrubber.rules import LOREM_IPSUM, Ruleset
+
+ACCESS_LIMITED_EDITIONS = 'SELECT id FROM editions WHERE access_limited = 1'
+ACCESS_LIMITED_ATTACHMENTS = (
+    "SELECT id FROM attachments WHERE attachable_type = 'Edition' "
+    "AND attachable_id IN (" + ACCESS_LIMITED_EDITIONS + ")"
+)
+
+# The hand-written task's statements, as (table, sql, params), ported from
+# MySQL (the UPDATE ... JOIN, and backquotes) and given a batch condition
+BASELINE_STATEMENTS = [
+    (
+        'edition_translations',
+        'UPDATE edition_translations SET title = %s, summary = %s, body = %s '
+        'WHERE edition_id IN (' + ACCESS_LIMITED_EDITIONS + ') AND {batch}',
+        (LOREM_IPSUM['line'], LOREM_IPSUM['line'], LOREM_IPSUM['paragraphs']),
+    ),
+    (
+        'documents',
+        'UPDATE documents SET slug = CONCAT(%s, id) '
+        'WHERE id IN (SELECT document_id FROM editions WHERE access_limited = 1) AND {batch}',
+        (LOREM_IPSUM['slug'],),
+    ),
+    (
+        'fact_check_requests',
+        "UPDATE fact_check_requests SET "
+        "email_address = CONCAT('fact-email-', id, '@example.com'), "
+        "comments = '', instructions = '', \"key\" = CONCAT('redacted-', id) "
+        "WHERE {batch}",
+        (),
+    ),
+    (
+        'attachments',
+        'UPDATE attachments SET title = %s WHERE id IN (' + ACCESS_LIMITED_ATTACHMENTS + ') AND {batch}',
+        (LOREM_IPSUM['line'],),
+    ),
+    (
+        'attachments',
+        "UPDATE attachments SET slug = CONCAT(%s, '-', id) "
+        "WHERE id IN (" + ACCESS_LIMITED_ATTACHMENTS + ") AND {batch}",
+        (LOREM_IPSUM['slug'],),
+    ),
+    (
+        'attachment_data',
+        "UPDATE attachment_data SET carrierwave_file = 'redacted.pdf' "
+        "WHERE id IN (SELECT attachment_data_id FROM attachments WHERE id IN (" +
+        ACCESS_LIMITED_ATTACHMENTS + ")) AND {batch}",
+        (),
+    ),
+    (
+        'govspeak_contents',
+        "UPDATE govspeak_contents "
+        "SET body = %s, computed_body_html = NULL, computed_headers_html = NULL "
+        "FROM attachments, editions "
+        "WHERE attachments.id = govspeak_contents.html_attachment_id "
+        "AND attachments.attachable_id = editions.id "
+        "AND attachments.attachable_type = 'Edition' AND editions.access_limited = 1 "
+        "AND {batch}",
+        (LOREM_IPSUM['paragraphs'],),
+    ),
+]
+
+
+def baseline(runner):
+    for (table, sql, params) in BASELINE_STATEMENTS:
+        runner.execute_in_batches(sql, params=params, table=table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-table rule planning")
+    parser.add_argument('--dsn', help="Postgres connection string (default: DATASCRUBBER_BENCHMARK_POSTGRES)")
+    parser.add_argument('--scale', type=int, default=10, help="Size of the data, in thousands of documents (default: 10)")
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(whitehall_schema.get_dsn(args.dsn))
+    spec = whitehall_schema.inline_sets(whitehall_schema.load_whitehall_ruleset())
+    ruleset = Ruleset('whitehall', 'postgres', spec['rules'], indexes=spec.get('indexes', []))
+
+    variants = [
+        ('hand-written statements', baseline),
+        ('per-table plan', ruleset.scrub),
+    ]
+
+    results = []
+    for (name, scrub) in variants:
+        whitehall_schema.reset_schema(connection, args.scale)
+        results.append((name, whitehall_schema.measure(connection, scrub, args.batch_size)))
+
+    whitehall_schema.print_results(results)
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# A synthetic, Whitehall-shaped Postgres schema for the ruleset benchmarks,
+# with the tables and columns the whitehall ruleset scrubs, and helpers to
+# run a scrub against it and measure what it cost.
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import datascrubber.batching  # noqa: E402
+import datascrubber.rules  # noqa: E402
+
+TABLES = [
+    'documents', 'editions', 'edition_translations', 'fact_check_requests',
+    'attachments', 'attachment_data', 'govspeak_contents',
+]
+
+# Rows per unit of scale
+SCHEMA = [
+    "CREATE TABLE documents (id serial PRIMARY KEY, slug varchar(255))",
+    "INSERT INTO documents (slug) SELECT 'document-' || i FROM generate_series(1, {scale} * 1000) i",
+
+    "CREATE TABLE editions (id serial PRIMARY KEY, document_id integer, access_limited smallint)",
+    # Three editions per document, one in twenty access limited
+    "INSERT INTO editions (document_id, access_limited) "
+    "SELECT 1 + (i % ({scale} * 1000)), CASE WHEN i % 20 = 0 THEN 1 ELSE 0 END "
+    "FROM generate_series(1, {scale} * 3000) i",
+
+    "CREATE TABLE edition_translations (id serial PRIMARY KEY, edition_id integer, "
+    "title varchar(255), summary text, body text)",
+    "INSERT INTO edition_translations (edition_id, title, summary, body) "
+    "SELECT i, 'Title ' || i, repeat('summary ', 20), repeat('body text ', 200) "
+    "FROM generate_series(1, {scale} * 3000) i",
+
+    "CREATE TABLE fact_check_requests (id serial PRIMARY KEY, email_address varchar(255), "
+    "comments text, instructions text, key varchar(255))",
+    "INSERT INTO fact_check_requests (email_address, comments, instructions, key) "
+    "SELECT 'person' || i || '@example.gov.uk', repeat('comment ', 30), repeat('instruction ', 30), md5(i::text) "
+    "FROM generate_series(1, {scale} * 500) i",
+
+    "CREATE TABLE attachment_data (id serial PRIMARY KEY, carrierwave_file varchar(255))",
+    "INSERT INTO attachment_data (carrierwave_file) "
+    "SELECT 'file-' || i || '.pdf' FROM generate_series(1, {scale} * 6000) i",
+
+    # Two attachments per edition, and one in four of them HTML
+    "CREATE TABLE attachments (id serial PRIMARY KEY, attachable_type varchar(255), "
+    "attachable_id integer, attachment_data_id integer, title varchar(255), slug varchar(255))",
+    "INSERT INTO attachments (attachable_type, attachable_id, attachment_data_id, title, slug) "
+    "SELECT CASE WHEN i % 10 = 0 THEN 'PolicyGroup' ELSE 'Edition' END, 1 + (i % ({scale} * 3000)), i, "
+    "'Attachment ' || i, 'attachment-' || i "
+    "FROM generate_series(1, {scale} * 6000) i",
+
+    "CREATE TABLE govspeak_contents (id serial PRIMARY KEY, html_attachment_id integer, "
+    "body text, computed_body_html text, computed_headers_html text)",
+    "INSERT INTO govspeak_contents (html_attachment_id, body, computed_body_html, computed_headers_html) "
+    "SELECT i * 4, repeat('govspeak ', 100), repeat('<p>html</p>', 100), '<h2>header</h2>' "
+    "FROM generate_series(1, {scale} * 1500) i",
+]
+
+
+def get_dsn(args_dsn):
+    dsn = args_dsn or os.environ.get('DATASCRUBBER_BENCHMARK_POSTGRES')
+    if not dsn:
+        sys.exit("Give a Postgres connection string with --dsn or DATASCRUBBER_BENCHMARK_POSTGRES")
+    return dsn
+
+
+def load_whitehall_ruleset():
+    # The packaged ruleset is for MySQL, but its SQL is portable, so it's
+    # loaded as a Postgres one
+    path = os.path.join(datascrubber.rules.RULESETS_DIR, 'whitehall.json')
+    with open(path) as f:
+        spec = json.load(f)
+
+    return spec
+
+
+def inline_sets(spec):
+    # The ruleset as it'd be without sets: each reference to a set replaced
+    # with the set's query, as a subquery evaluated wherever it's used
+    queries = {}
+    for s in spec.get('sets', []):
+        queries[s['name']] = '({0}) AS {1}'.format(
+            datascrubber.rules.substitute_sets(s['sql'], queries), s['name'],
+        )
+
+    rules = []
+    for rule in spec['rules']:
+        rule = dict(rule)
+        if rule.get('where'):
+            rule['where'] = datascrubber.rules.substitute_sets(rule['where'], queries)
+        rules.append(rule)
+
+    return dict(spec, rules=rules, sets=[])
+
+
+def reset_schema(connection, scale):
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute('DROP TABLE IF EXISTS {0}'.format(', '.join(TABLES + [
+        datascrubber.batching.BatchRunner.checkpoint_table,
+    ])))
+    for sql in SCHEMA:
+        cursor.execute(sql.format(scale=scale))
+    cursor.execute('VACUUM ANALYZE')
+    cursor.close()
+    connection.autocommit = False
+
+
+def read_counters(connection):
+    # WAL written so far, the blocks read or hit in the whole database (so
+    # that those of the sets' tables, dropped by the time this is called,
+    # are counted) and the row updates in the benchmark tables
+    connection.autocommit = True
+    cursor = connection.cursor()
+    try:
+        # Postgres 15 onwards only flushes statistics every so often
+        cursor.execute('SELECT pg_stat_force_next_flush()')
+    except Exception:
+        time.sleep(1)
+
+    cursor.execute('SELECT pg_current_wal_lsn()')
+    wal = cursor.fetchone()[0]
+    cursor.execute(
+        'SELECT blks_read + blks_hit FROM pg_stat_database WHERE datname = current_database()'
+    )
+    blocks = int(cursor.fetchone()[0])
+    cursor.execute(
+        'SELECT COALESCE(SUM(n_tup_upd), 0) FROM pg_stat_user_tables WHERE relname = ANY(%s)',
+        (TABLES,)
+    )
+    updates = int(cursor.fetchone()[0])
+    cursor.execute("SELECT pg_wal_lsn_diff(%s, '0/0')", (wal,))
+    wal_bytes = int(cursor.fetchone()[0])
+    cursor.close()
+    connection.autocommit = False
+    return (wal_bytes, blocks, updates)
+
+
+def measure(connection, scrub, batch_size):
+    # Runs scrub(runner) as a task would be, and returns its cost
+    before = read_counters(connection)
+    runner = datascrubber.batching.BatchRunner(
+        connection, 'benchmark', batch_size, engine='postgres',
+    )
+    started = time.monotonic()
+    scrub(runner)
+    runner.finish('none')
+    connection.commit()
+    seconds = time.monotonic() - started
+    after = read_counters(connection)
+
+    return {
+        'seconds': seconds,
+        'statements': runner.statement_count,
+        'wal_mb': (after[0] - before[0]) / 1024 / 1024,
+        'blocks': after[1] - before[1],
+        'row_updates': after[2] - before[2],
+    }
+
+
+def print_results(results):
+    print('{0:<28} {1:>10} {2:>10} {3:>10} {4:>12} {5:>12}'.format(
+        'variant', 'statements', 'seconds', 'WAL MiB', 'blocks', 'row updates',
+    ))
+    for (name, r) in results:
+        print('{0:<28} {1:>10} {2:>10.2f} {3:>10.1f} {4:>12} {5:>12}'.format(
+            name, r['statements'], r['seconds'], r['wal_mb'], r['blocks'], r['row_updates'],
+        ))
@@ -1,22 +1,63 @@
 import random
 import time
 import logging
-import dns.resolver
+import botocore.exceptions
 import dns.name
 import hashlib
 from datetime import datetime
 
+from .discovery import DnsCache, RdsEndpointIndex
+from .timing import increment, span
+from .waiters import Waiter
+
 logger = logging.getLogger(__name__)
 
+# The snapshot a workspace (or standby) instance was restored from
+SOURCE_SNAPSHOT_TAG = 'scrubber-source-snapshot'
+
+
+def iterate_db_snapshots(rds_client, **kwargs):
+    paginator = rds_client.get_paginator('describe_db_snapshots')
+    for page in paginator.paginate(**kwargs):
+        for snapshot in page['DBSnapshots']:
+            yield snapshot
+
+
+def snapshot_age_key(snapshot):
+    # Snapshots which are still being created don't have a create time yet,
+    # and are newer than any which do
+    create_time = snapshot.get('SnapshotCreateTime')
+    if create_time is None:
+        return (1, None)
+
+    return (0, create_time)
+
 
 class ScrubWorkspaceInstance:
-    def __init__(self, snapshot_finder, boto3_session, timeout=90, security_groups=None):
+    # Rough durations, in seconds, of each phase of the workspace lifecycle,
+    # used to avoid polling RDS too often before they're likely to be done
+    expected_durations = {
+        'restore': 20 * 60,
+        'modify': 5 * 60,
+        'reboot': 5 * 60,
+        'snapshot': 10 * 60,
+    }
+
+    def __init__(self, snapshot_finder, boto3_session, timeout=90, security_groups=None, poller=None, standby_pool=None, instance_class=None, storage_type=None, iops=None, parameter_group=None, bulk_write_parameter_group=None, report=None, keep_on_failure=False, resume=False):
         timestamp = datetime.now()
 
         self.boto3_session = boto3_session
         self.rds_client = self.boto3_session.client('rds')
         self.snapshot_finder = snapshot_finder
         self.timeout = timeout
+        self.poller = poller
+        self.standby_pool = standby_pool
+        self.report = report
+        # A workspace kept after a failed scrub can be picked up again by a
+        # later run with resume, whose tasks then carry on from their
+        # checkpoints rather than starting again on a fresh restore
+        self.keep_on_failure = keep_on_failure
+        self.resume = resume
         self.password = "{0:x}".format(random.getrandbits(41 * 4))
 
         self.source_snapshot = self.snapshot_finder.get_snapshot()
@@ -34,6 +75,7 @@ class ScrubWorkspaceInstance:
 
         self.instance = None
         self.deleted = False
+        self.final_snapshot_created = False
 
         if type(security_groups) == str:
             self.security_groups = [security_groups]
@@ -48,6 +90,31 @@ class ScrubWorkspaceInstance:
                 if sg['Status'] == 'active'
             ]
 
+        # The bulk write parameter group trades durability for speed. Nothing
+        # is lost by it once the scrub has finished, as the instance is idle
+        # and every commit is flushed within a second or so, and snapshots
+        # don't carry the instance's parameter group with them, so the
+        # workspace keeps it until it's deleted.
+        if bulk_write_parameter_group is not None and parameter_group is None:
+            parameter_group = bulk_write_parameter_group.ensure(
+                self.source_snapshot['Engine'],
+                self.source_snapshot['EngineVersion'],
+            )
+
+        # Settings which are applied when the instance is restored, rather
+        # than by modifying it afterwards and waiting for that to complete
+        self.instance_options = {
+            'VpcSecurityGroupIds': self.security_groups,
+        }
+        if instance_class is not None:
+            self.instance_options['DBInstanceClass'] = instance_class
+        if storage_type is not None:
+            self.instance_options['StorageType'] = storage_type
+        if iops is not None:
+            self.instance_options['Iops'] = iops
+        if parameter_group is not None:
+            self.instance_options['DBParameterGroupName'] = parameter_group
+
         logger.info(
             "Initialised scrub workspace instance, DBInstanceIdentifier: %s",
             self.instance_identifier
@@ -65,31 +132,84 @@ class ScrubWorkspaceInstance:
         return self.password
 
     def get_instance(self):
+        if self.instance is None and self.resume:
+            self.__adopt_existing_instance()
+
         if self.instance is None:
-            logger.info(
-                "Instance %s doesn't exist yet, creating",
-                self.instance_identifier
-            )
-            self.__create_instance()
-            self.__apply_instance_modifications()
+            standby_identifier = None
+            if self.standby_pool is not None:
+                with self.__span('claim_standby') as s:
+                    standby_identifier = self.standby_pool.claim(self.source_snapshot)
+                    s['standby'] = standby_identifier
+
+            if standby_identifier is None:
+                logger.info(
+                    "Instance %s doesn't exist yet, creating",
+                    self.instance_identifier
+                )
+                with self.__span('restore'):
+                    self.__create_instance()
+                with self.__span('modify'):
+                    self.__apply_instance_modifications()
+                self.__reboot_for_parameter_group()
+
+            else:
+                logger.info(
+                    "Using standby instance %s as %s",
+                    standby_identifier,
+                    self.instance_identifier
+                )
+                with self.__span('modify', standby=standby_identifier):
+                    self.__apply_instance_modifications(rename_from=standby_identifier)
+                self.__reboot_for_parameter_group()
 
         return self.instance
 
+    def create_final_snapshot(self):
+        # Snapshots the live instance, which remains usable (e.g. by running
+        # exports) while the snapshot is being taken
+        if self.final_snapshot_created:
+            return
+
+        logger.info(
+            "Creating final snapshot %s of RDS instance %s",
+            self.final_snapshot_identifier,
+            self.instance_identifier,
+        )
+        with self.__span('final_snapshot'):
+            requested_at = time.time()
+            self.rds_client.create_db_snapshot(
+                DBSnapshotIdentifier=self.final_snapshot_identifier,
+                DBInstanceIdentifier=self.instance_identifier,
+            )
+            self.final_snapshot_created = True
+            self.__wait_for_final_snapshot(requested_at)
+
     def cleanup(self, create_final_snapshot=True):
+        if self.instance is not None and not self.deleted and not create_final_snapshot and self.keep_on_failure:
+            logger.info(
+                "Keeping RDS instance %s after a failed scrub, to be resumed "
+                "with --resume-workspace or deleted by hand",
+                self.instance_identifier,
+            )
+            return
+
         if self.instance is not None and not self.deleted:
             rds = self.rds_client
-            if create_final_snapshot:
+            if create_final_snapshot and not self.final_snapshot_created:
                 logger.info(
                     "Deleting RDS instance %s and creating final snapshot %s",
                     self.instance_identifier,
                     self.final_snapshot_identifier,
                 )
-                rds.delete_db_instance(
-                    DBInstanceIdentifier=self.instance_identifier,
-                    FinalDBSnapshotIdentifier=self.final_snapshot_identifier,
-                )
-                self.deleted = True
-                self.__wait_for_final_snapshot()
+                with self.__span('final_snapshot', deleting=True):
+                    requested_at = time.time()
+                    rds.delete_db_instance(
+                        DBInstanceIdentifier=self.instance_identifier,
+                        FinalDBSnapshotIdentifier=self.final_snapshot_identifier,
+                    )
+                    self.deleted = True
+                    self.__wait_for_final_snapshot(requested_at)
             else:
                 logger.info(
                     "Deleting RDS instance %s without final snapshot",
@@ -107,14 +227,20 @@ class ScrubWorkspaceInstance:
             self.instance_identifier,
         )
 
-        response = self.rds_client.describe_db_snapshots(IncludeShared=True)
+        # Final snapshots are manual snapshots of the workspace instance, so
+        # there's no need to enumerate every snapshot in the account
         snapshots = [
-            s for s in response['DBSnapshots'] if s['DBInstanceIdentifier'] == self.instance_identifier
+            {
+                'DBSnapshotIdentifier': s['DBSnapshotIdentifier'],
+                'SnapshotCreateTime': s.get('SnapshotCreateTime'),
+            }
+            for s in iterate_db_snapshots(
+                self.rds_client,
+                DBInstanceIdentifier=self.instance_identifier,
+                SnapshotType='manual',
+            )
         ]
-        snapshots.sort(
-            key=lambda x: x.get('SnapshotCreateTime', 0),
-            reverse=True
-        )
+        snapshots.sort(key=snapshot_age_key, reverse=True)
 
         logger.info(
             "%d snapshots for %s exist in RDS",
@@ -143,13 +269,15 @@ class ScrubWorkspaceInstance:
         subnet_group_name = self.source_instance['DBSubnetGroup']['DBSubnetGroupName']
 
         logger.info(
-            "Restoring instance %s from snapshot %s in subnet group %s. Timeout: %s minutes",
+            "Restoring instance %s from snapshot %s in subnet group %s with %s. Timeout: %s minutes",
             self.instance_identifier,
             source_snapshot_id,
             subnet_group_name,
+            self.instance_options,
             self.timeout,
         )
 
+        requested_at = time.time()
         rds.restore_db_instance_from_db_snapshot(
             DBInstanceIdentifier=self.instance_identifier,
             DBSnapshotIdentifier=source_snapshot_id,
@@ -158,16 +286,22 @@ class ScrubWorkspaceInstance:
                 {
                     'Key': 'scrubber',
                     'Value': 'scrubber'
-                }
-            ]
+                },
+                {
+                    'Key': SOURCE_SNAPSHOT_TAG,
+                    'Value': source_snapshot_id,
+                },
+            ],
+            **self.instance_options
         )
 
-        max_end_time = time.time() + 60 * self.timeout
-        while time.time() <= max_end_time:
-            poll_response = rds.describe_db_instances(
-                DBInstanceIdentifier=self.instance_identifier
-            )
-            self.instance = poll_response['DBInstances'][0]
+        def instance_available():
+            instance = self.__describe_instance(requested_at)
+            if instance is None:
+                logger.info("Waiting for %s to appear", self.instance_identifier)
+                return False
+
+            self.instance = instance
 
             logger.info(
                 "Waiting for %s to become available, current status: '%s'",
@@ -175,93 +309,271 @@ class ScrubWorkspaceInstance:
                 self.instance['DBInstanceStatus'],
             )
 
-            if self.instance['DBInstanceStatus'] == 'available':
+            return self.instance['DBInstanceStatus'] == 'available'
+
+        self.__wait('instance', 'restore', instance_available)
+
+    def __adopt_existing_instance(self):
+        try:
+            instance = self.rds_client.describe_db_instances(
+                DBInstanceIdentifier=self.instance_identifier
+            )['DBInstances'][0]
+
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'DBInstanceNotFound':
+                logger.info(
+                    "No workspace instance %s to resume, creating one",
+                    self.instance_identifier,
+                )
                 return
-            else:
-                time.sleep(10)
+            raise
+
+        tags = {
+            t['Key']: t['Value'] for t in self.rds_client.list_tags_for_resource(
+                ResourceName=instance['DBInstanceArn']
+            )['TagList']
+        }
+        restored_from = tags.get(SOURCE_SNAPSHOT_TAG)
+        snapshot_identifier = self.source_snapshot['DBSnapshotIdentifier']
+
+        if restored_from != snapshot_identifier:
+            option = '--postgresql-snapshots' if 'postgres' in self.source_snapshot['Engine'] else '--mysql-snapshots'
+            raise Exception(
+                "Workspace instance {0} was restored from snapshot {1}, not {2}. "
+                "Resume it with {3} {1}, or delete it.".format(
+                    self.instance_identifier, restored_from, snapshot_identifier, option,
+                )
+            )
 
-        raise TimeoutError(
-            "Timed out creating RDS instance {0}".format(
+        if instance['DBInstanceStatus'] == 'deleting':
+            raise Exception("Workspace instance {0} is being deleted".format(
                 self.instance_identifier
-            )
+            ))
+
+        logger.info(
+            "Resuming scrub on existing workspace instance %s, restored from %s",
+            self.instance_identifier,
+            snapshot_identifier,
         )
 
-    def __apply_instance_modifications(self):
+        with self.__span('resume'):
+            requested_at = time.time()
+
+            def instance_available():
+                instance = self.__describe_instance(requested_at)
+                return instance is not None and instance['DBInstanceStatus'] == 'available'
+
+            self.__wait('instance', 'modify', instance_available)
+
+            # Only the password needs setting again, as it's new for each run
+            self.__apply_instance_modifications()
+
+        # e.g. if the instance was a standby, and the last run failed before
+        # rebooting it
+        self.__reboot_for_parameter_group()
+
+    def __apply_instance_modifications(self, rename_from=None):
         rds = self.rds_client
 
+        # Only settings which can't be set at restore time are applied here,
+        # unless the instance is a standby, restored without any of them
+        modifications = {
+            'MasterUserPassword': self.password,
+            'BackupRetentionPeriod': 0,
+        }
+        if rename_from is not None:
+            modifications.update(self.instance_options)
+            # Standby instances are renamed to the workspace instance
+            # identifier, so that final snapshots (and their retention)
+            # are the same whether or not a standby was used
+            modifications['NewDBInstanceIdentifier'] = self.instance_identifier
+
         logger.info(
             "Applying modifications to %s: %s",
-            self.instance_identifier,
-            {
-                'VpcSecurityGroupIds': self.security_groups,
-                'MasterUserPassword': '****',
-                'BackupRetentionPeriod': 0,
-            },
+            rename_from or self.instance_identifier,
+            dict(modifications, MasterUserPassword='****'),
         )
 
+        requested_at = time.time()
         rds.modify_db_instance(
-            DBInstanceIdentifier=self.instance_identifier,
-            VpcSecurityGroupIds=self.security_groups,
-            MasterUserPassword=self.password,
-            BackupRetentionPeriod=0,
+            DBInstanceIdentifier=rename_from or self.instance_identifier,
             ApplyImmediately=True,
+            **modifications
         )
 
-        max_end_time = time.time() + 60 * self.timeout
-        while time.time() <= max_end_time:
-            poll_response = rds.describe_db_instances(
-                DBInstanceIdentifier=self.instance_identifier
-            )
-            pending = list(
-                poll_response['DBInstances'][0]['PendingModifiedValues'].keys()
-            )
+        def modifications_applied():
+            instance = self.__describe_instance(requested_at)
+            if instance is None:
+                return False
+
+            pending = list(instance['PendingModifiedValues'].keys())
 
-            if len(pending) > 0:
+            if len(pending) > 0 or instance['DBInstanceStatus'] != 'available':
                 logger.info(
-                    "Modifications to %s still pending: %s",
+                    "Modifications to %s still pending: %s, current status: '%s'",
                     self.instance_identifier,
                     pending,
+                    instance['DBInstanceStatus'],
+                )
+                return False
+
+            self.instance = instance
+            return True
+
+        self.__wait('instance', 'modify', modifications_applied)
+
+    def __reboot_for_parameter_group(self):
+        # A parameter group only takes effect once the instance is rebooted,
+        # unless it was given when the instance was restored. RDS reports it
+        # as 'applying' for a while after it's attached, so this waits for
+        # it to settle before deciding whether a reboot is needed.
+        parameter_group = self.instance_options.get('DBParameterGroupName')
+        if parameter_group is None:
+            return
+
+        def parameter_group_status(expected, since):
+            def check():
+                instance = self.__describe_instance(since)
+                if instance is None:
+                    return False
+
+                statuses = {
+                    g['DBParameterGroupName']: g['ParameterApplyStatus']
+                    for g in instance['DBParameterGroups']
+                }
+                logger.info(
+                    "Waiting for parameter group %s on %s to be %s, current status: '%s', %s",
+                    parameter_group,
+                    self.instance_identifier,
+                    ' or '.join(expected),
+                    instance['DBInstanceStatus'],
+                    statuses,
                 )
-                time.sleep(10)
-            else:
-                return
 
-        raise TimeoutError(
-            "Timed out applying changes to RDS instance {0}".format(
-                self.instance_identifier
+                if instance['DBInstanceStatus'] != 'available' or statuses.get(parameter_group) not in expected:
+                    return False
+
+                self.instance = instance
+                return True
+
+            return check
+
+        self.__wait('instance', 'modify', parameter_group_status(['pending-reboot', 'in-sync'], time.time()))
+
+        statuses = {
+            g['DBParameterGroupName']: g['ParameterApplyStatus']
+            for g in self.instance['DBParameterGroups']
+        }
+        if statuses.get(parameter_group) != 'pending-reboot':
+            return
+
+        logger.info(
+            "Rebooting %s to apply parameter group %s",
+            self.instance_identifier,
+            parameter_group,
+        )
+
+        with self.__span('reboot', parameter_group=parameter_group):
+            requested_at = time.time()
+            self.rds_client.reboot_db_instance(
+                DBInstanceIdentifier=self.instance_identifier,
+            )
+            self.__wait('instance', 'reboot', parameter_group_status(['in-sync'], requested_at))
+
+    def __wait_for_final_snapshot(self, requested_at):
+        logger.info(
+            "Waiting for snapshot %s to become available. Timeout: %s minutes",
+            self.final_snapshot_identifier,
+            self.timeout,
+        )
+
+        def snapshot_available():
+            snapshot = self.__describe_final_snapshot(requested_at)
+            if snapshot is None:
+                return False
+
+            logger.info(
+                "Waiting for snapshot %s to become available, current status: '%s'",
+                self.final_snapshot_identifier,
+                snapshot['Status'],
             )
+
+            return snapshot['Status'] == 'available'
+
+        self.__wait('snapshot', 'snapshot', snapshot_available)
+
+        logger.info(
+            "Snapshot %s is now available",
+            self.final_snapshot_identifier
         )
 
-    def __wait_for_final_snapshot(self):
-        rds = self.rds_client
+    def __span(self, phase, **attributes):
+        return span(
+            self.report, 'workspace.' + phase,
+            instance=self.instance_identifier,
+            **attributes
+        )
 
-        max_end_time = time.time() + 60 * self.timeout
-        while time.time() <= max_end_time:
-            try:
-                logger.info(
-                    "Waiting for snapshot %s to become available. Timeout: %s minutes",
-                    self.final_snapshot_identifier,
-                    self.timeout,
-                )
+    def __wait(self, resource, phase, check):
+        # With a shared poller, checks read the poller's results rather than
+        # calling RDS themselves, so they're cheap; the poller only looks up
+        # resources which are being waited on.
+        if resource == 'instance':
+            identifier = self.instance_identifier
+            watch = self.poller.watch_instance if self.poller else None
+            unwatch = self.poller.unwatch_instance if self.poller else None
+        else:
+            identifier = self.final_snapshot_identifier
+            watch = self.poller.watch_snapshot if self.poller else None
+            unwatch = self.poller.unwatch_snapshot if self.poller else None
+
+        waiter = Waiter(
+            "{0} {1} ({2})".format(resource, identifier, phase),
+            timeout=60 * self.timeout,
+            expected_duration=self.expected_durations[phase],
+        )
+        if self.poller is not None:
+            waiter.max_delay = self.poller.interval
+
+        if watch is not None:
+            watch(identifier)
+        try:
+            waiter.wait(check)
+        finally:
+            if unwatch is not None:
+                unwatch(identifier)
+            increment(self.report, 'throttle_retries', waiter.throttle_retries, source='waiter')
+
+    def __describe_instance(self, since):
+        if self.poller is not None:
+            return self.poller.get_instance(self.instance_identifier, since)
+
+        try:
+            poll_response = self.rds_client.describe_db_instances(
+                DBInstanceIdentifier=self.instance_identifier
+            )
+            return poll_response['DBInstances'][0]
 
-                poll_response = rds.describe_db_snapshots(
-                    DBSnapshotIdentifier=self.final_snapshot_identifier
-                )
+        except botocore.exceptions.ClientError as e:
+            # e.g. while a standby is being renamed
+            if e.response['Error']['Code'] == 'DBInstanceNotFound':
+                return None
+            raise
 
-                if poll_response['DBSnapshots'][0]['Status'] == 'available':
-                    logger.info(
-                        "Snapshot %s is now available",
-                        self.final_snapshot_identifier
-                    )
-                    return
+    def __describe_final_snapshot(self, since):
+        if self.poller is not None:
+            return self.poller.get_snapshot(self.final_snapshot_identifier, since)
 
-                else:
-                    time.sleep(10)
-            except Exception as e:
-                if e.response['Error']['Code'] == 'DBSnapshotNotFound':
-                    time.sleep(10)
-                else:
-                    raise(e)
+        try:
+            poll_response = self.rds_client.describe_db_snapshots(
+                DBSnapshotIdentifier=self.final_snapshot_identifier
+            )
+            return poll_response['DBSnapshots'][0]
+
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'DBSnapshotNotFound':
+                return None
+            raise
 
 
 class RdsSnapshotFinder:
@@ -305,24 +617,32 @@ class RdsSnapshotFinder:
             logger.info("Discovering snapshot identifier...")
 
             source_instance_id = self.get_source_instance_identifier()
-            response = self.rds_client.describe_db_snapshots(
+
+            most_recent = None
+            count = 0
+            for snapshot in iterate_db_snapshots(
+                self.rds_client,
                 DBInstanceIdentifier=source_instance_id,
-            )
+                SnapshotType='automated',
+            ):
+                count += 1
+                if snapshot['Status'] != 'available':
+                    continue
 
-            if len(response['DBSnapshots']) == 0:
-                raise Exception("No snapshots found")
+                if most_recent is None or snapshot_age_key(snapshot) > snapshot_age_key(most_recent):
+                    most_recent = snapshot
 
             logger.debug(
-                "Found %d snapshots for %s",
-                len(response['DBSnapshots']),
+                "Found %d automated snapshots for %s",
+                count,
                 source_instance_id,
             )
 
-            response['DBSnapshots'].sort(
-                key=lambda x: x.get('SnapshotCreateTime', 0),
-                reverse=True
-            )
-            most_recent = response['DBSnapshots'][0]
+            if most_recent is None:
+                raise Exception("No available automated snapshots found for {0}".format(
+                    source_instance_id
+                ))
+
             self.snapshot_identifier = most_recent['DBSnapshotIdentifier']
 
             logger.info("Using snapshot %s", self.snapshot_identifier)
@@ -345,28 +665,21 @@ class RdsSnapshotFinder:
             if self.source_instance_identifier is None:
                 logger.info("Discovering source RDS instance...")
 
-                rds_instances = self.rds_client.describe_db_instances()
+                address = self.get_rds_endpoint_address()
+                instance = RdsEndpointIndex.lookup(self.rds_client, address)
+
+                if instance is None:
+                    raise Exception("Couldn't find an RDS instance matching endpoint address %s" % address)
 
-                logger.debug(
-                    "Enumerated %d RDS instances",
-                    len(rds_instances['DBInstances'])
+                logger.info(
+                    "RDS instance %s matches endpoint address %s:%s",
+                    instance['DBInstanceIdentifier'],
+                    instance['Endpoint']['Address'],
+                    instance['Endpoint']['Port'],
                 )
 
-                for instance in rds_instances['DBInstances']:
-                    if 'Endpoint' in instance and instance['Endpoint']['Address'] == self.get_rds_endpoint_address():
-                        logger.info(
-                            "RDS instance %s matches endpoint address %s:%s",
-                            instance['DBInstanceIdentifier'],
-                            instance['Endpoint']['Address'],
-                            instance['Endpoint']['Port'],
-                        )
-
-                        self.source_instance = instance
-                        self.source_instance_identifier = instance['DBInstanceIdentifier']
-                        break
-
-                if self.source_instance is None:
-                    raise Exception("Couldn't find an RDS instance matching endpoint address %s" % self.get_rds_endpoint_address())
+                self.source_instance = instance
+                self.source_instance_identifier = instance['DBInstanceIdentifier']
             else:
                 logger.info("Looking up RDS instance %s ...", self.source_instance_identifier)
                 # An exception will be raised if the instance doesn't exist
@@ -387,9 +700,7 @@ class RdsSnapshotFinder:
         if self.rds_endpoint_address is None:
             logger.info("Discovering RDS endpoint address via DNS...")
 
-            resolver = dns.resolver.Resolver()
-            resolution = resolver.query(self.get_hostname())
-            cname = resolution.canonical_name
+            cname = DnsCache.get_canonical_name(self.get_hostname())
 
             if not cname.is_subdomain(self.rds_domain):
                 raise Exception("{0} is not a subdomain of RDS domain ({1})".format(
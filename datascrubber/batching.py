@@ -0,0 +1,995 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import tempfile
+
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+BATCH_MARKER = '{batch}'
+
+# Backslash escapes in Postgres' COPY text format
+COPY_ESCAPES = {
+    'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v',
+}
+
+# Column types transform() can rewrite with COPY, whose text representation is
+# the value itself
+TEXT_TYPES = ('text', 'character varying', 'character')
+# Integer column types, as information_schema names them in Postgres and MySQL
+INTEGER_TYPES = ('smallint', 'integer', 'bigint', 'tinyint', 'mediumint', 'int')
+
+
+class BatchRunner:
+    # Progress through each statement is recorded in a checkpoint table inside
+    # the database being scrubbed, in the same transaction as the work itself,
+    # so running a task again against the same workspace carries on from the
+    # last committed chunk. finish() drops the table so it never makes it
+    # into the final snapshot.
+
+    checkpoint_table = 'datascrubber_checkpoints'
+    secret_statement = 'secret'
+    stage_table = 'datascrubber_stage'
+    rewrite_table = 'datascrubber_rewrite'
+    # Rows read from the server at a time by transform()
+    fetch_size = 1000
+
+    def __init__(self, connection, task, batch_size=10000, report=None, engine=None, keep_set_threshold=0.3, rewrite_threshold=0.5):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.task = task
+        self.batch_size = batch_size
+        self.report = report
+        self.engine = engine
+        self.keep_set_threshold = keep_set_threshold
+        self.rewrite_threshold = rewrite_threshold
+
+        self.statement_count = 0
+        self.checkpoints = None
+        self.temporary_indexes = []
+        self.modified_tables = []
+        self.materialised = []
+
+    def execute(self, sql, params=None):
+        statement_id = self._next_statement_id(sql)
+        with self._span(statement_id, sql) as s:
+            if self._is_complete(statement_id):
+                logger.info("Skipping statement %s, already completed", statement_id)
+                s['skipped'] = True
+                return 0
+
+            s['rowcount'] = self._execute_once(statement_id, sql, params)
+            return s['rowcount']
+
+    def execute_in_batches(self, sql, params=None, table=None, key='id', key_expression=None):
+        # sql must contain BATCH_MARKER as a WHERE condition, after any other
+        # placeholders; it is replaced with a range condition on
+        # key_expression (table.key by default) for each chunk.
+        if table is None:
+            raise Exception("A table is required to execute a statement in batches")
+
+        if key_expression is None:
+            key_expression = '{0}.{1}'.format(table, key)
+
+        self._modified(table)
+        statement_id = self._next_statement_id(sql)
+        with self._span(statement_id, sql, table) as s:
+            s['rowcount'] = self._execute_in_batches(
+                statement_id, sql, params, table, key, key_expression, s,
+            )
+            return s['rowcount']
+
+    def _execute_in_batches(self, statement_id, sql, params, table, key, key_expression, s):
+        if self._is_complete(statement_id):
+            logger.info("Skipping statement %s, already completed", statement_id)
+            s['skipped'] = True
+            return 0
+
+        # MIN() and MAX() aren't defined for every type (e.g. uuid), so the
+        # key's type is looked up first, where it can be
+        integer_key = self._is_integer_column(table, key)
+        if integer_key is not False:
+            self.cursor.execute('SELECT MIN({0}), MAX({0}) FROM {1}'.format(key, table))
+            (lower, upper) = self.cursor.fetchone()
+
+            if lower is None:
+                logger.info("Table %s is empty, nothing to do", table)
+                self._save_checkpoint(statement_id, None, True)
+                self.connection.commit()
+                return 0
+
+        if integer_key is False or not isinstance(lower, int):
+            logger.warning(
+                "%s.%s is not an integer key, running statement %s in one go",
+                table, key, statement_id,
+            )
+            return self._execute_once(statement_id, sql.replace(BATCH_MARKER, '1 = 1'), params)
+
+        last_key = self.checkpoints.get(statement_id, (None, False))[0]
+        if last_key is not None:
+            logger.info(
+                "Resuming statement %s on %s from %s=%d",
+                statement_id, table, key, last_key + 1,
+            )
+            lower = last_key + 1
+
+        batch_sql = sql.replace(
+            BATCH_MARKER,
+            '{0} >= %s AND {0} < %s'.format(key_expression),
+        )
+        logger.debug(batch_sql)
+
+        rowcount = 0
+        start = lower
+        while start <= upper:
+            end = start + self.batch_size
+            self.cursor.execute(batch_sql, tuple(params or ()) + (start, end))
+            rowcount += self.cursor.rowcount
+
+            self._save_checkpoint(statement_id, end - 1, end > upper)
+            self.connection.commit()
+
+            logger.debug(
+                "Statement %s: %s %d-%d done, %d rows affected so far",
+                statement_id, key, start, end - 1, rowcount,
+            )
+            start = end
+            s['batches'] = s.get('batches', 0) + 1
+
+        if lower > upper:
+            self._save_checkpoint(statement_id, upper, True)
+            self.connection.commit()
+
+        return rowcount
+
+    def retain(self, table, condition, params=None, key='id'):
+        # Removes every row of table which doesn't match condition. When the
+        # table statistics suggest only a small fraction of rows will be
+        # kept (below keep_set_threshold), the rows to keep are copied aside
+        # and put back into an emptied table, which is much quicker than
+        # deleting the rest and leaves no dead rows behind. Otherwise, or if
+        # the table can't safely be emptied, the rest are deleted in batches.
+        # Returns the number of rows removed, which is an estimate when they
+        # were removed by copying.
+        self._modified(table)
+        statement_id = self._next_statement_id(
+            'RETAIN {0} WHERE {1}'.format(table, condition)
+        )
+        with self._span(statement_id, condition, table) as s:
+            if self._is_complete(statement_id):
+                logger.info("Skipping statement %s, already completed", statement_id)
+                s['skipped'] = True
+                return 0
+
+            (total, kept) = self._estimate_rows(table, condition, params)
+            s['estimated_rows'] = total
+            s['estimated_kept'] = kept
+            logger.info(
+                "Retaining rows of %s where %s: an estimated %d of %d rows",
+                table, condition, kept, total,
+            )
+
+            if total > 0 and kept / total < self.keep_set_threshold and self._can_empty(table):
+                s['method'] = 'copy'
+                kept = self._retain_by_copy(statement_id, table, condition, params)
+                s['rows_kept'] = kept
+                s['rowcount'] = max(0, total - kept)
+
+            else:
+                s['method'] = 'delete'
+                s['rowcount'] = self._execute_in_batches(
+                    statement_id,
+                    'DELETE FROM {0} WHERE NOT COALESCE(({1}), FALSE) AND {{batch}}'.format(
+                        table, condition
+                    ),
+                    params, table, key, '{0}.{1}'.format(table, key), s,
+                )
+
+            return s['rowcount']
+
+    def get_secret(self):
+        # A random key for pseudonymising values (e.g. with a keyed hash),
+        # which stays the same if the task is resumed, so that values
+        # scrubbed before and after an interruption still match. It's kept
+        # in the checkpoint table, and so is dropped along with it.
+        if self.checkpoints is None:
+            self._load_checkpoints()
+
+        if self.secret_statement not in self.checkpoints:
+            self._save_checkpoint(
+                self.secret_statement,
+                random.SystemRandom().getrandbits(62),
+                True,
+            )
+            self.connection.commit()
+
+        return str(self.checkpoints[self.secret_statement][0])
+
+    def create_temporary_index(self, table, columns):
+        # Indexes table on columns for the duration of the task, unless an
+        # existing index already starts with them. Temporary indexes are
+        # dropped by finish(), so they don't make it into the final snapshot.
+        columns = list(columns)
+        name = 'datascrubber_{0}'.format(
+            hashlib.sha256('{0}({1})'.format(table, ','.join(columns)).encode()).hexdigest()[0:16]
+        )
+
+        for (index_name, index_columns) in self._get_indexes(table):
+            if index_columns[0:len(columns)] == columns:
+                if index_name == name:
+                    # Left over from an earlier, interrupted run of the task
+                    self.temporary_indexes.append((table, name))
+                else:
+                    logger.info(
+                        "%s(%s) is already indexed by %s",
+                        table, ', '.join(columns), index_name,
+                    )
+                return
+
+        with span(self.report, 'index', task=self.task, table=table, columns=columns):
+            logger.info(
+                "Creating temporary index %s on %s(%s)",
+                name, table, ', '.join(columns),
+            )
+            self.cursor.execute('CREATE INDEX {0} ON {1} ({2})'.format(
+                name, table, ', '.join(columns)
+            ))
+            self.connection.commit()
+
+        self.temporary_indexes.append((table, name))
+
+    def materialise(self, name, sql, params=None, columns=[]):
+        # Runs a query once into an indexed table, dropped by finish(), so that
+        # statements which share a subquery can select from the table
+        # instead of each evaluating it again. Returns the table's name. The
+        # query is run again when a task is resumed, so it must give the same
+        # answer for any statements which haven't completed yet.
+        table = 'datascrubber_set_{0}'.format(name)
+
+        with span(self.report, 'materialise', task=self.task, table=table) as s:
+            if self.engine == 'mysql':
+                # Not a TEMPORARY table, as MySQL doesn't allow those to be
+                # referred to more than once in a statement
+                self.cursor.execute('DROP TABLE IF EXISTS {0}'.format(table))
+                indexes = ''
+                if len(columns) > 0:
+                    indexes = '({0}) '.format(
+                        ', '.join('INDEX ({0})'.format(c) for c in columns)
+                    )
+                self.cursor.execute('CREATE TABLE {0} {1}{2}'.format(
+                    table, indexes, sql,
+                ), params)
+                s['rowcount'] = self.cursor.rowcount
+
+            else:
+                self.cursor.execute('DROP TABLE IF EXISTS {0}'.format(table))
+                self.cursor.execute('CREATE TEMPORARY TABLE {0} AS {1}'.format(table, sql), params)
+                s['rowcount'] = self.cursor.rowcount
+                for c in columns:
+                    self.cursor.execute('CREATE INDEX ON {0} ({1})'.format(table, c))
+                # Temporary tables are never analysed automatically
+                self.cursor.execute('ANALYZE {0}'.format(table))
+
+            self.connection.commit()
+
+        logger.info("Materialised %d rows into %s", s['rowcount'], table)
+        if table not in self.materialised:
+            self.materialised.append(table)
+
+        return table
+
+    def transform(self, table, columns, function, key='id', condition=None, params=None):
+        # Rewrites columns of table in Python, for scrubs that can't be done
+        # in SQL. function is called with each row (matching condition, if
+        # given) as a dict of its key and columns, and returns a dict of new
+        # values for any of the columns, or None to leave the row as it is.
+        #
+        # Rows are read batch_size keys at a time through a server side
+        # cursor, fetch_size rows at a time, and the changed ones are written
+        # back in bulk through a staging table, so memory use doesn't depend
+        # on the size of the table. Each batch is checkpointed, as with
+        # execute_in_batches, so function must give the same result for a
+        # row whichever run of the task it's called in. Tables without an
+        # integer key (e.g. a uuid) are read the same way, but in a single
+        # batch. Returns the number of rows changed.
+        #
+        # In Postgres, when the table statistics suggest at least
+        # rewrite_threshold of the table's rows match condition, and the
+        # columns are all text, the whole table is instead streamed out with
+        # COPY, through function and into an unlogged table, then put back
+        # in place of the original rows. That writes each row once, rather
+        # than leaving a dead copy of every updated row behind.
+        columns = list(columns)
+        description = 'TRANSFORM {0} ({1}) WITH {2}{3}'.format(
+            table,
+            ', '.join(columns),
+            getattr(function, '__name__', 'function'),
+            ' WHERE {0}'.format(condition) if condition else '',
+        )
+
+        self._modified(table)
+        statement_id = self._next_statement_id(description)
+        with self._span(statement_id, description, table) as s:
+            if self._is_complete(statement_id):
+                logger.info("Skipping statement %s, already completed", statement_id)
+                s['skipped'] = True
+                return 0
+
+            if self.engine == 'postgres':
+                (total, matching) = self._estimate_rows(table, condition or 'TRUE', params)
+                s['estimated_rows'] = total
+                s['estimated_matching'] = matching
+
+                if (
+                    total > 0 and
+                    matching / total >= self.rewrite_threshold and
+                    self._can_rewrite(table, columns, key)
+                ):
+                    logger.info(
+                        "Transforming %s by copying, as an estimated %d of %d rows match",
+                        table, matching, total,
+                    )
+                    s['method'] = 'copy'
+                    s['rowcount'] = self._transform_by_copy(
+                        statement_id, table, columns, function, key, condition, params,
+                    )
+                    return s['rowcount']
+
+            s['method'] = 'update'
+            integer_key = self._is_integer_column(table, key)
+            if integer_key is not False:
+                self.cursor.execute('SELECT MIN({0}), MAX({0}) FROM {1}'.format(key, table))
+                (lower, upper) = self.cursor.fetchone()
+
+                if lower is None:
+                    logger.info("Table %s is empty, nothing to do", table)
+                    self._save_checkpoint(statement_id, None, True)
+                    self.connection.commit()
+                    s['rowcount'] = 0
+                    return 0
+
+            select_sql = 'SELECT {0}, {1} FROM {2}{3}'.format(
+                key,
+                ', '.join(columns),
+                table,
+                ' WHERE ({0})'.format(condition) if condition else '',
+            )
+
+            self._create_stage(table, key, columns)
+
+            if integer_key is False or not isinstance(lower, int):
+                # As with execute_in_batches, the whole table is done in one
+                # transaction, but still read and written a chunk at a time
+                logger.warning(
+                    "%s.%s is not an integer key, transforming %s in one go",
+                    table, key, table,
+                )
+                logger.debug(select_sql)
+                rowcount = self._transform_rows(table, key, columns, function, select_sql, params)
+                self._save_checkpoint(statement_id, None, True)
+                self.connection.commit()
+
+                self._drop_stage()
+                s['rowcount'] = rowcount
+                return rowcount
+
+            last_key = self.checkpoints.get(statement_id, (None, False))[0]
+            if last_key is not None:
+                logger.info(
+                    "Resuming statement %s on %s from %s=%d",
+                    statement_id, table, key, last_key + 1,
+                )
+                lower = last_key + 1
+
+            select_sql += '{0} {1} >= %s AND {1} < %s ORDER BY {1}'.format(
+                ' AND' if condition else ' WHERE', key,
+            )
+            logger.debug(select_sql)
+
+            rowcount = 0
+            start = lower
+            while start <= upper:
+                end = start + self.batch_size
+                rowcount += self._transform_rows(
+                    table, key, columns, function, select_sql, tuple(params or ()) + (start, end),
+                )
+
+                self._save_checkpoint(statement_id, end - 1, end > upper)
+                self.connection.commit()
+
+                logger.debug(
+                    "Statement %s: %s %d-%d done, %d rows changed so far",
+                    statement_id, key, start, end - 1, rowcount,
+                )
+                start = end
+                s['batches'] = s.get('batches', 0) + 1
+
+            if lower > upper:
+                self._save_checkpoint(statement_id, upper, True)
+                self.connection.commit()
+
+            self._drop_stage()
+            s['rowcount'] = rowcount
+            return rowcount
+
+    def _transform_rows(self, table, key, columns, function, select_sql, params):
+        # Passes the rows select_sql selects through function, and writes
+        # back the changed ones. Returns the number of rows changed.
+        for rows in self._select_in_chunks(select_sql, params):
+            changed = []
+            for row in rows:
+                values = function(dict(zip([key] + columns, row)))
+                if values:
+                    changed.append((row[0],) + tuple(
+                        values.get(c, row[i + 1]) for (i, c) in enumerate(columns)
+                    ))
+
+            if len(changed) > 0:
+                self._write_stage(key, columns, changed)
+
+        return self._apply_stage(table, key, columns)
+
+    def finish(self, maintenance='analyze'):
+        # maintenance is what to do with the tables the task modified, once
+        # it's done: 'analyze' refreshes their statistics (and, in Postgres,
+        # vacuums them), 'compact' also rewrites them to reclaim the space
+        # left by deleted and updated rows, and 'none' does nothing
+        for (table, name) in self.temporary_indexes:
+            logger.info("Dropping temporary index %s on %s", name, table)
+            if self.engine == 'mysql':
+                self.cursor.execute('DROP INDEX {0} ON {1}'.format(name, table))
+            else:
+                self.cursor.execute('DROP INDEX IF EXISTS {0}'.format(name))
+        self.temporary_indexes = []
+
+        for table in self.materialised:
+            self.cursor.execute('DROP TABLE IF EXISTS {0}'.format(table))
+        self.materialised = []
+
+        logger.info("Removing checkpoints for task %s", self.task)
+        self.cursor.execute('DROP TABLE IF EXISTS {0}'.format(self.checkpoint_table))
+        self.connection.commit()
+
+        if maintenance != 'none':
+            self._maintain(maintenance)
+
+        self.cursor.close()
+
+    def _maintain(self, maintenance):
+        autocommit = self.connection.autocommit
+        if self.engine == 'postgres':
+            # VACUUM can't run inside a transaction. The connection is put
+            # back as it was afterwards, as it may go back to a pool.
+            self.connection.autocommit = True
+            command = 'VACUUM (FULL, ANALYZE) {0}' if maintenance == 'compact' else 'VACUUM (ANALYZE) {0}'
+        else:
+            command = 'OPTIMIZE TABLE {0}' if maintenance == 'compact' else 'ANALYZE TABLE {0}'
+
+        try:
+            for table in self.modified_tables:
+                with span(self.report, 'maintenance', task=self.task, table=table, method=maintenance):
+                    logger.info("Running %s", command.format(table))
+                    self.cursor.execute(command.format(table))
+                    if self.engine == 'mysql':
+                        # Both return a result set, which has to be read
+                        self.cursor.fetchall()
+                    self.connection.commit()
+        finally:
+            if self.engine == 'postgres':
+                self.connection.autocommit = autocommit
+
+    def _get_indexes(self, table):
+        # Returns a list of (index name, [column, ...]) for table
+        if self.engine == 'postgres':
+            self.cursor.execute(
+                'SELECT c.relname, array_agg(a.attname::text ORDER BY k.n) '
+                'FROM pg_index i '
+                'JOIN pg_class c ON c.oid = i.indexrelid '
+                'CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, n) '
+                'JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum '
+                'WHERE i.indrelid = %s::regclass '
+                'GROUP BY c.relname',
+                (table,)
+            )
+            indexes = [(row[0], list(row[1])) for row in self.cursor.fetchall()]
+
+        else:
+            self.cursor.execute(
+                'SELECT index_name, column_name FROM information_schema.statistics '
+                'WHERE table_schema = DATABASE() AND table_name = %s '
+                'ORDER BY index_name, seq_in_index',
+                (table,)
+            )
+            indexes = []
+            for (index_name, column_name) in self.cursor.fetchall():
+                if len(indexes) == 0 or indexes[-1][0] != index_name:
+                    indexes.append((index_name, []))
+                indexes[-1][1].append(column_name)
+
+        self.connection.commit()
+        return indexes
+
+    def _is_integer_column(self, table, column):
+        # True or False, or None if the column can't be found in the
+        # catalog (e.g. the table name is qualified with its schema)
+        if self.engine == 'postgres':
+            schema = 'current_schema()'
+        else:
+            schema = 'DATABASE()'
+
+        self.cursor.execute(
+            'SELECT data_type FROM information_schema.columns '
+            'WHERE table_schema = {0} AND table_name = %s AND column_name = %s'.format(schema),
+            (table, column)
+        )
+        row = self.cursor.fetchone()
+        self.connection.commit()
+
+        if row is None:
+            return None
+
+        data_type = row[0]
+        if isinstance(data_type, (bytes, bytearray)):
+            data_type = data_type.decode()
+        return data_type.lower() in INTEGER_TYPES
+
+    def _modified(self, table):
+        if table not in self.modified_tables:
+            self.modified_tables.append(table)
+
+    def _estimate_rows(self, table, condition, params):
+        # Returns the planner's estimates of the number of rows in table, and
+        # of those matching condition, without scanning it
+        select = 'SELECT * FROM {0} WHERE {1}'.format(table, condition)
+
+        if self.engine == 'postgres':
+            # Both come from the planner, rather than pg_class.reltuples,
+            # which TRUNCATE (e.g. by retain()) resets until the table's next
+            # ANALYZE; the planner scales it by the table's current size
+            def plan_rows(sql, params):
+                self.cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                plan = self.cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                return int(plan[0]['Plan']['Plan Rows'])
+
+            total = plan_rows('SELECT * FROM {0}'.format(table), None)
+            kept = plan_rows(select, params)
+
+        elif self.engine == 'mysql':
+            self.cursor.execute(
+                'SELECT table_rows FROM information_schema.tables '
+                'WHERE table_schema = DATABASE() AND table_name = %s',
+                (table,)
+            )
+            total = int(self.cursor.fetchone()[0] or 0)
+
+            self.cursor.execute('EXPLAIN ' + select, params)
+            columns = [d[0] for d in self.cursor.description]
+            row = dict(zip(columns, self.cursor.fetchall()[0]))
+            kept = int((row.get('rows') or 0) * float(row.get('filtered') or 100) / 100)
+
+        else:
+            raise Exception("Can't estimate row counts for engine {0}".format(self.engine))
+
+        self.connection.commit()
+        return (total, min(kept, total))
+
+    def _can_empty(self, table):
+        # Postgres won't truncate a table other tables have foreign keys to,
+        # and putting the rows back would fire the table's own triggers as if
+        # they were new. In MySQL, the table is swapped for a copy, which
+        # would have none of its foreign keys or triggers, and leave those
+        # referencing it pointing at the old table. In both, the rows are put
+        # back as they are, which generated columns (and in Postgres, GENERATED
+        # ALWAYS identity columns) don't allow.
+        if self.engine == 'postgres':
+            self.cursor.execute(
+                "SELECT COUNT(*) FROM pg_constraint "
+                "WHERE contype = 'f' AND confrelid = %s::regclass",
+                (table,)
+            )
+            blockers = self.cursor.fetchone()[0]
+            # Foreign keys are enforced by internal triggers, which are left
+            # to the check above
+            self.cursor.execute(
+                'SELECT COUNT(*) FROM pg_trigger '
+                'WHERE tgrelid = %s::regclass AND NOT tgisinternal',
+                (table,)
+            )
+            blockers += self.cursor.fetchone()[0]
+            self.cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = %s "
+                "AND (is_generated = 'ALWAYS' OR identity_generation = 'ALWAYS')",
+                (table,)
+            )
+            blockers += self.cursor.fetchone()[0]
+
+        else:
+            self.cursor.execute(
+                'SELECT COUNT(*) FROM information_schema.key_column_usage '
+                'WHERE table_schema = DATABASE() '
+                'AND referenced_table_name IS NOT NULL '
+                'AND (table_name = %s OR referenced_table_name = %s)',
+                (table, table)
+            )
+            blockers = self.cursor.fetchone()[0]
+            self.cursor.execute(
+                'SELECT COUNT(*) FROM information_schema.triggers '
+                'WHERE event_object_schema = DATABASE() AND event_object_table = %s',
+                (table,)
+            )
+            blockers += self.cursor.fetchone()[0]
+            # Not DEFAULT_GENERATED, which MySQL 8 reports for expression
+            # defaults
+            self.cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.columns "
+                "WHERE table_schema = DATABASE() AND table_name = %s "
+                "AND (extra LIKE '%%VIRTUAL GENERATED%%' OR extra LIKE '%%STORED GENERATED%%')",
+                (table,)
+            )
+            blockers += self.cursor.fetchone()[0]
+
+        self.connection.commit()
+
+        if blockers > 0:
+            logger.info(
+                "%s has foreign keys, triggers or generated columns which prevent "
+                "copying the rows to keep",
+                table,
+            )
+        return blockers == 0
+
+    def _retain_by_copy(self, statement_id, table, condition, params):
+        if self.engine == 'postgres':
+            # TRUNCATE is transactional in Postgres, so this either happens
+            # entirely, along with its checkpoint, or not at all
+            self.cursor.execute(
+                'CREATE TEMPORARY TABLE datascrubber_keep ON COMMIT DROP AS '
+                'SELECT * FROM {0} WHERE {1}'.format(table, condition),
+                params
+            )
+            kept = self.cursor.rowcount
+            self.cursor.execute('TRUNCATE {0}'.format(table))
+            self.cursor.execute('INSERT INTO {0} SELECT * FROM datascrubber_keep'.format(table))
+
+            self._save_checkpoint(statement_id, None, True)
+            self.connection.commit()
+            return kept
+
+        # MySQL DDL commits implicitly, so the copy is built under another
+        # name and swapped in with an atomic RENAME. Every step can be
+        # repeated if the task is interrupted before the checkpoint.
+        keep_table = '{0}_datascrubber_keep'.format(table)
+        old_table = '{0}_datascrubber_old'.format(table)
+
+        self.cursor.execute('DROP TABLE IF EXISTS {0}, {1}'.format(keep_table, old_table))
+        self.cursor.execute('CREATE TABLE {0} LIKE {1}'.format(keep_table, table))
+        self.cursor.execute(
+            'INSERT INTO {0} SELECT * FROM {1} WHERE {2}'.format(keep_table, table, condition),
+            params
+        )
+        kept = self.cursor.rowcount
+        self.connection.commit()
+
+        self.cursor.execute('RENAME TABLE {0} TO {1}, {2} TO {0}'.format(table, old_table, keep_table))
+        self.cursor.execute('DROP TABLE {0}'.format(old_table))
+
+        self._save_checkpoint(statement_id, None, True)
+        self.connection.commit()
+        return kept
+
+    def _can_rewrite(self, table, columns, key):
+        # The original rows are removed and put back as _retain_by_copy does
+        # them, and values are only passed to function unconverted from
+        # COPY's text format for text columns, and an integer, text or uuid
+        # key (the latter as its text).
+        if not self._can_empty(table):
+            return False
+
+        self.cursor.execute(
+            'SELECT column_name, data_type FROM information_schema.columns '
+            'WHERE table_schema = current_schema() AND table_name = %s',
+            (table,)
+        )
+        types = dict(self.cursor.fetchall())
+        self.connection.commit()
+
+        key_types = INTEGER_TYPES + TEXT_TYPES + ('uuid',)
+        if types.get(key) not in key_types or any(types.get(c) not in TEXT_TYPES for c in columns):
+            logger.info(
+                "%s.%s isn't an integer, text or uuid, or %s aren't all text, which prevents copying it",
+                table, key, ', '.join(columns),
+            )
+            return False
+
+        return True
+
+    def _transform_by_copy(self, statement_id, table, columns, function, key, condition, params):
+        # The table is copied out to a local temporary file first, as a
+        # connection can only run one COPY at a time, and then read back
+        # through function as it's copied into the rewrite table. Rows are
+        # written twice, into the rewrite table (unlogged, so without WAL) and
+        # back into the emptied table, but no dead row versions are left
+        # behind, as a batched UPDATE would. TRUNCATE is
+        # transactional in Postgres, so all of this happens, along with its
+        # checkpoint, or none of it does.
+        self.cursor.execute('SELECT * FROM {0} LIMIT 0'.format(table))
+        table_columns = [d[0] for d in self.cursor.description]
+        key_position = table_columns.index(key)
+        positions = [table_columns.index(c) for c in columns]
+        decode_key = int if self._is_integer_column(table, key) else decode_copy_field
+
+        select = 'SELECT *, COALESCE(({0}), FALSE) FROM {1}'.format(condition or 'TRUE', table)
+        select = self.cursor.mogrify(select, params)
+        if isinstance(select, bytes):
+            select = select.decode(self.connection.encoding)
+
+        changed = 0
+
+        def rewrite(lines):
+            nonlocal changed
+            for line in lines:
+                fields = line[:-1].split('\t')
+                if fields.pop() == 't':
+                    row = {key: decode_key(fields[key_position])}
+                    for (c, p) in zip(columns, positions):
+                        row[c] = decode_copy_field(fields[p])
+
+                    values = function(row)
+                    if values:
+                        for (c, p) in zip(columns, positions):
+                            if c in values:
+                                fields[p] = encode_copy_field(values[c])
+                        changed += 1
+
+                yield '\t'.join(fields) + '\n'
+
+        with tempfile.TemporaryFile('w+', encoding='utf-8', newline='\n') as spool:
+            with span(self.report, 'copy.out', task=self.task, table=table):
+                self.cursor.copy_expert('COPY ({0}) TO STDOUT'.format(select), spool)
+            spool.seek(0)
+
+            self.cursor.execute('DROP TABLE IF EXISTS {0}'.format(self.rewrite_table))
+            self.cursor.execute('CREATE UNLOGGED TABLE {0} (LIKE {1})'.format(
+                self.rewrite_table, table,
+            ))
+            with span(self.report, 'copy.in', task=self.task, table=table):
+                self.cursor.copy_expert(
+                    'COPY {0} FROM STDIN'.format(self.rewrite_table),
+                    IteratorFile(rewrite(spool)),
+                )
+
+        self.cursor.execute('TRUNCATE {0}'.format(table))
+        self.cursor.execute('INSERT INTO {0} SELECT * FROM {1}'.format(table, self.rewrite_table))
+        self.cursor.execute('DROP TABLE {0}'.format(self.rewrite_table))
+
+        self._save_checkpoint(statement_id, None, True)
+        self.connection.commit()
+        return changed
+
+    def _select_in_chunks(self, sql, params):
+        # Yields the rows selected by sql, in lists of up to fetch_size rows
+        if self.engine == 'postgres':
+            # A named cursor keeps the result on the server, and stays open
+            # while other statements run in the same transaction
+            cursor = self.connection.cursor(name='datascrubber_transform')
+            cursor.itersize = self.fetch_size
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(self.fetch_size)
+                    if len(rows) == 0:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+            return
+
+        # MySQL streams an unbuffered result, but won't run anything else on
+        # the connection until every row has been read, so the whole batch
+        # is read before any of it is written back
+        cursor = self.connection.cursor(buffered=False)
+        try:
+            cursor.execute(sql, params)
+            rows = []
+            while True:
+                chunk = cursor.fetchmany(self.fetch_size)
+                if len(chunk) == 0:
+                    break
+                rows.extend(chunk)
+        finally:
+            cursor.close()
+
+        for i in range(0, len(rows), self.fetch_size):
+            yield rows[i:i + self.fetch_size]
+
+    def _create_stage(self, table, key, columns):
+        # An empty temporary table with the same types as the key and columns
+        # of table, into which changed rows are written before being applied
+        # to table with a single UPDATE
+        self._drop_stage()
+        select = 'SELECT {0}, {1} FROM {2}'.format(key, ', '.join(columns), table)
+        if self.engine == 'postgres':
+            self.cursor.execute('CREATE TEMPORARY TABLE {0} AS {1} WITH NO DATA'.format(
+                self.stage_table, select,
+            ))
+            self.cursor.execute('ALTER TABLE {0} ADD PRIMARY KEY ({1})'.format(
+                self.stage_table, key,
+            ))
+        else:
+            self.cursor.execute('CREATE TEMPORARY TABLE {0} (PRIMARY KEY ({1})) {2} LIMIT 0'.format(
+                self.stage_table, key, select,
+            ))
+        self.connection.commit()
+
+    def _write_stage(self, key, columns, rows):
+        if self.engine == 'postgres':
+            # COPY's text format, in which NULL is \N and so distinct from
+            # an empty string, whatever the column's type. Values are written
+            # as str() gives them.
+            data = IteratorFile(
+                '\t'.join(encode_copy_field(v) for v in row) + '\n' for row in rows
+            )
+            self.cursor.copy_expert(
+                'COPY {0} ({1}, {2}) FROM STDIN'.format(
+                    self.stage_table, key, ', '.join(columns),
+                ),
+                data,
+            )
+        else:
+            # MySQL Connector sends an executemany INSERT as one statement
+            self.cursor.executemany(
+                'INSERT INTO {0} ({1}, {2}) VALUES ({3})'.format(
+                    self.stage_table, key, ', '.join(columns),
+                    ', '.join(['%s'] * (len(columns) + 1)),
+                ),
+                rows,
+            )
+
+    def _apply_stage(self, table, key, columns):
+        if self.engine == 'postgres':
+            self.cursor.execute('UPDATE {0} SET {1} FROM {2} WHERE {0}.{3} = {2}.{3}'.format(
+                table,
+                ', '.join('{0} = {1}.{0}'.format(c, self.stage_table) for c in columns),
+                self.stage_table,
+                key,
+            ))
+            rowcount = self.cursor.rowcount
+            self.cursor.execute('TRUNCATE {0}'.format(self.stage_table))
+        else:
+            self.cursor.execute('UPDATE {0} JOIN {1} ON {0}.{2} = {1}.{2} SET {3}'.format(
+                table,
+                self.stage_table,
+                key,
+                ', '.join('{0}.{2} = {1}.{2}'.format(table, self.stage_table, c) for c in columns),
+            ))
+            rowcount = self.cursor.rowcount
+            # TRUNCATE would commit implicitly
+            self.cursor.execute('DELETE FROM {0}'.format(self.stage_table))
+
+        return rowcount
+
+    def _drop_stage(self):
+        if self.engine == 'postgres':
+            self.cursor.execute('DROP TABLE IF EXISTS {0}'.format(self.stage_table))
+        else:
+            # Unlike DROP TABLE, this doesn't commit implicitly
+            self.cursor.execute('DROP TEMPORARY TABLE IF EXISTS {0}'.format(self.stage_table))
+        self.connection.commit()
+
+    def _span(self, statement_id, sql, table=None):
+        return span(
+            self.report, 'statement',
+            task=self.task,
+            statement=statement_id,
+            table=table,
+            sql=' '.join(sql.split()),
+        )
+
+    def _execute_once(self, statement_id, sql, params):
+        logger.debug(sql)
+        self.cursor.execute(sql, params)
+        rowcount = self.cursor.rowcount
+
+        self._save_checkpoint(statement_id, None, True)
+        self.connection.commit()
+
+        return rowcount
+
+    def _next_statement_id(self, sql):
+        self.statement_count += 1
+        return '{0}-{1}'.format(
+            self.statement_count,
+            hashlib.sha256(sql.encode()).hexdigest()[0:12],
+        )
+
+    def _is_complete(self, statement_id):
+        if self.checkpoints is None:
+            self._load_checkpoints()
+
+        return self.checkpoints.get(statement_id, (None, False))[1]
+
+    def _load_checkpoints(self):
+        self.cursor.execute(
+            'CREATE TABLE IF NOT EXISTS {0} ('
+            '  task VARCHAR(255) NOT NULL,'
+            '  statement VARCHAR(64) NOT NULL,'
+            '  last_key BIGINT,'
+            '  completed BOOLEAN NOT NULL,'
+            '  PRIMARY KEY (task, statement)'
+            ')'.format(self.checkpoint_table)
+        )
+        self.cursor.execute(
+            'SELECT statement, last_key, completed FROM {0} '
+            'WHERE task = %s'.format(self.checkpoint_table),
+            (self.task,)
+        )
+        self.checkpoints = {
+            row[0]: (row[1], bool(row[2])) for row in self.cursor.fetchall()
+        }
+        self.connection.commit()
+
+        if len(self.checkpoints) > 0:
+            logger.info(
+                "Found %d checkpoints for task %s from a previous run",
+                len(self.checkpoints), self.task,
+            )
+
+    def _save_checkpoint(self, statement_id, last_key, completed):
+        self.cursor.execute(
+            'DELETE FROM {0} WHERE task = %s AND statement = %s'.format(
+                self.checkpoint_table
+            ),
+            (self.task, statement_id)
+        )
+        self.cursor.execute(
+            'INSERT INTO {0} (task, statement, last_key, completed) '
+            'VALUES (%s, %s, %s, %s)'.format(self.checkpoint_table),
+            (self.task, statement_id, last_key, completed)
+        )
+        self.checkpoints[statement_id] = (last_key, completed)
+
+
+class IteratorFile:
+    # A file-like object which reads the strings an iterator yields, so that
+    # COPY FROM STDIN can load rows as they're generated
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self.buffer)
+
+        (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+
+def decode_copy_field(field):
+    if field == '\\N':
+        return None
+
+    return re.sub(
+        r'\\(.)', lambda m: COPY_ESCAPES.get(m.group(1), m.group(1)), field
+    )
+
+
+def encode_copy_field(value):
+    if value is None:
+        return '\\N'
+
+    value = str(value).replace('\\', '\\\\')
+    for (letter, character) in COPY_ESCAPES.items():
+        value = value.replace(character, '\\' + letter)
+    return value
@@ -1,14 +1,22 @@
 import logging
 import logging.handlers
 import argparse
-import subprocess
+import concurrent.futures
 import sys
 import threading
 import traceback
 import boto3
-import socket
 
 from . import ScrubWorkspaceInstance, RdsSnapshotFinder
+from .compression import CODECS, get_codec
+from .exports import ExportPipeline
+from .metrics import build_metrics, push_prometheus, send_statsd, write_prometheus_file
+from .notifications import IcingaNotifier
+from .poller import RdsStatusPoller
+from .parameter_groups import BulkWriteParameterGroup
+from .pool import StandbyPool
+from .s3 import S3Uploader
+from .timing import RunReport
 from .task_managers import Mysql, Postgresql
 
 
@@ -18,101 +26,126 @@ def main():
     logger = logging.getLogger()
     logger.info('Starting up')
 
+    if args.prune_standbys:
+        session = boto3.session.Session(region_name=args.region)
+        StandbyPool(session).prune(args.standby_max_age)
+        logger.info('Finished pruning standby instances')
+        return
+
+    worker_function = worker
+    if args.prepare_standby:
+        worker_function = prepare_standby_worker
+
+    poller = RdsStatusPoller(region=args.region, interval=args.rds_poll_interval)
+    poller.start()
+
+    report = RunReport()
+
+    notifier = None
+    if args.icinga_host is not None:
+        notifier = IcingaNotifier(args.icinga_host)
+        notifier.start()
+
+    worker_options = {
+        'poller': poller,
+        'report': report,
+        'use_standby': args.use_standby,
+        'keep_workspace_on_failure': args.keep_workspace_on_failure,
+        'resume_workspace': args.resume_workspace,
+        'instance_class': args.workspace_instance_class,
+        'storage_type': args.workspace_storage_type,
+        'iops': args.workspace_iops,
+        'parameter_group': args.workspace_parameter_group,
+        'bulk_write_parameters': args.bulk_write_parameters,
+        'target_accounts': args.share_with,
+        'region': args.region,
+        'snapshot_retention': args.snapshot_retention,
+        'notifier': notifier,
+        's3': args.s3_export,
+        'batch_size': args.batch_size,
+        'task_concurrency': args.task_concurrency,
+        'export_concurrency': args.export_concurrency,
+        'export_parallelism': args.export_parallelism,
+        's3_endpoint_url': args.s3_endpoint_url,
+        's3_part_size': args.s3_part_size,
+        's3_upload_concurrency': args.s3_upload_concurrency,
+        'export_codec': args.export_codec,
+        'export_compression_level': args.export_compression_level,
+        'rulesets': args.rules,
+        'maintenance': args.post_scrub_maintenance,
+    }
+
     threads = []
 
     if args.mysql_snapshots is not None:
         for snap_id in args.mysql_snapshots:
             thread = threading.Thread(
-                target=worker,
-                kwargs=({
-                    'dbms': 'mysql',
-                    'snapshot': snap_id,
-                    'target_accounts': args.share_with,
-                    'region': args.region,
-                    'snapshot_retention': args.snapshot_retention,
-                    'icinga_host': args.icinga_host,
-                    's3': args.s3_export,
-                }),
+                target=worker_function,
+                kwargs=dict(
+                    worker_options,
+                    dbms='mysql',
+                    snapshot=snap_id,
+                ),
             )
             threads.append(thread)
 
     elif args.mysql_instances is not None:
         for instance_id in args.mysql_instances:
             thread = threading.Thread(
-                target=worker,
-                kwargs=({
-                    'dbms': 'mysql',
-                    'instance': instance_id,
-                    'target_accounts': args.share_with,
-                    'region': args.region,
-                    'snapshot_retention': args.snapshot_retention,
-                    'icinga_host': args.icinga_host,
-                    's3': args.s3_export,
-                })
+                target=worker_function,
+                kwargs=dict(
+                    worker_options,
+                    dbms='mysql',
+                    instance=instance_id,
+                ),
             )
             threads.append(thread)
 
     elif args.mysql_hosts is not None:
         for host in args.mysql_hosts:
             thread = threading.Thread(
-                target=worker,
-                kwargs=({
-                    'dbms': 'mysql',
-                    'hostname': host,
-                    'target_accounts': args.share_with,
-                    'region': args.region,
-                    'snapshot_retention': args.snapshot_retention,
-                    'icinga_host': args.icinga_host,
-                    's3': args.s3_export,
-                })
+                target=worker_function,
+                kwargs=dict(
+                    worker_options,
+                    dbms='mysql',
+                    hostname=host,
+                ),
             )
             threads.append(thread)
 
     if args.postgresql_snapshots is not None:
         for snap_id in args.postgresql_snapshots:
             thread = threading.Thread(
-                target=worker,
-                kwargs=({
-                    'dbms': 'postgresql',
-                    'snapshot': snap_id,
-                    'target_accounts': args.share_with,
-                    'region': args.region,
-                    'snapshot_retention': args.snapshot_retention,
-                    'icinga_host': args.icinga_host,
-                    's3': args.s3_export,
-                }),
+                target=worker_function,
+                kwargs=dict(
+                    worker_options,
+                    dbms='postgresql',
+                    snapshot=snap_id,
+                ),
             )
             threads.append(thread)
 
     elif args.postgresql_instances is not None:
         for instance_id in args.postgresql_instances:
             thread = threading.Thread(
-                target=worker,
-                kwargs=({
-                    'dbms': 'postgresql',
-                    'instance': instance_id,
-                    'target_accounts': args.share_with,
-                    'region': args.region,
-                    'snapshot_retention': args.snapshot_retention,
-                    'icinga_host': args.icinga_host,
-                    's3': args.s3_export,
-                })
+                target=worker_function,
+                kwargs=dict(
+                    worker_options,
+                    dbms='postgresql',
+                    instance=instance_id,
+                ),
             )
             threads.append(thread)
 
     elif args.postgresql_hosts is not None:
         for host in args.postgresql_hosts:
             thread = threading.Thread(
-                target=worker,
-                kwargs=({
-                    'dbms': 'postgresql',
-                    'hostname': host,
-                    'target_accounts': args.share_with,
-                    'region': args.region,
-                    'snapshot_retention': args.snapshot_retention,
-                    'icinga_host': args.icinga_host,
-                    's3': args.s3_export,
-                })
+                target=worker_function,
+                kwargs=dict(
+                    worker_options,
+                    dbms='postgresql',
+                    hostname=host,
+                ),
             )
             threads.append(thread)
 
@@ -122,8 +155,36 @@ def main():
     for thread in threads:
         thread.join()
 
+    poller.stop()
+    if notifier is not None:
+        notifier.close()
     logger.info('All tasks completed')
 
+    if args.report_file is not None:
+        report.write(args.report_file)
+
+    publish_metrics(args, report, poller)
+
+
+def publish_metrics(args, report, poller):
+    # Metrics are best-effort: failing to publish them shouldn't fail a run
+    # whose scrubs have already completed
+    logger = logging.getLogger()
+    metrics = build_metrics(report, poller)
+
+    try:
+        if args.metrics_file is not None:
+            write_prometheus_file(metrics, args.metrics_file)
+
+        if args.metrics_pushgateway is not None:
+            push_prometheus(metrics, args.metrics_pushgateway, args.metrics_job)
+
+        if args.statsd_host is not None:
+            send_statsd(metrics, args.statsd_host, args.statsd_prefix)
+
+    except Exception as e:
+        logger.error("Error publishing metrics: %s", e)
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -239,6 +300,266 @@ def parse_arguments():
         help="Dump scrubbed database and export to S3 at the specified URL prefix (e.g. s3://bucket/keyprefix)"
     )
 
+    parser.add_argument(
+        '--batch-size',
+        required=False,
+        type=int,
+        default=10000,
+        help="Number of primary key values covered by each chunk of a batched "
+             "scrub statement; each chunk is committed separately (default: 10000)"
+    )
+
+    parser.add_argument(
+        '--task-concurrency',
+        required=False,
+        type=int,
+        default=1,
+        help="Maximum number of scrub tasks to run at once against each "
+             "workspace instance, each on its own connection (default: 1)"
+    )
+
+    parser.add_argument(
+        '--export-concurrency',
+        required=False,
+        type=int,
+        default=1,
+        help="Maximum number of S3 exports to run at once per workspace "
+             "instance. Exports run in the background alongside subsequent "
+             "scrub tasks (default: 1)"
+    )
+
+    parser.add_argument(
+        '--export-parallelism',
+        required=False,
+        type=int,
+        default=1,
+        help="Number of parallel dump streams per S3 export. Above 1, each "
+             "database is exported as multiple objects plus a manifest, to "
+             "be restored with datascrubber-restore (default: 1)"
+    )
+
+    parser.add_argument(
+        '--s3-endpoint-url',
+        required=False,
+        type=str,
+        help="S3 endpoint URL to export to, e.g. a local S3-compatible "
+             "service for testing (default: the AWS endpoint for the region)"
+    )
+
+    parser.add_argument(
+        '--s3-part-size',
+        required=False,
+        type=int,
+        default=16,
+        help="Size in MiB of each part of the multipart upload used for S3 "
+             "exports, minimum 5 (default: 16)"
+    )
+
+    parser.add_argument(
+        '--s3-upload-concurrency',
+        required=False,
+        type=int,
+        default=4,
+        help="Number of parts of each S3 export to upload at once. Memory "
+             "use per export is roughly this times the part size (default: 4)"
+    )
+
+    parser.add_argument(
+        '--export-codec',
+        required=False,
+        type=str,
+        choices=sorted(CODECS.keys()),
+        default='gzip',
+        help="Compression for S3 exports. pigz and zstd compress on all "
+             "available cores (default: gzip)"
+    )
+
+    parser.add_argument(
+        '--export-compression-level',
+        required=False,
+        type=int,
+        help="Compression level for S3 exports, 1-9 for gzip and pigz or "
+             "1-19 for zstd (default: the codec's own default)"
+    )
+
+    parser.add_argument(
+        '--rds-poll-interval',
+        required=False,
+        type=int,
+        default=15,
+        help="Seconds between lookups of the status of workspace instances and "
+             "snapshots being waited on. One lookup covers all workers "
+             "(default: 15)"
+    )
+
+    standby_mode = parser.add_mutually_exclusive_group()
+    standby_mode.add_argument(
+        '--prepare-standby',
+        required=False,
+        action='store_true',
+        help="Instead of scrubbing, restore a standby instance from the latest "
+             "snapshot of each selected source, to be picked up by a later "
+             "run with --use-standby"
+    )
+
+    standby_mode.add_argument(
+        '--use-standby',
+        required=False,
+        action='store_true',
+        help="Scrub using a standby instance prepared with --prepare-standby, "
+             "if one restored from the same snapshot is available, instead of "
+             "restoring a new workspace instance"
+    )
+
+    standby_mode.add_argument(
+        '--prune-standbys',
+        required=False,
+        action='store_true',
+        help="Delete standby instances which are older than --standby-max-age "
+             "or weren't restored from the latest snapshot of their source, "
+             "and exit"
+    )
+
+    parser.add_argument(
+        '--keep-workspace-on-failure',
+        required=False,
+        action='store_true',
+        help="Don't delete the workspace instance when a scrub fails, so that "
+             "it can be resumed with --resume-workspace"
+    )
+
+    parser.add_argument(
+        '--resume-workspace',
+        required=False,
+        action='store_true',
+        help="Carry on with a workspace instance kept from an earlier failed "
+             "run of the same snapshot, if there is one, skipping the parts "
+             "of each scrub task which already completed"
+    )
+
+    parser.add_argument(
+        '--standby-max-age',
+        required=False,
+        type=int,
+        default=24,
+        help="Maximum age in hours of standby instances kept by "
+             "--prune-standbys (default: 24)"
+    )
+
+    parser.add_argument(
+        '--workspace-instance-class',
+        required=False,
+        type=str,
+        help="RDS instance class for workspace instances, e.g. to scrub on a "
+             "bigger instance than the source (default: the snapshot's)"
+    )
+
+    parser.add_argument(
+        '--workspace-storage-type',
+        required=False,
+        type=str,
+        choices=['standard', 'gp2', 'gp3', 'io1'],
+        help="Storage type for workspace instances (default: the snapshot's)"
+    )
+
+    parser.add_argument(
+        '--workspace-iops',
+        required=False,
+        type=int,
+        help="Provisioned IOPS for workspace instances, with "
+             "--workspace-storage-type io1 or gp3"
+    )
+
+    parser.add_argument(
+        '--workspace-parameter-group',
+        required=False,
+        type=str,
+        help="DB parameter group for workspace instances (default: the "
+             "engine's default parameter group)"
+    )
+
+    parser.add_argument(
+        '--bulk-write-parameters',
+        required=False,
+        action='store_true',
+        help="Run scrubs with a managed parameter group which relaxes commit "
+             "durability (e.g. synchronous_commit=off, "
+             "innodb_flush_log_at_trx_commit=2). Standby instances are "
+             "rebooted to apply it. Ignored if --workspace-parameter-group "
+             "is given"
+    )
+
+    parser.add_argument(
+        '--report-file',
+        required=False,
+        type=str,
+        help="Write a JSON report of how long each phase of the run took "
+             "(workspace restore and modifications, each scrub task and SQL "
+             "statement, exports and final snapshots) to this file"
+    )
+
+    parser.add_argument(
+        '--metrics-file',
+        required=False,
+        type=str,
+        help="Write run metrics in Prometheus text format to this file, e.g. "
+             "for the node exporter's textfile collector"
+    )
+
+    parser.add_argument(
+        '--metrics-pushgateway',
+        required=False,
+        type=str,
+        help="URL of a Prometheus pushgateway to push run metrics to"
+    )
+
+    parser.add_argument(
+        '--metrics-job',
+        required=False,
+        type=str,
+        default='datascrubber',
+        help="Job name to push metrics under. Default: datascrubber"
+    )
+
+    parser.add_argument(
+        '--statsd-host',
+        required=False,
+        type=str,
+        help="host[:port] of a StatsD server to send run metrics to"
+    )
+
+    parser.add_argument(
+        '--statsd-prefix',
+        required=False,
+        type=str,
+        default='datascrubber',
+        help="Prefix for StatsD metric names. Default: datascrubber"
+    )
+
+    parser.add_argument(
+        '--rules',
+        required=False,
+        nargs='+',
+        type=str,
+        default=[],
+        help="Additional scrub rulesets (JSON, or YAML if PyYAML is "
+             "installed) to run as tasks, alongside those in "
+             "datascrubber/rulesets/. A ruleset with the same task name as a "
+             "built in one replaces it"
+    )
+
+    parser.add_argument(
+        '--post-scrub-maintenance',
+        required=False,
+        choices=['none', 'analyze', 'compact'],
+        default='analyze',
+        help="What to do with each table a scrub task modified, once it's "
+             "finished: 'analyze' refreshes table statistics (VACUUM ANALYZE "
+             "in Postgres, ANALYZE TABLE in MySQL), 'compact' also rewrites "
+             "the tables to reclaim space (VACUUM FULL, OPTIMIZE TABLE) for a "
+             "smaller final snapshot. Default: analyze"
+    )
+
     return parser.parse_args()
 
 
@@ -280,53 +601,42 @@ def configure_logging(mode, level_name):
         return log_config_syslog()
 
 
-def submit_passive_icinga_check(task, status, icinga_host, info=None):
+def prepare_standby_worker(dbms, hostname=None, instance=None, snapshot=None, region=None, **kwargs):
     logger = logging.getLogger()
+    logger.info("Spawned new standby worker thread")
 
-    status_numeric = {
-        'OK': 0,
-        'WARNING': 1,
-        'CRITICAL': 2
-    }.get(status.upper(), 0)
-
-    if info is None:
-        info = status
-
-    message = "{0}\t{1}\t{2}\t{3}\n".format(
-        socket.gethostbyname(socket.gethostname()),
-        "GOV.UK data scrubber {0}".format(task),
-        status_numeric,
-        info,
-    )
+    try:
+        session = boto3.session.Session(region_name=region)
 
-    send_nsca_command = ['send_nsca', '-H', icinga_host]
-    send_nsca = subprocess.Popen(
-        send_nsca_command,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
+        snapshot_finder = RdsSnapshotFinder(
+            boto3_session=session,
+            hostname=hostname,
+            source_instance_identifier=instance,
+            snapshot_identifier=snapshot,
+        )
 
-    output = send_nsca.communicate(message.encode('utf-8'))[0]
+        StandbyPool(session).prepare(snapshot_finder)
 
-    logger.info(
-        "Submitted check result to Icinga: %s",
-        {'command': send_nsca_command,
-         'message': message,
-         'exitcode': 0,
-         'output': output.decode('utf-8')}
-    )
+    except Exception as e:
+        logger.critical(
+            "Standby worker encountered an unrecoverable error: %s, traceback: %s", e,
+            traceback.format_tb(e.__traceback__)
+        )
 
 
-def worker(dbms, hostname=None, instance=None, snapshot=None, region=None, target_accounts=[], snapshot_retention=5, icinga_host=None, s3=None):
+def worker(dbms, hostname=None, instance=None, snapshot=None, region=None, target_accounts=[], snapshot_retention=5, notifier=None, s3=None, batch_size=10000, task_concurrency=1, export_concurrency=1, export_parallelism=1, s3_endpoint_url=None, s3_part_size=16, s3_upload_concurrency=4, export_codec='gzip', export_compression_level=None, poller=None, use_standby=False, keep_workspace_on_failure=False, resume_workspace=False, instance_class=None, storage_type=None, iops=None, parameter_group=None, bulk_write_parameters=False, report=None, rulesets=[], maintenance='analyze'):
     logger = logging.getLogger()
     logger.info("Spawned new worker thread")
     workspace = None
+    exports = None
+    task_manager = None
 
     try:
         # We need a boto3 session per thread
         # https://boto3.readthedocs.io/en/latest/guide/resources.html#multithreading-multiprocessing
         session = boto3.session.Session(region_name=region)
+        if report is not None:
+            report.instrument_session(session)
         rds_client = session.client('rds')
 
         snapshot_finder = RdsSnapshotFinder(
@@ -336,39 +646,120 @@ def worker(dbms, hostname=None, instance=None, snapshot=None, region=None, targe
             snapshot_identifier=snapshot,
         )
 
+        standby_pool = None
+        if use_standby:
+            standby_pool = StandbyPool(session)
+
+        bulk_write_parameter_group = None
+        if bulk_write_parameters:
+            bulk_write_parameter_group = BulkWriteParameterGroup(session)
+
         workspace = ScrubWorkspaceInstance(
             snapshot_finder,
             session,
+            poller=poller,
+            standby_pool=standby_pool,
+            instance_class=instance_class,
+            storage_type=storage_type,
+            iops=iops,
+            parameter_group=parameter_group,
+            bulk_write_parameter_group=bulk_write_parameter_group,
+            report=report,
+            keep_on_failure=keep_workspace_on_failure,
+            resume=resume_workspace,
         )
 
+        codec = get_codec(export_codec, export_compression_level)
+
+        uploader = None
+        if s3 is not None:
+            uploader = S3Uploader(
+                session,
+                endpoint_url=s3_endpoint_url,
+                part_size=s3_part_size * 1024 * 1024,
+                concurrency=s3_upload_concurrency,
+            )
+
         if dbms == 'mysql':
-            task_manager = Mysql(workspace)
+            task_manager = Mysql(
+                workspace,
+                batch_size=batch_size,
+                export_parallelism=export_parallelism,
+                uploader=uploader,
+                codec=codec,
+                report=report,
+                rulesets=rulesets,
+                maintenance=maintenance,
+                max_connections=task_concurrency + 1,
+            )
         elif dbms == 'postgresql':
-            task_manager = Postgresql(workspace)
+            task_manager = Postgresql(
+                workspace,
+                batch_size=batch_size,
+                export_parallelism=export_parallelism,
+                uploader=uploader,
+                codec=codec,
+                report=report,
+                rulesets=rulesets,
+                maintenance=maintenance,
+                max_connections=task_concurrency + 1,
+            )
         else:
             raise Exception("DBMS not supported: %s" % dbms)
 
-        success = True
-        for task in task_manager.get_viable_tasks():
-            (success, err) = task_manager.run_task(task)
-            if not success:
-                logger.error(
-                    "Task %s failed. A final snapshot will not be generated, "
-                    "in case sensitive data remains.",
-                    task, err
-                )
-
-                if icinga_host is not None:
-                    submit_passive_icinga_check(task, 'CRITICAL', icinga_host, err)
-
-                break
-
-            if icinga_host is not None:
-                submit_passive_icinga_check(task, 'OK', icinga_host)
-
-            if s3 is not None:
-                task_manager.export_to_s3(task, s3)
+        if s3 is not None:
+            exports = ExportPipeline(task_manager, s3, export_concurrency)
 
+        # Each task runs on its own connection, taken from the task manager's
+        # pool, which has one more for table listings during exports. Tasks
+        # that haven't started yet are cancelled as soon as one fails, as no
+        # final snapshot will be taken anyway.
+        success = True
+        tasks = task_manager.get_viable_tasks()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=task_concurrency) as executor:
+            futures = {
+                executor.submit(task_manager.run_task, task): task
+                for task in tasks
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                task = futures[future]
+                if future.cancelled():
+                    logger.info("Task %s was cancelled", task)
+                    continue
+
+                (task_success, err) = future.result()
+                if not task_success:
+                    success = False
+                    logger.error(
+                        "Task %s failed: %s. A final snapshot will not be "
+                        "generated, in case sensitive data remains.",
+                        task, err
+                    )
+
+                    if notifier is not None:
+                        notifier.submit(task, 'CRITICAL', err)
+
+                    for f in futures:
+                        f.cancel()
+
+                    continue
+
+                if notifier is not None:
+                    notifier.submit(task, 'OK')
+
+                if exports is not None and success:
+                    exports.submit(task)
+
+        if exports is not None and exports.needs_instance():
+            # Exports only read from the workspace instance, so the final
+            # snapshot can be taken while they are still running. The
+            # instance itself has to stay up until they've finished.
+            if success:
+                workspace.create_final_snapshot()
+            exports.wait()
+
+        task_manager.close()
         workspace.cleanup(create_final_snapshot=success)
         if success:
             if target_accounts is not None and len(target_accounts) >= 1:
@@ -398,4 +789,8 @@ def worker(dbms, hostname=None, instance=None, snapshot=None, region=None, targe
                 "sensitive data remains. The error was: %s, traceback: %s", e,
                 traceback.format_tb(e.__traceback__)
             )
+            if exports is not None:
+                exports.cancel()
+            if task_manager is not None:
+                task_manager.close()
             workspace.cleanup(create_final_snapshot=False)
@@ -0,0 +1,71 @@
+import shlex
+
+
+class Codec:
+    def __init__(self, name, compress_command, decompress_command, suffix, default_level=None, max_level=None):
+        self.name = name
+        self.compress_command = compress_command
+        self.decompress_command = decompress_command
+        self.suffix = suffix
+        self.default_level = default_level
+        self.max_level = max_level
+        self.level = default_level
+
+    def with_level(self, level):
+        if level is None:
+            return self
+
+        if self.max_level is None:
+            raise Exception("Codec {0} doesn't support compression levels".format(self.name))
+
+        if level < 1 or level > self.max_level:
+            raise Exception("Compression level for {0} must be between 1 and {1}".format(
+                self.name, self.max_level
+            ))
+
+        codec = Codec(
+            self.name,
+            self.compress_command,
+            self.decompress_command,
+            self.suffix,
+            self.default_level,
+            self.max_level,
+        )
+        codec.level = level
+        return codec
+
+    def get_compress_pipe(self):
+        # Shell fragment to append to a dump command, e.g. ' | gzip -6'
+        if self.compress_command is None:
+            return ''
+
+        command = list(self.compress_command)
+        if self.level is not None:
+            command.append('-{0}'.format(self.level))
+
+        return ' | ' + ' '.join(list(map(shlex.quote, command)))
+
+    def get_decompress_pipe(self):
+        if self.decompress_command is None:
+            return ''
+
+        return ' | ' + ' '.join(list(map(shlex.quote, self.decompress_command)))
+
+    def get_file_suffix(self, base='.sql'):
+        return base + self.suffix
+
+
+CODECS = {
+    'gzip': Codec('gzip', ['gzip'], ['gunzip'], '.gz', 6, 9),
+    # pigz and zstd use all available cores by default
+    'pigz': Codec('pigz', ['pigz'], ['pigz', '-d'], '.gz', 6, 9),
+    'zstd': Codec('zstd', ['zstd', '-T0', '-q'], ['zstd', '-d', '-q'], '.zst', 3, 19),
+    'none': Codec('none', None, None, ''),
+}
+
+
+def get_codec(name, level=None):
+    if name not in CODECS:
+        raise Exception("Compression codec not supported: {0}".format(name))
+
+    return CODECS[name].with_level(level)
@@ -0,0 +1,154 @@
+import collections
+import contextlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    # Database connections to one workspace instance, kept open between uses
+    # and handed out again to whatever next needs the same database, so that
+    # discovery, table listing and tasks don't each pay for a new TCP, TLS
+    # and authentication handshake.
+    #
+    # connect(dbname) opens a new connection and is_usable(connection) says
+    # whether an idle one is still open. At most max_size connections are
+    # open at once (None for no limit); once there are that many, an idle
+    # connection to another database is closed to make room, and failing
+    # that acquire() waits for one to be released. close() closes every
+    # idle connection, and any released after it.
+    def __init__(self, connect, is_usable, max_size=None):
+        self.connect = connect
+        self.is_usable = is_usable
+        self.max_size = max_size
+
+        self.condition = threading.Condition()
+        self.idle = collections.OrderedDict()
+        self.open_count = 0
+        self.closed = False
+
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    @contextlib.contextmanager
+    def connection(self, dbname):
+        # The connection goes back to the pool if the block completes, and is
+        # closed if it raises, as it may be part way through a transaction or
+        # holding session state (e.g. temporary tables)
+        cnx = self.acquire(dbname)
+        try:
+            yield cnx
+        except BaseException:
+            self.release(dbname, cnx, discard=True)
+            raise
+        self.release(dbname, cnx)
+
+    def acquire(self, dbname):
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise Exception("Connection pool is closed")
+
+                cnx = self._take_idle(dbname)
+                if cnx is not None:
+                    self.connections_reused += 1
+                    return cnx
+
+                if self.max_size is None or self.open_count < self.max_size:
+                    break
+
+                if not self._close_oldest_idle():
+                    self.condition.wait()
+
+            self.open_count += 1
+
+        try:
+            cnx = self.connect(dbname)
+        except BaseException:
+            with self.condition:
+                self.open_count -= 1
+                self.condition.notify()
+            raise
+
+        with self.condition:
+            self.connections_opened += 1
+        return cnx
+
+    def release(self, dbname, cnx, discard=False):
+        if not discard:
+            try:
+                # Nothing left uncommitted is carried over to the next user
+                cnx.rollback()
+            except Exception as e:
+                logger.warning("Discarding connection to %s: %s", dbname, e)
+                discard = True
+
+        with self.condition:
+            if discard or self.closed:
+                self.open_count -= 1
+            else:
+                self.idle.setdefault(dbname, []).append(cnx)
+                self.idle.move_to_end(dbname)
+            self.condition.notify()
+
+        if discard or self.closed:
+            self._close(dbname, cnx)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle = [
+                (dbname, cnx)
+                for (dbname, connections) in self.idle.items()
+                for cnx in connections
+            ]
+            self.idle.clear()
+            self.open_count -= len(idle)
+            self.condition.notify_all()
+
+        for (dbname, cnx) in idle:
+            self._close(dbname, cnx)
+
+        logger.info(
+            "Closed connection pool: %d connections opened, %d reused",
+            self.connections_opened, self.connections_reused,
+        )
+
+    def _take_idle(self, dbname):
+        # Called with the lock held. Connections which have been closed
+        # underneath us (e.g. by a server side timeout) are dropped.
+        connections = self.idle.get(dbname, [])
+        while len(connections) > 0:
+            cnx = connections.pop()
+            if len(connections) == 0:
+                del self.idle[dbname]
+
+            if self.is_usable(cnx):
+                return cnx
+
+            logger.info("Dropping closed connection to %s", dbname)
+            self.open_count -= 1
+            self._close(dbname, cnx)
+
+        return None
+
+    def _close_oldest_idle(self):
+        # Called with the lock held
+        for (dbname, connections) in self.idle.items():
+            cnx = connections.pop(0)
+            if len(connections) == 0:
+                del self.idle[dbname]
+
+            self.open_count -= 1
+            self._close(dbname, cnx)
+            return True
+
+        return False
+
+    def _close(self, dbname, cnx):
+        logger.debug("Closing connection to %s", dbname)
+        try:
+            cnx.close()
+        except Exception as e:
+            logger.warning("Error closing connection to %s: %s", dbname, e)
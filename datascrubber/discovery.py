@@ -0,0 +1,66 @@
+import logging
+import threading
+import time
+
+import dns.resolver
+
+logger = logging.getLogger(__name__)
+
+
+class RdsEndpointIndex:
+    # Process-wide index of RDS instances by endpoint address, shared by all
+    # worker threads. It's built by the first thread which needs it (the
+    # others wait for that rather than enumerating instances themselves),
+    # and rebuilt once it's older than ttl seconds.
+    ttl = 300
+
+    lock = threading.Lock()
+    indexes = {}
+
+    @classmethod
+    def lookup(cls, rds_client, address):
+        region = rds_client.meta.region_name
+
+        with cls.lock:
+            (built_at, index) = cls.indexes.get(region, (0, None))
+            if index is None or time.time() - built_at > cls.ttl:
+                index = cls._build(rds_client)
+                cls.indexes[region] = (time.time(), index)
+
+        return index.get(address)
+
+    @classmethod
+    def _build(cls, rds_client):
+        logger.info("Building RDS endpoint index...")
+
+        index = {}
+        paginator = rds_client.get_paginator('describe_db_instances')
+        for page in paginator.paginate():
+            for instance in page['DBInstances']:
+                if 'Endpoint' in instance:
+                    index[instance['Endpoint']['Address']] = instance
+
+        logger.info("Indexed %d RDS instance endpoints", len(index))
+        return index
+
+
+class DnsCache:
+    # Caches CNAME resolutions of hostnames for the TTL of the DNS answer
+    lock = threading.Lock()
+    entries = {}
+
+    @classmethod
+    def get_canonical_name(cls, hostname):
+        with cls.lock:
+            (expires_at, cname) = cls.entries.get(hostname, (0, None))
+            if cname is not None and time.time() < expires_at:
+                return cname
+
+        resolver = dns.resolver.Resolver()
+        resolution = resolver.query(hostname)
+        cname = resolution.canonical_name
+
+        with cls.lock:
+            cls.entries[hostname] = (time.time() + resolution.rrset.ttl, cname)
+
+        return cname
@@ -0,0 +1,199 @@
+import concurrent.futures
+import json
+import logging
+import subprocess
+import tempfile
+import traceback
+
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+
+class ExportPipeline:
+    # Runs S3 exports of scrubbed databases in the background, so that the
+    # next scrub task (and the final snapshot) don't have to wait for them.
+    def __init__(self, task_manager, s3_url_prefix, concurrency=1):
+        self.task_manager = task_manager
+        self.s3_url_prefix = s3_url_prefix
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency
+        )
+        self.futures = {}
+
+    def submit(self, database):
+        logger.info("Queueing export of %s to %s", database, self.s3_url_prefix)
+        self.futures[database] = self.executor.submit(self._export, database)
+
+    def needs_instance(self):
+        # Every export reads from the live workspace instance, so it can't be
+        # deleted until they have all finished
+        return len(self.futures) > 0
+
+    def wait(self):
+        pending = [d for (d, f) in self.futures.items() if not f.done()]
+        if len(pending) > 0:
+            logger.info("Waiting for exports to finish: %s", pending)
+
+        self.executor.shutdown(wait=True)
+
+        failed = [
+            database for (database, future) in self.futures.items()
+            if future.cancelled() or not future.result()
+        ]
+        if len(failed) > 0:
+            logger.error("Exports failed: %s", failed)
+
+        return failed
+
+    def cancel(self):
+        for future in self.futures.values():
+            future.cancel()
+
+        return self.wait()
+
+    def _export(self, database):
+        with span(self.task_manager.report, 'export', database=database) as s:
+            try:
+                if self.task_manager.export_to_s3(database, self.s3_url_prefix):
+                    return True
+
+            except Exception as e:
+                logger.error(
+                    "Error exporting %s: %s, traceback: %s", database, e,
+                    traceback.format_tb(e.__traceback__)
+                )
+                s['error'] = str(e)
+
+            s['status'] = 'error'
+            return False
+
+
+def export_stream(dump_command, s3_url, description, uploader, env=None, report=None):
+    with span(report, 'export.upload', description=description) as s:
+        size = _export_stream(dump_command, s3_url, description, uploader, env)
+        if size is None:
+            s['status'] = 'error'
+            return False
+
+        s['bytes'] = size
+        return True
+
+
+def _export_stream(dump_command, s3_url, description, uploader, env):
+    # Returns the number of bytes uploaded, or None on failure.
+    #
+    # Streams the output of dump_command (a shell pipeline producing the
+    # compressed dump) into a multipart upload. pipefail means a failure at
+    # any stage of the pipeline fails the export, and the upload is aborted
+    # rather than leaving a truncated object behind.
+    logger.debug("shell: %s", dump_command)
+
+    stderr = tempfile.TemporaryFile()
+    dump = subprocess.Popen(
+        'set -o pipefail; {0}'.format(dump_command),
+        shell=True,
+        executable='/bin/bash',
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+        env=env,
+    )
+
+    upload = None
+    try:
+        upload = uploader.start(s3_url)
+        upload.upload_from(dump.stdout)
+
+        exitcode = dump.wait()
+        if exitcode != 0:
+            raise Exception("Dump command exited with status {0}".format(exitcode))
+
+        size = upload.complete()
+        logger.info(
+            "Finished copying %s to S3: %s", description,
+            {'command': dump_command,
+             'url': s3_url,
+             'bytes': size}
+        )
+        return size
+
+    except Exception as e:
+        if dump.poll() is None:
+            dump.kill()
+        dump.wait()
+
+        if upload is not None:
+            upload.abort()
+
+        stderr.seek(0)
+        logger.error(
+            "Error copying %s to S3: %s",
+            description,
+            {'command': dump_command,
+             'url': s3_url,
+             'exitcode': dump.returncode,
+             'error': str(e),
+             'output': stderr.read().decode('utf-8', 'replace')}
+        )
+        return None
+
+    finally:
+        dump.stdout.close()
+        stderr.close()
+
+
+def run_dump_command(shell_command, description, env=None):
+    logger.debug("shell: %s", shell_command)
+
+    try:
+        output = subprocess.check_output(
+            shell_command,
+            shell=True,
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+        logger.info(
+            "Finished dumping %s: %s", description,
+            {'command': shell_command,
+             'exitcode': 0,
+             'output': output.decode('utf-8')}
+        )
+        return True
+
+    except subprocess.CalledProcessError as e:
+        logger.error(
+            "Error dumping %s: %s",
+            description,
+            {'command': shell_command,
+             'exitcode': e.returncode,
+             'output': e.output.decode('utf-8')}
+        )
+        return False
+
+
+def get_manifest_url(export_url):
+    return '{0}/manifest.json'.format(export_url)
+
+
+def write_manifest(uploader, export_url, manifest):
+    manifest_url = get_manifest_url(export_url)
+    logger.info("Writing export manifest %s", manifest_url)
+
+    try:
+        uploader.put(
+            manifest_url,
+            json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'),
+        )
+        return True
+
+    except Exception as e:
+        logger.error("Error writing export manifest %s: %s", manifest_url, e)
+        return False
+
+
+def read_manifest(downloader, manifest_url):
+    return json.loads(downloader.get(manifest_url).decode('utf-8'))
+
+
+def get_part_url(manifest_url, part):
+    return '{0}/{1}'.format(manifest_url.rsplit('/', 1)[0], part['key'])
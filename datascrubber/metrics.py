@@ -0,0 +1,226 @@
+import logging
+import os
+import re
+import socket
+import tempfile
+import urllib.parse
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+
+class Metric:
+    def __init__(self, name, metric_type, help_text):
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        self.samples = {}
+
+    def add(self, value, **labels):
+        key = tuple(sorted((k, str(v)) for (k, v) in labels.items() if v is not None))
+        self.samples[key] = self.samples.get(key, 0) + value
+
+
+def build_metrics(report, poller=None):
+    # Summarises a RunReport (and the shared RDS status poller's counters) as
+    # a set of metrics, suitable for alerting on throughput as well as on
+    # failures. Spans with the same labels are added together.
+    metrics = {}
+
+    def metric(name, metric_type, help_text):
+        if name not in metrics:
+            metrics[name] = Metric(name, metric_type, help_text)
+        return metrics[name]
+
+    run_duration = report.to_dict()['duration']
+    metric(
+        'datascrubber_run_duration_seconds', 'gauge',
+        "Duration of the whole scrub run",
+    ).add(run_duration)
+    metric(
+        'datascrubber_last_run_timestamp_seconds', 'gauge',
+        "Time the last scrub run started",
+    ).add(report.started_at)
+
+    for s in report.get_spans():
+        if s['name'].startswith('workspace.'):
+            metric(
+                'datascrubber_workspace_phase_duration_seconds', 'gauge',
+                "Duration of each phase of the workspace instance lifecycle",
+            ).add(s['duration'], phase=s['name'][len('workspace.'):], instance=s['instance'])
+
+        elif s['name'] == 'task':
+            metric(
+                'datascrubber_task_duration_seconds', 'gauge',
+                "Duration of each scrub task",
+            ).add(s['duration'], task=s['task'])
+            metric(
+                'datascrubber_task_success', 'gauge',
+                "Whether each scrub task succeeded",
+            ).add(1 if s['status'] == 'ok' else 0, task=s['task'])
+
+        elif s['name'] == 'statement':
+            labels = {
+                'task': s['task'],
+                'statement': s['statement'],
+                'table': s['table'],
+            }
+            metric(
+                'datascrubber_statement_duration_seconds', 'gauge',
+                "Duration of each scrub SQL statement",
+            ).add(s['duration'], **labels)
+            metric(
+                'datascrubber_statement_rows', 'gauge',
+                "Rows affected by each scrub SQL statement",
+            ).add(s.get('rowcount', 0), **labels)
+
+        elif s['name'] == 'export':
+            metric(
+                'datascrubber_export_duration_seconds', 'gauge',
+                "Duration of each database export",
+            ).add(s['duration'], database=s['database'])
+            metric(
+                'datascrubber_export_success', 'gauge',
+                "Whether each database export succeeded",
+            ).add(1 if s['status'] == 'ok' else 0, database=s['database'])
+
+        elif s['name'] == 'export.upload':
+            metric(
+                'datascrubber_exported_bytes_total', 'counter',
+                "Bytes uploaded to S3 by exports",
+            ).add(s.get('bytes', 0))
+
+    for c in report.get_counters():
+        labels = dict(c)
+        name = labels.pop('name')
+        value = labels.pop('value')
+
+        if name == 'api_calls':
+            metric(
+                'datascrubber_aws_api_calls_total', 'counter',
+                "AWS API calls made by workers",
+            ).add(value, **labels)
+
+        elif name == 'api_retries':
+            metric(
+                'datascrubber_aws_api_retries_total', 'counter',
+                "AWS API calls retried by botocore",
+            ).add(value, **labels)
+
+        elif name == 'api_throttled':
+            metric(
+                'datascrubber_aws_api_throttled_total', 'counter',
+                "AWS API calls which failed with a throttling error",
+            ).add(value, **labels)
+
+        elif name == 'throttle_retries':
+            metric(
+                'datascrubber_throttle_retries_total', 'counter',
+                "Throttled status checks retried by the scrubber",
+            ).add(value, **labels)
+
+    if poller is not None:
+        metric(
+            'datascrubber_aws_api_calls_total', 'counter',
+            "AWS API calls made by workers",
+        ).add(poller.api_calls, service='rds', operation='poller')
+        metric(
+            'datascrubber_throttle_retries_total', 'counter',
+            "Throttled status checks retried by the scrubber",
+        ).add(poller.throttle_retries, source='poller')
+
+    return [metrics[name] for name in sorted(metrics.keys())]
+
+
+def format_prometheus(metrics):
+    # Prometheus text exposition format, as read by the node exporter's
+    # textfile collector and accepted by the pushgateway
+    lines = []
+    for m in metrics:
+        lines.append('# HELP {0} {1}'.format(m.name, m.help))
+        lines.append('# TYPE {0} {1}'.format(m.name, m.type))
+        for (labels, value) in sorted(m.samples.items()):
+            if len(labels) > 0:
+                lines.append('{0}{{{1}}} {2}'.format(
+                    m.name,
+                    ','.join(
+                        '{0}="{1}"'.format(k, escape_label_value(v))
+                        for (k, v) in labels
+                    ),
+                    repr(float(value)),
+                ))
+            else:
+                lines.append('{0} {1}'.format(m.name, repr(float(value))))
+
+    return '\n'.join(lines) + '\n'
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def write_prometheus_file(metrics, path):
+    # Written to a temporary file and renamed into place, so that a collector
+    # never reads a half-written file
+    logger.info("Writing metrics to %s", path)
+    (fd, temporary_path) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.datascrubber-metrics-',
+    )
+    with os.fdopen(fd, 'w') as f:
+        f.write(format_prometheus(metrics))
+    os.chmod(temporary_path, 0o644)
+    os.rename(temporary_path, path)
+
+
+def push_prometheus(metrics, gateway_url, job='datascrubber'):
+    # PUT replaces every metric previously pushed for the job, so series from
+    # statements or exports which didn't run this time don't linger
+    url = '{0}/metrics/job/{1}'.format(
+        gateway_url.rstrip('/'),
+        urllib.parse.quote(job, safe=''),
+    )
+    logger.info("Pushing metrics to %s", url)
+
+    request = urllib.request.Request(
+        url,
+        data=format_prometheus(metrics).encode('utf-8'),
+        method='PUT',
+        headers={'Content-Type': 'text/plain; version=0.0.4'},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+
+
+def send_statsd(metrics, address, prefix='datascrubber'):
+    # StatsD has no labels, so label values become part of the metric name,
+    # e.g. datascrubber.task_duration_seconds.whitehall. Durations are sent as
+    # timers in milliseconds, counters as counts and everything else as
+    # gauges.
+    (host, _, port) = address.partition(':')
+    port = int(port or 8125)
+    logger.info("Sending metrics to StatsD at %s:%d", host, port)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for m in metrics:
+            base = m.name[len('datascrubber_'):] if m.name.startswith('datascrubber_') else m.name
+            for (labels, value) in sorted(m.samples.items()):
+                name = '.'.join(
+                    [prefix, base] + [statsd_name_part(v) for (k, v) in labels]
+                )
+
+                if m.name.endswith('_seconds') and m.type == 'gauge' and 'timestamp' not in m.name:
+                    line = '{0}:{1}|ms'.format(name, int(value * 1000))
+                elif m.type == 'counter':
+                    line = '{0}:{1}|c'.format(name, int(value))
+                else:
+                    line = '{0}:{1}|g'.format(name, value)
+
+                sock.sendto(line.encode('utf-8'), (host, port))
+    finally:
+        sock.close()
+
+
+def statsd_name_part(value):
+    return re.sub('[^A-Za-z0-9_-]+', '_', value)
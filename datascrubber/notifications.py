@@ -0,0 +1,104 @@
+import logging
+import queue
+import socket
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+STATUS_CODES = {
+    'OK': 0,
+    'WARNING': 1,
+    'CRITICAL': 2,
+}
+
+
+class IcingaNotifier:
+    # Passive check results are queued by workers and sent by a single
+    # background thread, so a slow or unreachable Icinga host never holds up
+    # a scrub. Results queued close together (e.g. several tasks finishing
+    # at once) are sent with one send_nsca invocation, one result per line.
+    # close() sends anything still queued before returning.
+    def __init__(self, icinga_host, batch_delay=2, max_batch=50):
+        self.icinga_host = icinga_host
+        self.batch_delay = batch_delay
+        self.max_batch = max_batch
+
+        # Looked up once, rather than for every check result
+        self.source_address = socket.gethostbyname(socket.gethostname())
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self._run,
+            name='IcingaNotifier',
+            daemon=True,
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, task, status, info=None):
+        if info is None:
+            info = status
+
+        # Each result has to fit on one line of send_nsca's input
+        info = ' '.join(str(info).splitlines())
+
+        self.queue.put("{0}\t{1}\t{2}\t{3}\n".format(
+            self.source_address,
+            "GOV.UK data scrubber {0}".format(task),
+            STATUS_CODES.get(status.upper(), 0),
+            info,
+        ))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            message = self.queue.get()
+            if message is None:
+                break
+
+            batch = [message]
+            while len(batch) < self.max_batch:
+                try:
+                    message = self.queue.get(timeout=self.batch_delay)
+                except queue.Empty:
+                    break
+
+                if message is None:
+                    stopping = True
+                    break
+
+                batch.append(message)
+
+            self._send(batch)
+
+    def _send(self, batch):
+        send_nsca_command = ['send_nsca', '-H', self.icinga_host]
+        try:
+            send_nsca = subprocess.Popen(
+                send_nsca_command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            output = send_nsca.communicate(''.join(batch).encode('utf-8'))[0]
+
+            logger.info(
+                "Submitted %d check results to Icinga: %s",
+                len(batch),
+                {'command': send_nsca_command,
+                 'messages': batch,
+                 'exitcode': send_nsca.returncode,
+                 'output': output.decode('utf-8', 'replace')}
+            )
+
+        except Exception as e:
+            logger.error(
+                "Error submitting %d check results to Icinga: %s",
+                len(batch), e,
+            )
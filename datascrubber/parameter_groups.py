@@ -0,0 +1,75 @@
+import logging
+import re
+
+import botocore.exceptions
+
+logger = logging.getLogger(__name__)
+
+# The group is given when a workspace instance is restored, or attached to a
+# standby by modifying it, and the instance is rebooted if RDS says that's
+# needed to apply it. Binary logging doesn't need turning off for MySQL: RDS
+# only enables it when backups are, and workspace instances have a backup
+# retention of 0.
+BULK_WRITE_PARAMETERS = {
+    'mysql': {
+        'innodb_flush_log_at_trx_commit': '2',
+        'sync_binlog': '0',
+    },
+    'postgres': {
+        'synchronous_commit': 'off',
+        # kB: an eighth of the instance's memory (which is in bytes), up to
+        # 1GB, so that small instance classes aren't left short
+        'maintenance_work_mem': 'LEAST({DBInstanceClassMemory/8192},1048576)',
+        # Scrubs leave plenty of dead tuples behind, but nothing is gained by
+        # vacuuming them while the scrub is still running
+        'autovacuum': '0',
+    },
+}
+
+
+class BulkWriteParameterGroup:
+    # Manages a DB parameter group per engine family, tuned for the bulk
+    # writes of a scrub rather than for durability, since the workspace
+    # instance's data is disposable until the final snapshot
+    def __init__(self, boto3_session):
+        self.boto3_session = boto3_session
+        self.rds_client = self.boto3_session.client('rds')
+
+    def ensure(self, engine, engine_version):
+        if engine not in BULK_WRITE_PARAMETERS:
+            raise Exception("No bulk write parameters for engine {0}".format(engine))
+
+        family = self.rds_client.describe_db_engine_versions(
+            Engine=engine,
+            EngineVersion=engine_version,
+        )['DBEngineVersions'][0]['DBParameterGroupFamily']
+        name = 'datascrubber-bulk-{0}'.format(re.sub('[^a-z0-9]+', '-', family.lower()))
+
+        try:
+            self.rds_client.create_db_parameter_group(
+                DBParameterGroupName=name,
+                DBParameterGroupFamily=family,
+                Description="GOV.UK data scrubber workspace bulk write settings",
+                Tags=[{'Key': 'scrubber', 'Value': 'scrubber'}],
+            )
+            logger.info("Created parameter group %s", name)
+
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'DBParameterGroupAlreadyExists':
+                raise
+
+        parameters = BULK_WRITE_PARAMETERS[engine]
+        logger.info("Setting parameters in %s: %s", name, parameters)
+        self.rds_client.modify_db_parameter_group(
+            DBParameterGroupName=name,
+            Parameters=[
+                {
+                    'ParameterName': key,
+                    'ParameterValue': value,
+                    'ApplyMethod': 'immediate',
+                }
+                for (key, value) in sorted(parameters.items())
+            ],
+        )
+
+        return name
@@ -0,0 +1,156 @@
+import logging
+import random
+import threading
+import time
+
+import boto3
+
+from .waiters import is_throttling_error
+
+logger = logging.getLogger(__name__)
+
+
+class RdsStatusPoller:
+    # A single background thread which looks up every scrub workspace
+    # instance and final snapshot that workers are waiting on, with one
+    # (filtered) describe call per resource type per poll, so the number of
+    # RDS API calls depends on how long the run takes rather than on how many
+    # workers there are.
+    #
+    # Results are only handed out from polls which started after the time a
+    # worker asks about, so that e.g. a worker which has just requested a
+    # modification doesn't see the instance's state from before it.
+    def __init__(self, region=None, interval=15, max_interval=120):
+        self.region = region
+        self.interval = interval
+        self.max_interval = max_interval
+
+        self.lock = threading.Lock()
+        self.watched_instances = {}
+        self.watched_snapshots = {}
+        self.instances = {}
+        self.snapshots = {}
+        self.last_poll_started = 0
+
+        self.api_calls = 0
+        self.throttle_retries = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run,
+            name='RdsStatusPoller',
+            daemon=True,
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        logger.info(
+            "RDS status poller stopped after %d API calls (%d throttled)",
+            self.api_calls, self.throttle_retries,
+        )
+
+    def watch_instance(self, instance_identifier):
+        with self.lock:
+            self._watch(self.watched_instances, instance_identifier)
+
+    def unwatch_instance(self, instance_identifier):
+        with self.lock:
+            self._unwatch(self.watched_instances, instance_identifier)
+
+    def watch_snapshot(self, snapshot_identifier):
+        with self.lock:
+            self._watch(self.watched_snapshots, snapshot_identifier)
+
+    def unwatch_snapshot(self, snapshot_identifier):
+        with self.lock:
+            self._unwatch(self.watched_snapshots, snapshot_identifier)
+
+    def get_instance(self, instance_identifier, since):
+        # Returns None until a poll which started after `since` has found the
+        # instance
+        with self.lock:
+            if self.last_poll_started < since:
+                return None
+            return self.instances.get(instance_identifier)
+
+    def get_snapshot(self, snapshot_identifier, since):
+        with self.lock:
+            if self.last_poll_started < since:
+                return None
+            return self.snapshots.get(snapshot_identifier)
+
+    def _watch(self, watched, identifier):
+        watched[identifier] = watched.get(identifier, 0) + 1
+
+    def _unwatch(self, watched, identifier):
+        watched[identifier] -= 1
+        if watched[identifier] <= 0:
+            del watched[identifier]
+
+    def _run(self):
+        # The poller has its own thread, and so needs its own boto3 session
+        session = boto3.session.Session(region_name=self.region)
+        rds = session.client('rds')
+        delay = self.interval
+
+        while not self.stopped.is_set():
+            with self.lock:
+                instance_ids = sorted(self.watched_instances.keys())
+                snapshot_ids = sorted(self.watched_snapshots.keys())
+
+            if len(instance_ids) > 0 or len(snapshot_ids) > 0:
+                poll_started = time.time()
+                try:
+                    instances = self._describe_instances(rds, instance_ids)
+                    snapshots = self._describe_snapshots(rds, snapshot_ids)
+
+                    with self.lock:
+                        self.instances = instances
+                        self.snapshots = snapshots
+                        self.last_poll_started = poll_started
+
+                    delay = self.interval
+
+                except Exception as e:
+                    if is_throttling_error(e):
+                        self.throttle_retries += 1
+                        delay = min(self.max_interval, delay * 2)
+                        logger.warning("RDS status poll throttled, backing off to %d seconds", delay)
+                    else:
+                        logger.error("Error polling RDS status: %s", e)
+
+            self.stopped.wait(random.uniform(delay / 2, delay))
+
+    def _describe_instances(self, rds, instance_ids):
+        if len(instance_ids) == 0:
+            return {}
+
+        instances = {}
+        paginator = rds.get_paginator('describe_db_instances')
+        for page in paginator.paginate(Filters=[{'Name': 'db-instance-id', 'Values': instance_ids}]):
+            self.api_calls += 1
+            for instance in page['DBInstances']:
+                # Only ever report on instances created by the scrubber
+                tags = instance.get('TagList')
+                if tags is not None and {'Key': 'scrubber', 'Value': 'scrubber'} not in tags:
+                    continue
+                instances[instance['DBInstanceIdentifier']] = instance
+
+        return instances
+
+    def _describe_snapshots(self, rds, snapshot_ids):
+        if len(snapshot_ids) == 0:
+            return {}
+
+        snapshots = {}
+        paginator = rds.get_paginator('describe_db_snapshots')
+        for page in paginator.paginate(Filters=[{'Name': 'db-snapshot-id', 'Values': snapshot_ids}]):
+            self.api_calls += 1
+            for snapshot in page['DBSnapshots']:
+                snapshots[snapshot['DBSnapshotIdentifier']] = snapshot
+
+        return snapshots
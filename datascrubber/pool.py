@@ -0,0 +1,181 @@
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+
+from . import SOURCE_SNAPSHOT_TAG, RdsSnapshotFinder
+from .waiters import Waiter
+
+logger = logging.getLogger(__name__)
+
+POOL_TAG = 'scrubber-pool'
+SOURCE_INSTANCE_TAG = 'scrubber-source-instance'
+
+
+class StandbyPool:
+    # Standby instances are restored from the latest snapshot of a source
+    # instance ahead of the scrub window (datascrubber --prepare-standby), so
+    # that the scrub itself can start from an already restored instance. A
+    # standby is only ever used for a scrub of the exact snapshot it was
+    # restored from, and is consumed (renamed to the workspace instance and
+    # deleted at the end) by the scrub that uses it.
+    def __init__(self, boto3_session):
+        self.boto3_session = boto3_session
+        self.rds_client = self.boto3_session.client('rds')
+
+    def get_standby_identifier(self, source_snapshot):
+        return "scrubber-standby-{0}-{1}".format(
+            source_snapshot['Engine'],
+            hashlib.sha256(
+                source_snapshot['DBInstanceIdentifier'].encode()
+            ).hexdigest()[0:12]
+        )
+
+    def prepare(self, snapshot_finder):
+        source_snapshot = snapshot_finder.get_snapshot()
+        source_instance = snapshot_finder.get_source_instance()
+        standby_identifier = self.get_standby_identifier(source_snapshot)
+
+        existing = self.__describe_standby(standby_identifier)
+        if existing is not None:
+            if existing['tags'].get(SOURCE_SNAPSHOT_TAG) == source_snapshot['DBSnapshotIdentifier']:
+                logger.info(
+                    "Standby %s of snapshot %s already exists",
+                    standby_identifier,
+                    source_snapshot['DBSnapshotIdentifier'],
+                )
+                return standby_identifier
+
+            logger.info("Replacing stale standby %s", standby_identifier)
+            if existing['instance']['DBInstanceStatus'] != 'deleting':
+                self.__delete(standby_identifier)
+            Waiter(
+                "standby {0} to be deleted".format(standby_identifier),
+                timeout=60 * 60,
+            ).wait(lambda: self.__describe_standby(standby_identifier) is None)
+
+        logger.info(
+            "Restoring standby %s from snapshot %s",
+            standby_identifier,
+            source_snapshot['DBSnapshotIdentifier'],
+        )
+        self.rds_client.restore_db_instance_from_db_snapshot(
+            DBInstanceIdentifier=standby_identifier,
+            DBSnapshotIdentifier=source_snapshot['DBSnapshotIdentifier'],
+            DBSubnetGroupName=source_instance['DBSubnetGroup']['DBSubnetGroupName'],
+            Tags=[
+                {'Key': 'scrubber', 'Value': 'scrubber'},
+                {'Key': POOL_TAG, 'Value': 'standby'},
+                {'Key': SOURCE_INSTANCE_TAG, 'Value': source_snapshot['DBInstanceIdentifier']},
+                {'Key': SOURCE_SNAPSHOT_TAG, 'Value': source_snapshot['DBSnapshotIdentifier']},
+            ]
+        )
+
+        return standby_identifier
+
+    def claim(self, source_snapshot):
+        # Returns the identifier of an available standby restored from
+        # source_snapshot, after removing it from the pool, or None
+        standby_identifier = self.get_standby_identifier(source_snapshot)
+        standby = self.__describe_standby(standby_identifier)
+
+        if standby is None:
+            logger.info("No standby %s found", standby_identifier)
+            return None
+
+        if standby['tags'].get(SOURCE_SNAPSHOT_TAG) != source_snapshot['DBSnapshotIdentifier']:
+            logger.info(
+                "Standby %s was restored from %s, not %s; not using it",
+                standby_identifier,
+                standby['tags'].get(SOURCE_SNAPSHOT_TAG),
+                source_snapshot['DBSnapshotIdentifier'],
+            )
+            return None
+
+        if standby['instance']['DBInstanceStatus'] != 'available':
+            logger.info(
+                "Standby %s is not available (status: '%s'); not using it",
+                standby_identifier,
+                standby['instance']['DBInstanceStatus'],
+            )
+            return None
+
+        logger.info("Claiming standby %s", standby_identifier)
+        self.rds_client.remove_tags_from_resource(
+            ResourceName=standby['instance']['DBInstanceArn'],
+            TagKeys=[POOL_TAG],
+        )
+
+        return standby_identifier
+
+    def prune(self, max_age_hours):
+        # Deletes standbys older than max_age_hours, or restored from anything
+        # other than the latest snapshot of their source instance
+        now = datetime.now(timezone.utc)
+        paginator = self.rds_client.get_paginator('describe_db_instances')
+        for page in paginator.paginate():
+            for instance in page['DBInstances']:
+                if not instance['DBInstanceIdentifier'].startswith('scrubber-standby-'):
+                    continue
+
+                if instance['DBInstanceStatus'] == 'deleting':
+                    continue
+
+                tags = self.__get_tags(instance)
+                if tags.get(POOL_TAG) != 'standby':
+                    continue
+
+                created = instance.get('InstanceCreateTime')
+                if created is not None and now - created > timedelta(hours=max_age_hours):
+                    logger.info(
+                        "Standby %s is older than %d hours",
+                        instance['DBInstanceIdentifier'], max_age_hours,
+                    )
+                    self.__delete(instance['DBInstanceIdentifier'])
+                    continue
+
+                try:
+                    latest = RdsSnapshotFinder(
+                        self.boto3_session,
+                        source_instance_identifier=tags.get(SOURCE_INSTANCE_TAG),
+                    ).get_snapshot_identifier()
+
+                except Exception as e:
+                    logger.error(
+                        "Couldn't find the latest snapshot of %s for standby %s: %s",
+                        tags.get(SOURCE_INSTANCE_TAG),
+                        instance['DBInstanceIdentifier'],
+                        e,
+                    )
+                    continue
+
+                if tags.get(SOURCE_SNAPSHOT_TAG) != latest:
+                    logger.info(
+                        "Standby %s was restored from %s, but the latest snapshot is %s",
+                        instance['DBInstanceIdentifier'],
+                        tags.get(SOURCE_SNAPSHOT_TAG),
+                        latest,
+                    )
+                    self.__delete(instance['DBInstanceIdentifier'])
+
+    def __describe_standby(self, standby_identifier):
+        response = self.rds_client.describe_db_instances(
+            Filters=[{'Name': 'db-instance-id', 'Values': [standby_identifier]}]
+        )
+        if len(response['DBInstances']) == 0:
+            return None
+
+        instance = response['DBInstances'][0]
+        return {'instance': instance, 'tags': self.__get_tags(instance)}
+
+    def __get_tags(self, instance):
+        response = self.rds_client.list_tags_for_resource(
+            ResourceName=instance['DBInstanceArn']
+        )
+        return {t['Key']: t['Value'] for t in response['TagList']}
+
+    def __delete(self, standby_identifier):
+        logger.info("Deleting standby %s", standby_identifier)
+        self.rds_client.delete_db_instance(
+            DBInstanceIdentifier=standby_identifier,
+            SkipFinalSnapshot=True,
+        )
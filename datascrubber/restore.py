@@ -0,0 +1,232 @@
+import argparse
+import concurrent.futures
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import boto3
+
+from . import compression, exports
+from .s3 import S3Downloader
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(
+        format='%(asctime)s | %(levelname)s | %(threadName)s | %(name)s %(funcName)s | %(message)s',
+        level=logging.INFO,
+    )
+
+    session = boto3.session.Session(region_name=args.region)
+    downloader = S3Downloader(session, endpoint_url=args.s3_endpoint_url)
+
+    manifest = exports.read_manifest(downloader, args.manifest)
+    logger.info(
+        "Restoring %s export of %s (%d parts) into %s",
+        manifest['format'], manifest['database'], len(manifest['parts']),
+        args.database,
+    )
+
+    if manifest['format'] == 'mysqldump-tables':
+        success = restore_mysql(downloader, args.manifest, manifest, args)
+    elif manifest['format'] == 'pg_dump-directory':
+        success = restore_postgresql(downloader, args.manifest, manifest, args)
+    else:
+        raise Exception("Export format not supported: %s" % manifest['format'])
+
+    if not success:
+        logger.error("Restore of %s failed", args.manifest)
+        return 1
+
+    logger.info("Restore of %s completed", args.manifest)
+    return 0
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Restore a parallel GOV.UK data scrubber export from S3. "
+                    "Passwords are read from MYSQL_PWD or PGPASSWORD."
+    )
+
+    parser.add_argument(
+        'manifest',
+        type=str,
+        help="S3 URL of the export manifest (e.g. s3://bucket/keyprefix/2018-01-01T00:00:00-whitehall_production/manifest.json)"
+    )
+
+    parser.add_argument(
+        '--host',
+        required=True,
+        type=str,
+        help="Hostname of the database server to restore into",
+    )
+
+    parser.add_argument(
+        '--user',
+        required=True,
+        type=str,
+        help="Database user to restore as",
+    )
+
+    parser.add_argument(
+        '--database',
+        required=True,
+        type=str,
+        help="Existing database to restore into",
+    )
+
+    parser.add_argument(
+        '--parallelism',
+        required=False,
+        type=int,
+        default=4,
+        help="Number of parts to restore at once (default: 4)",
+    )
+
+    parser.add_argument(
+        '--region',
+        required=False,
+        type=str,
+        help="AWS region of the S3 bucket",
+    )
+
+    parser.add_argument(
+        '--s3-endpoint-url',
+        required=False,
+        type=str,
+        help="Alternative S3 endpoint URL, as given to datascrubber when "
+             "exporting (default: the AWS endpoint for the region)",
+    )
+
+    return parser.parse_args()
+
+
+def restore_mysql(downloader, manifest_url, manifest, args):
+    mysql_command = ' '.join(list(map(shlex.quote, [
+        'mysql',
+        '--host={0}'.format(args.host),
+        '--user={0}'.format(args.user),
+        args.database,
+    ])))
+
+    codec = compression.get_codec(manifest['compression'])
+
+    def restore_part(part):
+        return run_restore_command(
+            'cat{0} | {1}'.format(codec.get_decompress_pipe(), mysql_command),
+            part['table'],
+            downloader=downloader,
+            s3_url=exports.get_part_url(manifest_url, part),
+        )
+
+    # Views depend on the tables, so are restored once those are all in place
+    tables = [p for p in manifest['parts'] if p['type'] == 'table']
+    views = [p for p in manifest['parts'] if p['type'] == 'view']
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallelism) as executor:
+        results = list(executor.map(restore_part, tables))
+
+    if not all(results):
+        return False
+
+    return all([restore_part(v) for v in views])
+
+
+def restore_postgresql(downloader, manifest_url, manifest, args):
+    restore_dir = tempfile.mkdtemp(prefix='datascrubber-restore-')
+
+    def download_part(part):
+        s3_url = exports.get_part_url(manifest_url, part)
+        try:
+            downloader.download_file(s3_url, os.path.join(restore_dir, part['key']))
+            return True
+
+        except Exception as e:
+            logger.error("Error downloading %s: %s", s3_url, e)
+            return False
+
+    try:
+        logger.info("Downloading %d parts of %s", len(manifest['parts']), manifest['database'])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallelism) as executor:
+            results = list(executor.map(download_part, manifest['parts']))
+
+        if not all(results):
+            return False
+
+        shell_command = ' '.join(list(map(shlex.quote, [
+            'pg_restore',
+            '--host={0}'.format(args.host),
+            '--username={0}'.format(args.user),
+            '--dbname={0}'.format(args.database),
+            '--jobs={0}'.format(args.parallelism),
+            '--no-owner',
+            '--no-acl',
+            restore_dir,
+        ])))
+        return run_restore_command(shell_command, manifest['database'])
+
+    finally:
+        shutil.rmtree(restore_dir, ignore_errors=True)
+
+
+def run_restore_command(shell_command, description, downloader=None, s3_url=None):
+    # Runs shell_command, feeding it the S3 object at s3_url if given. pipefail
+    # means a failure at any stage of the pipeline (e.g. decompression) fails
+    # the restore, not just a failure of the last command, and a failed
+    # download kills the command rather than letting it see a short input
+    # as complete.
+    logger.info("Restoring %s", description)
+    logger.debug("shell: %s", shell_command)
+
+    output = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        ['bash', '-o', 'pipefail', '-c', shell_command],
+        stdin=subprocess.PIPE if s3_url is not None else subprocess.DEVNULL,
+        stdout=output,
+        stderr=subprocess.STDOUT,
+    )
+
+    error = None
+    try:
+        if s3_url is not None:
+            try:
+                downloader.download_to(s3_url, process.stdin)
+
+            except Exception as e:
+                error = e
+                process.kill()
+
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        exitcode = process.wait()
+        if error is None and exitcode == 0:
+            return True
+
+        output.seek(0)
+        logger.error(
+            "Error restoring %s: %s",
+            description,
+            {'command': shell_command,
+             'url': s3_url,
+             'exitcode': exitcode,
+             'error': str(error) if error is not None else None,
+             'output': output.read().decode('utf-8', 'replace')}
+        )
+        return False
+
+    finally:
+        output.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
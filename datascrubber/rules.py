@@ -0,0 +1,344 @@
+import collections
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+RULESETS_DIR = os.path.join(os.path.dirname(__file__), 'rulesets')
+
+LOREM_IPSUM = {
+    'line': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit',
+    'slug': 'lorem-ipsum-dolor-sit-amet-elit',
+    'paragraphs': (
+        'Lorem ipsum dolor sit amet, consectetur adipiscing elit. Vestibulum '
+        'eget metus leo. Integer ac gravida magna. Vestibulum adipiscing '
+        'pretium vehicula. Praesent ultrices eros a mi elementum id ultrices '
+        'ligula ornare. Vivamus mollis, odio id luctus scelerisque, dui nunc '
+        'semper felis, vitae fermentum tortor ante eget erat. Maecenas '
+        'eleifend elit nec libero porttitor sodales. Quisque vitae augue ut '
+        'justo vulputate tincidunt at pellentesque tortor.\n\n'
+
+        'In bibendum urna sed sem egestas aliquam tempor leo dictum. Lorem '
+        'ipsum dolor sit amet, consectetur adipiscing elit. Donec rhoncus '
+        'adipiscing ultrices. Morbi gravida, lacus vitae adipiscing tincidunt, '
+        'quam tellus consectetur leo, et posuere tortor metus a nulla. Aliquam '
+        'erat volutpat. In et ante diam. Nulla laoreet ante ut sem egestas sed '
+        'placerat elit viverra. Duis tempor congue est, rutrum mattis neque '
+        'aliquam non. Nunc a massa quis nisl blandit elementum a in elit. '
+        'Pellentesque sollicitudin, magna nec viverra consectetur, risus ante '
+        'bibendum diam, vel volutpat risus neque sed risus. Nullam leo enim, '
+        'faucibus eu consequat facilisis, auctor eget velit. In ultricies '
+        'lectus in velit commodo tempus. Fusce luctus condimentum mi, eleifend '
+        'auctor libero volutpat sed. Quisque tempor viverra mauris, non '
+        'blandit ipsum vulputate viverra. In sed enim nibh, eu auctor urna. '
+        'Suspendisse potenti.\n\n'
+
+        'Proin elementum varius quam, eu fermentum nulla vestibulum sed. '
+        'Integer urna turpis, malesuada sed vehicula vel, vestibulum gravida '
+        'purus. Vivamus adipiscing ullamcorper bibendum. Nunc pretium '
+        'condimentum nisi, sit amet blandit augue accumsan in. Ut in erat '
+        'urna, eget elementum dui. Nam arcu enim, iaculis at interdum at, '
+        'viverra non massa. Sed nisl massa, pulvinar in blandit nec, '
+        'pretium eleifend quam. Nullam a nisi dolor, ornare sagittis felis. '
+        'Aliquam laoreet sodales leo sit amet rutrum.\n\n'
+
+        'Fusce dui ante, ornare a interdum vel, posuere non ipsum. Morbi '
+        'placerat est ac quam ultrices eget feugiat tortor rhoncus. Duis '
+        'tempor placerat leo sit amet volutpat. Curabitur dignissim pulvinar '
+        'sem, non auctor dolor mattis sed. In volutpat volutpat massa quis '
+        'convallis. In in cursus tortor. Pellentesque massa sem, rhoncus a '
+        'iaculis ac, tincidunt sit amet nibh.\n\n'
+
+        'Etiam eu orci sed massa porttitor volutpat. Maecenas euismod lobortis '
+        'risus sed vehicula. Proin luctus fringilla odio, in ullamcorper eros '
+        'suscipit ac. Ut consequat vehicula urna nec posuere. Donec vel '
+        'dapibus massa. Pellentesque consectetur odio a mauris semper '
+        'bibendum. In vitae sem sollicitudin est egestas gravida id non urna.'
+    ),
+}
+
+IDENTIFIER_QUOTES = {
+    'mysql': '`',
+    'postgres': '"',
+}
+
+
+def quote_identifier(engine, identifier):
+    quote = IDENTIFIER_QUOTES[engine]
+    return quote + identifier.replace(quote, quote + quote) + quote
+
+
+# Each strategy returns a SQL expression for the new value of a column, and
+# the parameters it uses
+def strategy_nullify(engine, column, key, rule):
+    return ('NULL', ())
+
+
+def strategy_blank(engine, column, key, rule):
+    return ("''", ())
+
+
+def strategy_value(engine, column, key, rule):
+    return ('%s', (rule['value'],))
+
+
+def strategy_lorem(engine, column, key, rule):
+    return ('%s', (LOREM_IPSUM[rule.get('text', 'line')],))
+
+
+def strategy_hash(engine, column, key, rule):
+    # NULLs stay NULL, since concatenating anything with NULL is NULL
+    if engine == 'mysql':
+        return ('MD5(CONCAT(%s, {0}))'.format(column), (rule.get('salt', ''),))
+
+    return ('md5(%s || {0})'.format(column), (rule.get('salt', ''),))
+
+
+def strategy_sequence(engine, column, key, rule):
+    return (
+        'CONCAT(%s, {0}, %s)'.format(key),
+        (rule.get('prefix', ''), rule.get('suffix', '')),
+    )
+
+
+def strategy_sequence_email(engine, column, key, rule):
+    return (
+        'CONCAT(%s, {0}, %s)'.format(key),
+        (rule.get('prefix', 'anonymous-'), '@' + rule.get('domain', 'example.com')),
+    )
+
+
+STRATEGIES = {
+    'nullify': strategy_nullify,
+    'blank': strategy_blank,
+    'value': strategy_value,
+    'lorem': strategy_lorem,
+    'hash': strategy_hash,
+    'sequence': strategy_sequence,
+    'sequence-email': strategy_sequence_email,
+}
+
+
+class Ruleset:
+    # A declarative scrub task: a list of rules, each rewriting one column of
+    # one table with a strategy, optionally only in rows matching a SQL
+    # condition ("where"). Rules for the same table are compiled into as few
+    # batched UPDATEs as possible (usually one), so each table is scanned
+    # once for all of them.
+    def __init__(self, name, engine, rules, key='id', indexes=[], sets=[]):
+        if engine not in IDENTIFIER_QUOTES:
+            raise Exception("Unsupported engine {0} in ruleset {1}".format(engine, name))
+
+        for rule in rules:
+            if rule.get('strategy') not in STRATEGIES:
+                raise Exception("Unknown strategy {0} for {1}.{2} in ruleset {3}".format(
+                    rule.get('strategy'), rule.get('table'), rule.get('column'), name,
+                ))
+
+            # Conditions are passed to the database driver along with their
+            # params, so a literal % has to be written as %%
+            placeholders = re.findall('%.?', re.sub('%%', '', rule.get('where') or ''))
+            if any(p != '%s' for p in placeholders) or len(placeholders) != len(rule.get('params', [])):
+                raise Exception(
+                    "Condition for {0}.{1} in ruleset {2} needs a %s for each of its "
+                    "{3} params, and %% for a literal %: {4}".format(
+                        rule.get('table'), rule.get('column'), name,
+                        len(rule.get('params', [])), rule.get('where'),
+                    )
+                )
+
+        self.name = name
+        self.engine = engine
+        self.rules = rules
+        self.key = key
+        # Indexes the rules' conditions need, created for the duration of
+        # the task if the database doesn't already have them
+        self.indexes = indexes
+        # Sets of rows shared by several rules' conditions, which are
+        # materialised once into temporary tables. Conditions (and later
+        # sets) refer to them as {name}.
+        self.sets = sets
+
+    def compile(self):
+        # Returns a list of (sql, params, table) tuples, in the order each
+        # table first appears in the rules
+        tables = collections.OrderedDict()
+        for rule in self.rules:
+            tables.setdefault(rule['table'], []).append(rule)
+
+        statements = []
+        for (table, rules) in tables.items():
+            for groups in self._plan_passes(rules):
+                statements.append(self._compile_update(table, groups))
+
+        return statements
+
+    def _plan_passes(self, rules):
+        # Rules on one table are grouped by their condition (and its params),
+        # and the groups
+        # combined into as few passes over the table as possible, each a
+        # single UPDATE in which rules with a condition only change the rows
+        # matching it. A group goes into a later pass if it rewrites a column
+        # which is already rewritten in the current one, or if its condition
+        # refers to a column rewritten in the current pass (or vice versa),
+        # since the outcome would then depend on the order MySQL applies the
+        # assignments in (left to right, each seeing the ones before it).
+        groups = collections.OrderedDict()
+        for rule in rules:
+            groups.setdefault((rule.get('where'), tuple(rule.get('params', []))), []).append(rule)
+
+        passes = []
+        sealed = False
+        for ((where, where_params), group_rules) in groups.items():
+            columns = set(r['column'] for r in group_rules)
+            # A condition on a column its own rules rewrite can't be shared
+            # with other groups, as it'd be evaluated part way through
+            # rewriting the row
+            self_referencing = refers_to_any(where, columns)
+
+            current = passes[-1] if len(passes) > 0 else None
+            if current is not None:
+                current_columns = set(
+                    r['column'] for (w, rs) in current for r in rs
+                )
+                current_conditions = [w for (w, rs) in current if w]
+
+                if (
+                    sealed or
+                    self_referencing or
+                    len(columns & current_columns) > 0 or
+                    refers_to_any(where, current_columns) or
+                    any(refers_to_any(w, columns) for w in current_conditions)
+                ):
+                    current = None
+
+            if current is None:
+                current = []
+                passes.append(current)
+
+            current.append((where, group_rules))
+            sealed = self_referencing
+
+        return passes
+
+    def _compile_update(self, table, groups):
+        quoted_table = quote_identifier(self.engine, table)
+        key = '{0}.{1}'.format(quoted_table, quote_identifier(self.engine, self.key))
+        conditional = len(groups) > 1
+
+        assignments = []
+        params = ()
+        for (where, rules) in groups:
+            # Every rule in a group has the same condition and params
+            where_params = tuple(rules[0].get('params', []))
+            for rule in rules:
+                column = '{0}.{1}'.format(
+                    quoted_table, quote_identifier(self.engine, rule['column'])
+                )
+                (expression, expression_params) = STRATEGIES[rule['strategy']](
+                    self.engine, column, key, rule
+                )
+                if conditional and where:
+                    expression = 'CASE WHEN ({0}) THEN {1} ELSE {2} END'.format(
+                        where, expression, column
+                    )
+                    expression_params = where_params + expression_params
+
+                assignments.append('{0} = {1}'.format(
+                    quote_identifier(self.engine, rule['column']), expression
+                ))
+                params += expression_params
+
+        conditions = [where for (where, rules) in groups]
+        if None in conditions or '' in conditions:
+            where_clause = '{batch}'
+        else:
+            where_clause = '({0}) AND {{batch}}'.format(
+                ' OR '.join('({0})'.format(w) for w in conditions)
+                if conditional else conditions[0]
+            )
+            for (where, rules) in groups:
+                params += tuple(rules[0].get('params', []))
+
+        sql = 'UPDATE {0} SET {1} WHERE {2}'.format(
+            quoted_table, ', '.join(assignments), where_clause,
+        )
+        return (sql, params, table)
+
+    def scrub(self, runner):
+        for index in self.indexes:
+            runner.create_temporary_index(index['table'], index['columns'])
+
+        set_tables = {}
+        for s in self.sets:
+            set_tables[s['name']] = runner.materialise(
+                s['name'],
+                substitute_sets(s['sql'], set_tables),
+                columns=s.get('columns', []),
+            )
+
+        for (sql, params, table) in self.compile():
+            sql = substitute_sets(sql, set_tables)
+            logger.info("Scrubbing %s (%s): %s", table, self.name, sql)
+            rowcount = runner.execute_in_batches(
+                sql, params=params, table=table, key=self.key,
+                key_expression='{0}.{1}'.format(
+                    quote_identifier(self.engine, table),
+                    quote_identifier(self.engine, self.key),
+                ),
+            )
+            logger.info('Rows affected: %d', rowcount)
+
+
+def substitute_sets(sql, set_tables):
+    for (name, table) in set_tables.items():
+        sql = sql.replace('{' + name + '}', table)
+    return sql
+
+
+def refers_to_any(condition, columns):
+    if not condition:
+        return False
+
+    return any(
+        re.search(r'\b{0}\b'.format(re.escape(c)), condition) for c in columns
+    )
+
+
+def load_ruleset(path):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("PyYAML is needed to load YAML ruleset {0}".format(path))
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+
+    name = spec.get('task', os.path.splitext(os.path.basename(path))[0])
+    return Ruleset(
+        name, spec['engine'], spec['rules'],
+        key=spec.get('key', 'id'),
+        indexes=spec.get('indexes', []),
+        sets=spec.get('sets', []),
+    )
+
+
+def get_rule_tasks(engine, paths=[]):
+    # Rulesets shipped with the scrubber, plus any given paths, keyed by task
+    # name. Later paths override earlier ones.
+    packaged = [
+        os.path.join(RULESETS_DIR, f) for f in sorted(os.listdir(RULESETS_DIR))
+        if f.endswith(('.json', '.yaml', '.yml'))
+    ]
+
+    tasks = {}
+    for path in packaged + list(paths):
+        ruleset = load_ruleset(path)
+        if ruleset.engine == engine:
+            tasks[ruleset.name] = ruleset.scrub
+
+    return tasks
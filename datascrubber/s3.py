@@ -0,0 +1,174 @@
+import concurrent.futures
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# S3 rejects multipart uploads with parts (other than the last) under 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def parse_s3_url(s3_url):
+    if not s3_url.startswith('s3://'):
+        raise Exception("Not an S3 URL: {0}".format(s3_url))
+
+    (bucket, _, key) = s3_url[len('s3://'):].partition('/')
+    return (bucket, key)
+
+
+class S3Uploader:
+    def __init__(self, boto3_session, endpoint_url=None, part_size=16 * 1024 * 1024, concurrency=4):
+        # boto3 sessions aren't thread safe but clients are, so the client is
+        # created here from the worker thread's session and then shared by
+        # the export threads
+        self.client = boto3_session.client('s3', endpoint_url=endpoint_url)
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.concurrency = concurrency
+
+    def start(self, s3_url):
+        return MultipartUpload(self, s3_url)
+
+    def put(self, s3_url, body):
+        (bucket, key) = parse_s3_url(s3_url)
+        self.client.put_object(Bucket=bucket, Key=key, Body=body)
+
+    def upload_file(self, path, s3_url):
+        upload = self.start(s3_url)
+        try:
+            with open(path, 'rb') as f:
+                upload.upload_from(f)
+            return upload.complete()
+
+        except Exception:
+            upload.abort()
+            raise
+
+
+class S3Downloader:
+    # Reads exports back from S3, through the same endpoint as S3Uploader
+    def __init__(self, boto3_session, endpoint_url=None, chunk_size=1024 * 1024):
+        self.client = boto3_session.client('s3', endpoint_url=endpoint_url)
+        self.chunk_size = chunk_size
+
+    def get(self, s3_url):
+        (bucket, key) = parse_s3_url(s3_url)
+        return self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    def download_to(self, s3_url, stream):
+        # Copies the object into a writable binary stream, a chunk at a
+        # time, and returns the number of bytes copied
+        (bucket, key) = parse_s3_url(s3_url)
+        body = self.client.get_object(Bucket=bucket, Key=key)['Body']
+        size = 0
+        try:
+            for chunk in body.iter_chunks(self.chunk_size):
+                stream.write(chunk)
+                size += len(chunk)
+        finally:
+            body.close()
+
+        return size
+
+    def download_file(self, s3_url, path):
+        with open(path, 'wb') as f:
+            return self.download_to(s3_url, f)
+
+
+class MultipartUpload:
+    def __init__(self, uploader, s3_url):
+        self.client = uploader.client
+        self.s3_url = s3_url
+        self.part_size = uploader.part_size
+        (self.bucket, self.key) = parse_s3_url(s3_url)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=uploader.concurrency
+        )
+        # Bounds the number of parts read from the stream but not yet
+        # uploaded, and so the memory used by the upload
+        self.slots = threading.BoundedSemaphore(uploader.concurrency)
+        self.futures = []
+        self.bytes_read = 0
+
+        response = self.client.create_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+        )
+        self.upload_id = response['UploadId']
+        logger.debug("Started multipart upload %s to %s", self.upload_id, s3_url)
+
+    def upload_from(self, stream):
+        while True:
+            data = self._read_part(stream)
+            if len(data) == 0:
+                break
+
+            self._submit_part(data)
+
+        # A multipart upload needs at least one part, even an empty one
+        if len(self.futures) == 0:
+            self._submit_part(b'')
+
+    def complete(self):
+        parts = [f.result() for f in self.futures]
+        self.executor.shutdown(wait=True)
+
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts},
+        )
+        logger.debug(
+            "Completed multipart upload to %s: %d parts, %d bytes",
+            self.s3_url, len(parts), self.bytes_read,
+        )
+
+        return self.bytes_read
+
+    def abort(self):
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+        logger.info("Aborting multipart upload to %s", self.s3_url)
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+        )
+
+    def _read_part(self, stream):
+        data = bytearray()
+        while len(data) < self.part_size:
+            chunk = stream.read(self.part_size - len(data))
+            if not chunk:
+                break
+            data.extend(chunk)
+
+        self.bytes_read += len(data)
+        return bytes(data)
+
+    def _submit_part(self, data):
+        # Stop reading as soon as a part has failed, rather than carrying on
+        # through the rest of the dump
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+        self.slots.acquire()
+        future = self.executor.submit(
+            self._upload_part, len(self.futures) + 1, data
+        )
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+
+    def _upload_part(self, part_number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
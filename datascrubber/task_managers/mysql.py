@@ -1,29 +1,53 @@
+import concurrent.futures
 import logging
 import mysql.connector
 import re
-import subprocess
 import shlex
 import time
 
+import datascrubber.batching
+import datascrubber.compression
+import datascrubber.connections
+import datascrubber.exports
+import datascrubber.rules
 import datascrubber.tasks
+import datascrubber.timing
 
 logger = logging.getLogger(__name__)
 
 
 class Mysql:
-    def __init__(self, workspace, db_suffix='_production', icinga_host=None):
-        self.scrub_functions = {
-            'whitehall': datascrubber.tasks.scrub_whitehall,
-        }
+    def __init__(self, workspace, db_suffix='_production', icinga_host=None, batch_size=10000, export_parallelism=1, uploader=None, codec=None, report=None, rulesets=[], maintenance='analyze', max_connections=None):
+        self.scrub_functions = {}
+        self.scrub_functions.update(
+            datascrubber.rules.get_rule_tasks('mysql', rulesets)
+        )
         self.db_realnames = {}
 
         self.workspace = workspace
         self.db_suffix = db_suffix
         self.viable_tasks = None
         self.icinga_host = icinga_host
+        self.batch_size = batch_size
+        self.export_parallelism = export_parallelism
+        self.uploader = uploader
+        self.report = report
+        self.maintenance = maintenance
+        self.codec = codec
+        if self.codec is None:
+            self.codec = datascrubber.compression.get_codec('gzip')
+
+        self.connections = datascrubber.connections.ConnectionPool(
+            self._get_connection,
+            lambda cnx: cnx.is_connected(),
+            max_size=max_connections,
+        )
 
         self._discover_available_dbs()
 
+    def close(self):
+        self.connections.close()
+
     def _get_connection(self, dbname):
         instance = self.workspace.get_instance()
 
@@ -48,21 +72,22 @@ class Mysql:
     def _discover_available_dbs(self):
         logger.info("Looking for available database in MySQL")
 
-        cnx = self._get_connection('information_schema')
-        cursor = cnx.cursor()
-        cursor.execute(
-            "SELECT DISTINCT(table_schema) "
-            "FROM TABLES "
-            "WHERE table_schema NOT IN ("
-            "    'information_schema',"
-            "    'innodb', "
-            "    'mysql', "
-            "    'performance_schema', "
-            "    'sys', "
-            "    'tmp'"
-            ");"
-        )
-        rows = cursor.fetchall()
+        with self.connections.connection('information_schema') as cnx:
+            cursor = cnx.cursor()
+            cursor.execute(
+                "SELECT DISTINCT(table_schema) "
+                "FROM TABLES "
+                "WHERE table_schema NOT IN ("
+                "    'information_schema',"
+                "    'innodb', "
+                "    'mysql', "
+                "    'performance_schema', "
+                "    'sys', "
+                "    'tmp'"
+                ");"
+            )
+            rows = cursor.fetchall()
+            cursor.close()
         available_dbs = [r[0] for r in rows]
         logger.info("Databases found: %s", available_dbs)
 
@@ -90,67 +115,133 @@ class Mysql:
             return (False, err)
 
         logger.info("Running scrub task: %s", task)
-        cnx = self._get_connection(self.db_realnames[task])
-        cursor = cnx.cursor()
-        try:
-            self.scrub_functions[task](cursor)
-            cnx.commit()
-            cursor.close()
-            cnx.close()
-
-            return (True, None)
-
-        except Exception as e:
-            logger.error("Error running scrub task %s: %s", task, e)
-            cnx.rollback()
-            cursor.close()
-            cnx.close()
-
-            return (False, e)
+        with datascrubber.timing.span(self.report, 'task', task=task, database=self.db_realnames[task]) as s:
+            dbname = self.db_realnames[task]
+            cnx = self.connections.acquire(dbname)
+            try:
+                runner = datascrubber.batching.BatchRunner(
+                    cnx, task, self.batch_size, report=self.report, engine='mysql',
+                )
+                self.scrub_functions[task](runner)
+                runner.finish(self.maintenance)
+                cnx.commit()
+                self.connections.release(dbname, cnx)
+
+                return (True, None)
+
+            except Exception as e:
+                logger.error("Error running scrub task %s: %s", task, e)
+                # Closing the connection rolls back whatever was left
+                # uncommitted
+                self.connections.release(dbname, cnx, discard=True)
+
+                s['status'] = 'error'
+                s['error'] = str(e)
+                return (False, e)
 
     def export_to_s3(self, database, s3_url_prefix):
-        endpoint = self.workspace.get_endpoint()
+        if self.export_parallelism > 1:
+            return self._export_to_s3_parallel(database, s3_url_prefix)
 
-        mysqldump_command = ' '.join(list(map(shlex.quote, [
-            'mysqldump',
-            '--host={0}'.format(endpoint['Address']),
-            '--user={0}'.format(self.workspace.get_username()),
-            '--password={0}'.format(self.workspace.get_password()),
-            self.db_realnames[database],
-        ])))
+        mysqldump_command = self._get_mysqldump_command(
+            self.db_realnames[database]
+        )
 
-        s3_url = '{0}/{1}-{2}.sql.gz'.format(
+        s3_url = '{0}/{1}-{2}{3}'.format(
             s3_url_prefix,
             time.strftime("%Y-%m-%dT%H:%M:%S"),
             self.db_realnames[database],
+            self.codec.get_file_suffix(),
         )
-        s3_command = 'aws s3 cp - {0}'.format(shlex.quote(s3_url))
-
-        shell_command = '{0} | gzip | {1}'.format(mysqldump_command, s3_command)
 
         logger.info("Copying %s to S3 as %s", database, s3_url)
         logger.debug("mysqldump command: %s", mysqldump_command)
-        logger.debug("s3 command: %s", s3_command)
-        logger.debug("shell: %s", shell_command)
-
-        try:
-            output = subprocess.check_output(
-                shell_command,
-                shell=True,
-                stderr=subprocess.STDOUT,
-            )
-            logger.info(
-                "Finished copying %s to S3: %s", database,
-                {'command': shell_command,
-                 'exitcode': 0,
-                 'output': output.decode('utf-8')}
+
+        return datascrubber.exports.export_stream(
+            mysqldump_command + self.codec.get_compress_pipe(),
+            s3_url,
+            database,
+            self.uploader,
+            report=self.report,
+        )
+
+    def _export_to_s3_parallel(self, database, s3_url_prefix):
+        # Each table is dumped to its own S3 object, export_parallelism at a
+        # time, with a manifest listing the parts for datascrubber-restore.
+        # Views are dumped separately so that they can be restored after the
+        # tables they depend on.
+        realname = self.db_realnames[database]
+        export_url = '{0}/{1}-{2}'.format(
+            s3_url_prefix,
+            time.strftime("%Y-%m-%dT%H:%M:%S"),
+            realname,
+        )
+
+        (tables, views) = self._list_tables(realname)
+        parts = (
+            [{'key': t + self.codec.get_file_suffix(), 'table': t, 'type': 'table'} for t in tables] +
+            [{'key': v + self.codec.get_file_suffix(), 'table': v, 'type': 'view'} for v in views]
+        )
+
+        logger.info(
+            "Copying %s to S3 as %d parts under %s, %d at a time",
+            database, len(parts), export_url, self.export_parallelism,
+        )
+
+        def export_part(part):
+            return datascrubber.exports.export_stream(
+                self._get_mysqldump_command(realname, part['table']) +
+                self.codec.get_compress_pipe(),
+                '{0}/{1}'.format(export_url, part['key']),
+                '{0}.{1}'.format(database, part['table']),
+                self.uploader,
+                report=self.report,
             )
 
-        except subprocess.CalledProcessError as e:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.export_parallelism) as executor:
+            results = list(executor.map(export_part, parts))
+
+        if not all(results):
             logger.error(
-                "Error copying %s to S3: %s",
-                database,
-                {'command': shell_command,
-                 'exitcode': e.returncode,
-                 'output': e.output.decode('utf-8')}
+                "Not writing export manifest for %s, %d parts failed",
+                database, results.count(False),
             )
+            return False
+
+        return datascrubber.exports.write_manifest(self.uploader, export_url, {
+            'engine': 'mysql',
+            'format': 'mysqldump-tables',
+            'database': realname,
+            'compression': self.codec.name,
+            'parts': parts,
+        })
+
+    def _get_mysqldump_command(self, dbname, table=None):
+        endpoint = self.workspace.get_endpoint()
+
+        command = [
+            'mysqldump',
+            '--host={0}'.format(endpoint['Address']),
+            '--user={0}'.format(self.workspace.get_username()),
+            '--password={0}'.format(self.workspace.get_password()),
+            dbname,
+        ]
+        if table is not None:
+            command.append(table)
+
+        return ' '.join(list(map(shlex.quote, command)))
+
+    def _list_tables(self, dbname):
+        with self.connections.connection('information_schema') as cnx:
+            cursor = cnx.cursor()
+            cursor.execute(
+                "SELECT table_name, table_type FROM TABLES "
+                "WHERE table_schema = %s",
+                (dbname,)
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+
+        tables = sorted([r[0] for r in rows if r[1] == 'BASE TABLE'])
+        views = sorted([r[0] for r in rows if r[1] == 'VIEW'])
+        return (tables, views)
@@ -1,30 +1,58 @@
+import concurrent.futures
 import logging
 import psycopg2
 import re
-import subprocess
 import shlex
+import shutil
 import os
+import tempfile
 import time
 
+import datascrubber.batching
+import datascrubber.compression
+import datascrubber.connections
+import datascrubber.exports
+import datascrubber.rules
 import datascrubber.tasks
+import datascrubber.timing
 
 logger = logging.getLogger(__name__)
 
 
 class Postgresql:
-    def __init__(self, workspace, db_suffix='_production'):
+    def __init__(self, workspace, db_suffix='_production', batch_size=10000, export_parallelism=1, uploader=None, codec=None, report=None, rulesets=[], maintenance='analyze', max_connections=None):
         self.scrub_functions = {
             'email-alert-api': datascrubber.tasks.scrub_email_alert_api,
             'publishing_api': datascrubber.tasks.scrub_publishing_api,
         }
+        self.scrub_functions.update(
+            datascrubber.rules.get_rule_tasks('postgres', rulesets)
+        )
         self.db_realnames = {}
 
         self.workspace = workspace
         self.db_suffix = db_suffix
         self.viable_tasks = None
+        self.batch_size = batch_size
+        self.export_parallelism = export_parallelism
+        self.uploader = uploader
+        self.report = report
+        self.maintenance = maintenance
+        self.codec = codec
+        if self.codec is None:
+            self.codec = datascrubber.compression.get_codec('gzip')
+
+        self.connections = datascrubber.connections.ConnectionPool(
+            self._get_connection,
+            lambda cnx: cnx.closed == 0,
+            max_size=max_connections,
+        )
 
         self._discover_available_dbs()
 
+    def close(self):
+        self.connections.close()
+
     def _get_connection(self, dbname):
         instance = self.workspace.get_instance()
 
@@ -50,18 +78,19 @@ class Postgresql:
     def _discover_available_dbs(self):
         logger.info("Looking for available databases in Postgres")
 
-        cnx = self._get_connection('postgres')
-        cursor = cnx.cursor()
-        cursor.execute(
-            "SELECT datname FROM pg_database "
-            "WHERE datname NOT IN ("
-            "  'template0', "
-            "  'rdsadmin', "
-            "  'postgres', "
-            "  'template1' "
-            ") AND datistemplate IS FALSE"
-        )
-        rows = cursor.fetchall()
+        with self.connections.connection('postgres') as cnx:
+            cursor = cnx.cursor()
+            cursor.execute(
+                "SELECT datname FROM pg_database "
+                "WHERE datname NOT IN ("
+                "  'template0', "
+                "  'rdsadmin', "
+                "  'postgres', "
+                "  'template1' "
+                ") AND datistemplate IS FALSE"
+            )
+            rows = cursor.fetchall()
+            cursor.close()
         available_dbs = [r[0] for r in rows]
         logger.info("Databases found: %s", available_dbs)
 
@@ -89,65 +118,157 @@ class Postgresql:
             return (False, err)
 
         logger.info("Running scrub task: %s", task)
-        cnx = self._get_connection(self.db_realnames[task])
-        cursor = cnx.cursor()
-        try:
-            self.scrub_functions[task](cursor)
-            return (True, None)
+        with datascrubber.timing.span(self.report, 'task', task=task, database=self.db_realnames[task]) as s:
+            dbname = self.db_realnames[task]
+            cnx = self.connections.acquire(dbname)
+            try:
+                # Chunks are committed individually by the batch runner
+                cnx.autocommit = False
+                runner = datascrubber.batching.BatchRunner(
+                    cnx, task, self.batch_size, report=self.report, engine='postgres',
+                )
+                self.scrub_functions[task](runner)
+                runner.finish(self.maintenance)
+                cnx.commit()
+                self.connections.release(dbname, cnx)
+
+                return (True, None)
 
-        except Exception as e:
-            logger.error("Error running scrub task %s: %s", task, e)
+            except Exception as e:
+                logger.error("Error running scrub task %s: %s", task, e)
+                # Closing the connection rolls back whatever was left
+                # uncommitted, and drops any temporary tables the task made
+                self.connections.release(dbname, cnx, discard=True)
 
-            return (False, e)
+                s['status'] = 'error'
+                s['error'] = str(e)
+                return (False, e)
 
     def export_to_s3(self, database, s3_url_prefix):
-        endpoint = self.workspace.get_endpoint()
+        if self.export_parallelism > 1:
+            return self._export_to_s3_parallel(database, s3_url_prefix)
 
-        pgdump_command = ' '.join(list(map(shlex.quote, [
-            'pg_dump',
-            '--host={0}'.format(endpoint['Address']),
-            '--username={0}'.format(self.workspace.get_username()),
-            '--dbname={0}'.format(self.db_realnames[database]),
-        ])))
+        pgdump_command = self._get_pgdump_command(self.db_realnames[database])
 
-        s3_url = '{0}/{1}-{2}.sql.gz'.format(
+        s3_url = '{0}/{1}-{2}{3}'.format(
             s3_url_prefix,
             time.strftime("%Y-%m-%dT%H:%M:%S"),
             self.db_realnames[database],
+            self.codec.get_file_suffix(),
         )
-        s3_command = 'aws s3 cp - {0}'.format(shlex.quote(s3_url))
-
-        shell_command = '{0} | gzip | {1}'.format(pgdump_command, s3_command)
 
         logger.info("Copying %s to S3 as %s", database, s3_url)
         logger.debug("pg_dump command: %s", pgdump_command)
-        logger.debug("s3 command: %s", s3_command)
-        logger.debug("shell: %s", shell_command)
 
+        return datascrubber.exports.export_stream(
+            pgdump_command + self.codec.get_compress_pipe(),
+            s3_url,
+            database,
+            self.uploader,
+            env=self._get_pg_env(),
+            report=self.report,
+        )
+
+    def _export_to_s3_parallel(self, database, s3_url_prefix):
+        # pg_dump's directory format dumps tables in parallel to separate
+        # local files, compressed by pg_dump itself, which are then uploaded
+        # as separate S3 objects alongside a manifest for datascrubber-restore.
+        realname = self.db_realnames[database]
+        export_url = '{0}/{1}-{2}'.format(
+            s3_url_prefix,
+            time.strftime("%Y-%m-%dT%H:%M:%S"),
+            realname,
+        )
+
+        dump_dir = tempfile.mkdtemp(prefix='datascrubber-')
+        dump_path = os.path.join(dump_dir, realname)
         try:
-            # subprocess.check_output doesn't have an env parameter
-            # (but subprocess.Popen does - WHY!)
-            os.environ['PGPASSWORD'] = self.workspace.get_password()
-            output = subprocess.check_output(
-                shell_command,
-                shell=True,
-                stderr=subprocess.STDOUT,
-            )
             logger.info(
-                "Finished copying %s to S3: %s", database,
-                {'command': shell_command,
-                 'exitcode': 0,
-                 'output': output.decode('utf-8')}
+                "Dumping %s to %s with %d jobs",
+                database, dump_path, self.export_parallelism,
             )
+            pgdump_command = self._get_pgdump_command(realname, [
+                '--format=directory',
+                '--jobs={0}'.format(self.export_parallelism),
+                '--file={0}'.format(dump_path),
+                self._get_pgdump_compression(),
+            ])
+            with datascrubber.timing.span(self.report, 'export.dump', database=database) as s:
+                if not datascrubber.exports.run_dump_command(pgdump_command, database, env=self._get_pg_env()):
+                    s['status'] = 'error'
+                    return False
 
-        except subprocess.CalledProcessError as e:
-            logger.error(
-                "Error copying %s to S3: %s",
-                database,
-                {'command': shell_command,
-                 'exitcode': e.returncode,
-                 'output': e.output.decode('utf-8')}
+            parts = [{'key': f} for f in sorted(os.listdir(dump_path))]
+            logger.info(
+                "Copying %s to S3 as %d parts under %s",
+                database, len(parts), export_url,
             )
 
+            def export_part(part):
+                path = os.path.join(dump_path, part['key'])
+                with datascrubber.timing.span(
+                    self.report, 'export.upload',
+                    description='{0}/{1}'.format(database, part['key']),
+                    bytes=os.path.getsize(path),
+                ) as s:
+                    try:
+                        self.uploader.upload_file(
+                            path,
+                            '{0}/{1}'.format(export_url, part['key']),
+                        )
+                        return True
+
+                    except Exception as e:
+                        logger.error(
+                            "Error copying %s part %s to S3: %s",
+                            database, part['key'], e,
+                        )
+                        s['status'] = 'error'
+                        return False
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.export_parallelism) as executor:
+                results = list(executor.map(export_part, parts))
+
+            if not all(results):
+                logger.error(
+                    "Not writing export manifest for %s, %d parts failed",
+                    database, results.count(False),
+                )
+                return False
+
         finally:
-            os.environ.pop('PGPASSWORD')
+            shutil.rmtree(dump_dir, ignore_errors=True)
+
+        return datascrubber.exports.write_manifest(self.uploader, export_url, {
+            'engine': 'postgres',
+            'format': 'pg_dump-directory',
+            'database': realname,
+            'compression': self.codec.name,
+            'parts': parts,
+        })
+
+    def _get_pgdump_command(self, dbname, extra_args=[]):
+        endpoint = self.workspace.get_endpoint()
+
+        return ' '.join(list(map(shlex.quote, [
+            'pg_dump',
+            '--host={0}'.format(endpoint['Address']),
+            '--username={0}'.format(self.workspace.get_username()),
+            '--dbname={0}'.format(dbname),
+        ] + extra_args)))
+
+    def _get_pgdump_compression(self):
+        if self.codec.name == 'none':
+            return '--compress=0'
+
+        # zstd is only supported by pg_dump 16 onwards; gzip and pigz both
+        # map onto pg_dump's built in zlib compression
+        if self.codec.name == 'zstd':
+            return '--compress=zstd:{0}'.format(self.codec.level)
+
+        return '--compress={0}'.format(self.codec.level)
+
+    def _get_pg_env(self):
+        # Exports run concurrently, so the password is passed in the
+        # subprocess environment rather than set in our own
+        return dict(os.environ, PGPASSWORD=self.workspace.get_password())
@@ -1,63 +1,56 @@
+import hashlib
 import logging
 
 
-def scrub_email_alert_api(cursor):
+def scrub_email_alert_api(runner):
     logger = logging.getLogger('scrub_email_alert_api')
 
     logger.info("Deleting all emails that are older than 1 day old...")
-    sql = (
-        "DELETE FROM emails "
-        "WHERE created_at < current_timestamp - interval '1 day'"
+    rowcount = runner.retain(
+        'emails', "created_at >= current_timestamp - interval '1 day'"
     )
-    logger.debug(sql)
-    cursor.execute(sql)
+    logger.info('Rows removed: %d', rowcount)
 
-    logger.info("Creating a table to store all email addresses...")
-    sql = 'CREATE TABLE addresses (id SERIAL, address VARCHAR NOT NULL)'
-    logger.debug(sql)
-    cursor.execute(sql)
+    # Addresses are replaced with a hash of the address keyed with a secret
+    # for this scrub, so the same address gets the same pseudonym in both
+    # tables without a lookup table of every address, and each table (and
+    # each batch of it) can be rewritten independently of the others.
+    key = runner.get_secret()
+    pseudonym = "'anonymous-' || md5(%s || {0}) || '@example.com'"
 
-    logger.info("Copying all email addresses into the table, ignoring nulled out subscriber addresses")
+    logger.info("Pseudonymising subscribers.address...")
     sql = (
-        'INSERT INTO addresses (address) '
-        'SELECT address FROM subscribers WHERE address IS NOT NULL '
-        'UNION DISTINCT '
-        'SELECT address FROM emails'
+        "UPDATE subscribers "
+        "SET address = " + pseudonym.format('address') + " "
+        "WHERE address IS NOT NULL "
+        "AND {batch}"
     )
-    logging.debug(sql)
-    cursor.execute(sql)
-
-    logger.info("Indexing the table so we can efficiently lookup addresses...")
-    sql = "CREATE UNIQUE INDEX addresses_index ON addresses (address)"
-    logging.debug(sql)
-    cursor.execute(sql)
-
-    logger.info("Setting subscribers.address from the auto-incremented id in addresses table...")
-    sql = (
-        "UPDATE subscribers s "
-        "SET address = CONCAT('anonymous-', a.id, '@example.com') "
-        "FROM addresses a "
-        "WHERE a.address = s.address"
+    runner.execute_in_batches(sql, params=(key,), table='subscribers')
+
+    logger.info("Pseudonymising emails.address, and the address in emails.subject and emails.body...")
+
+    # The same pseudonym as in SQL, computed in Python so that emails, most
+    # of which are rewritten, can be streamed through a single copy of the
+    # table rather than updated in place
+    def pseudonymise_email(row):
+        address = row['address']
+        replacement = 'anonymous-{0}@example.com'.format(
+            hashlib.md5((key + address).encode('utf-8')).hexdigest()
+        )
+        return {
+            'address': replacement,
+            'subject': replace_address(row['subject'], address, replacement),
+            'body': replace_address(row['body'], address, replacement),
+        }
+
+    runner.transform(
+        'emails', ['address', 'subject', 'body'], pseudonymise_email,
+        condition='address IS NOT NULL',
     )
-    logging.debug(sql)
-    cursor.execute(sql)
 
-    logger.info("Setting emails.address from the auto-incremented id in addresses table...")
-    sql = (
-        "UPDATE emails e "
-        "SET address = CONCAT('anonymous-', a.id, '@example.com'), "
-        "subject = REPLACE(e.subject, e.address, CONCAT('anonymous-', a.id, '@example.com')), "
-        "body = REPLACE(e.body, e.address, CONCAT('anonymous-', a.id, '@example.com')) "
-        "FROM addresses a "
-        "WHERE a.address = e.address"
-    )
-    logging.debug(sql)
-    cursor.execute(sql)
-
-    logger.info("Cleaning up - deleting the addresses table and its index...")
-    sql = "DROP INDEX addresses_index"
-    logging.debug(sql)
-    cursor.execute(sql)
-    sql = "DROP TABLE addresses"
-    logging.debug(sql)
-    cursor.execute(sql)
+
+def replace_address(text, address, replacement):
+    # Like SQL's REPLACE, which leaves text alone when address is empty
+    if text is None or address == '':
+        return text
+    return text.replace(address, replacement)
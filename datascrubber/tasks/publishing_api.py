@@ -1,36 +1,47 @@
 import logging
 
 
-def scrub_publishing_api(cursor):
+def scrub_publishing_api(runner):
     logger = logging.getLogger('scrub_publishing_api')
 
+    # Both sets are worked out before any editions are deleted, and shared
+    # by the statements below rather than each evaluating them again
+    access_limited_editions = runner.materialise(
+        'access_limited_editions',
+        'SELECT DISTINCT edition_id FROM access_limits',
+        columns=['edition_id'],
+    )
+    access_limited_content = runner.materialise(
+        'access_limited_content',
+        'SELECT DISTINCT documents.content_id'
+        '  FROM documents'
+        '  INNER JOIN editions ON (documents.id = editions.document_id)'
+        '  INNER JOIN {0} a ON (editions.id = a.edition_id)'.format(access_limited_editions),
+        columns=['content_id'],
+    )
+
     sql = (
         "UPDATE events SET payload = NULL "
         "WHERE action = 'PutContent' "
         "AND content_id IN ("
-        "  SELECT content_id"
-        "  FROM documents"
-        "  INNER JOIN editions ON (documents.id = editions.document_id)"
-        "  INNER JOIN access_limits ON (editions.id = access_limits.edition_id)"
-        ")"
+        "  SELECT content_id FROM {0}"
+        ") AND {{batch}}".format(access_limited_content)
     )
     logger.info(sql)
-    cursor.execute(sql)
+    runner.execute_in_batches(sql, table='events')
 
     sql = (
         'DELETE FROM change_notes WHERE edition_id IN ('
-        '    SELECT edition_id'
-        '    FROM access_limits'
-        ')'
+        '    SELECT edition_id FROM {0}'
+        ') AND {{batch}}'.format(access_limited_editions)
     )
     logger.info(sql)
-    cursor.execute(sql)
+    runner.execute_in_batches(sql, table='change_notes')
 
     sql = (
         'DELETE FROM editions WHERE id IN ('
-        '    SELECT edition_id'
-        '    FROM access_limits'
-        ')'
+        '    SELECT edition_id FROM {0}'
+        ') AND {{batch}}'.format(access_limited_editions)
     )
     logger.info(sql)
-    cursor.execute(sql)
+    runner.execute_in_batches(sql, table='editions')
@@ -0,0 +1,126 @@
+import contextlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from .waiters import THROTTLING_ERROR_CODES
+
+logger = logging.getLogger(__name__)
+
+
+class RunReport:
+    # Collects timing spans from every worker thread over a whole run. Each
+    # span is a flat dict: its name, the thread it ran in, when it started,
+    # how long it took, whether it succeeded, and whatever attributes the
+    # caller attached (e.g. the database, or a statement's rowcount).
+    #
+    # It also keeps labelled counters, e.g. of AWS API calls made through
+    # instrumented boto3 sessions.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.spans = []
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        span = dict(
+            attributes,
+            name=name,
+            thread=threading.current_thread().name,
+            start=time.time(),
+        )
+        started = time.monotonic()
+        try:
+            yield span
+
+        except BaseException as e:
+            span['status'] = 'error'
+            span['error'] = str(e)
+            raise
+
+        finally:
+            span['duration'] = round(time.monotonic() - started, 3)
+            span.setdefault('status', 'ok')
+            with self.lock:
+                self.spans.append(span)
+
+    def get_spans(self, name=None):
+        with self.lock:
+            return [
+                s for s in self.spans
+                if name is None or s['name'] == name
+            ]
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get_counters(self):
+        with self.lock:
+            return [
+                dict(labels, name=name, value=value)
+                for ((name, labels), value) in sorted(self.counters.items())
+            ]
+
+    def instrument_session(self, boto3_session):
+        # Clients copy the session's event hooks when they're created, so
+        # this has to be called before any clients are
+        boto3_session.events.register('after-call', self._count_api_call)
+
+    def _count_api_call(self, parsed, model, **kwargs):
+        labels = {
+            'service': model.service_model.service_name,
+            'operation': model.name,
+        }
+        self.increment('api_calls', **labels)
+
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries > 0:
+            self.increment('api_retries', retries, **labels)
+
+        if parsed.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            self.increment('api_throttled', **labels)
+
+    def to_dict(self):
+        finished_at = time.time()
+        spans = sorted(self.get_spans(), key=lambda s: s['start'])
+
+        return {
+            'started_at': format_timestamp(self.started_at),
+            'finished_at': format_timestamp(finished_at),
+            'duration': round(finished_at - self.started_at, 3),
+            'spans': [
+                dict(s, start=format_timestamp(s['start'])) for s in spans
+            ],
+            'counters': self.get_counters(),
+        }
+
+    def write(self, path):
+        logger.info("Writing run report to %s", path)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+
+@contextlib.contextmanager
+def span(report, name, **attributes):
+    # Lets code which may or may not have been given a report time itself
+    # regardless; without one, the span is simply discarded
+    if report is None:
+        yield dict(attributes, name=name)
+        return
+
+    with report.span(name, **attributes) as s:
+        yield s
+
+
+def increment(report, name, value=1, **labels):
+    if report is not None:
+        report.increment(name, value, **labels)
+
+
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
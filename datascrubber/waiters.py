@@ -0,0 +1,84 @@
+import logging
+import random
+import time
+
+import botocore.exceptions
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_ERROR_CODES = [
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+]
+
+
+def is_throttling_error(e):
+    return (
+        isinstance(e, botocore.exceptions.ClientError) and
+        e.response['Error']['Code'] in THROTTLING_ERROR_CODES
+    )
+
+
+class Waiter:
+    # Polls a check function until it returns True. Until expected_duration
+    # has elapsed, the poll interval is a fraction of the time remaining until
+    # then, so a 20 minute restore isn't polled every few seconds from the
+    # start. After that (or without an estimate) it backs off exponentially
+    # from min_delay. Throttling errors from the check are retried with a
+    # doubled delay rather than failing the wait. All delays are jittered so
+    # that many workers don't poll in lockstep.
+    def __init__(self, description, timeout, expected_duration=None, min_delay=2, max_delay=60, backoff=1.5):
+        self.description = description
+        self.timeout = timeout
+        self.expected_duration = expected_duration
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+
+        self.throttle_retries = 0
+
+    def wait(self, check):
+        start_time = time.time()
+        max_end_time = start_time + self.timeout
+        delay = self.min_delay
+
+        while True:
+            try:
+                if check():
+                    logger.debug(
+                        "Finished waiting for %s after %d seconds",
+                        self.description, time.time() - start_time,
+                    )
+                    return
+
+                delay = self._get_next_delay(time.time() - start_time, delay)
+
+            except Exception as e:
+                if not is_throttling_error(e):
+                    raise
+
+                self.throttle_retries += 1
+                delay = min(self.max_delay, delay * 2)
+                logger.warning(
+                    "Throttled while waiting for %s, retrying in up to %d seconds",
+                    self.description, delay,
+                )
+
+            remaining = max_end_time - time.time()
+            if remaining <= 0:
+                raise TimeoutError(
+                    "Timed out waiting for {0}".format(self.description)
+                )
+
+            time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+
+    def _get_next_delay(self, elapsed, delay):
+        if self.expected_duration is not None and elapsed < self.expected_duration:
+            return max(
+                self.min_delay,
+                min(self.max_delay, (self.expected_duration - elapsed) / 2),
+            )
+
+        return min(self.max_delay, delay * self.backoff)
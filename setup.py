@@ -8,8 +8,8 @@ setuptools.setup(
     author_email="reliability-engineering@digital.cabinet-office.gov.uk",
     description="Scrubs sensitive data from databases",
     url="https://github.com/alphagov/govuk-datascrubber",
-    packages=setuptools.find_packages(),
-    package_data={'datascrubber': ['sql/*.sql']},
+    packages=setuptools.find_packages(exclude=['tests', 'tests.*']),
+    package_data={'datascrubber': ['sql/*.sql', 'rulesets/*.json', 'rulesets/*.yaml']},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,330 @@
+import os
+import unittest
+
+from datascrubber.batching import BatchRunner, IteratorFile, decode_copy_field, encode_copy_field
+from datascrubber.timing import RunReport
+
+
+class TestCopyFields(unittest.TestCase):
+    def test_round_trip(self):
+        for value in ['plain', '', None, 'tab\there', 'line\nbreak\r\n', 'back\\slash', '\\N', 'bell\b\f\v']:
+            self.assertEqual(decode_copy_field(encode_copy_field(value)), value)
+
+    def test_null_is_distinct_from_backslash_n(self):
+        self.assertEqual(encode_copy_field(None), '\\N')
+        self.assertEqual(encode_copy_field('\\N'), '\\\\N')
+
+    def test_encoding_leaves_no_delimiters(self):
+        encoded = encode_copy_field('a\tb\nc\rd')
+        self.assertNotIn('\t', encoded)
+        self.assertNotIn('\n', encoded)
+        self.assertNotIn('\r', encoded)
+
+    def test_non_strings_are_written_as_text(self):
+        self.assertEqual(encode_copy_field(42), '42')
+
+
+class TestIteratorFile(unittest.TestCase):
+    def test_reads_across_chunks(self):
+        f = IteratorFile(iter(['ab\n', 'cde\n', 'f\n']))
+
+        self.assertEqual(f.read(3), 'ab\n')
+        self.assertEqual(f.read(5), 'cde\nf')
+        self.assertEqual(f.read(), '\n')
+        self.assertEqual(f.read(5), '')
+
+    def test_read_everything(self):
+        f = IteratorFile(iter(['a', 'b', 'c']))
+        self.assertEqual(f.read(), 'abc')
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.copied = []
+        self.executed = []
+
+    def copy_expert(self, sql, f):
+        self.copied.append((sql, f.read()))
+
+    def execute(self, sql, params=None):
+        if self.connection.fail_on is not None and self.connection.fail_on in sql:
+            raise Exception("Failed: " + sql)
+        self.executed.append((sql, self.connection.autocommit))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, fail_on=None):
+        self.autocommit = False
+        self.fail_on = fail_on
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+
+class TestTransformStage(unittest.TestCase):
+    def test_nulls_are_written_as_nulls(self):
+        runner = BatchRunner(FakeConnection(), 'test', engine='postgres')
+        runner._write_stage('id', ['body', 'count'], [
+            (1, None, None),
+            (2, '', 0),
+            (3, 'text', 7),
+        ])
+
+        self.assertEqual(runner.cursor.copied, [(
+            'COPY datascrubber_stage (id, body, count) FROM STDIN',
+            '1\t\\N\t\\N\n2\t\t0\n3\ttext\t7\n',
+        )])
+
+
+class TestMaintenance(unittest.TestCase):
+    def finish(self, connection):
+        runner = BatchRunner(connection, 'test', engine='postgres')
+        runner.modified_tables = ['documents', 'editions']
+        runner.finish('analyze')
+        return runner
+
+    def test_vacuum_runs_outside_a_transaction(self):
+        connection = FakeConnection()
+        runner = self.finish(connection)
+
+        self.assertIn(('VACUUM (ANALYZE) documents', True), runner.cursor.executed)
+        self.assertIn(('VACUUM (ANALYZE) editions', True), runner.cursor.executed)
+        self.assertFalse(connection.autocommit)
+
+    def test_autocommit_is_restored_after_failure(self):
+        connection = FakeConnection(fail_on='VACUUM (ANALYZE) editions')
+
+        with self.assertRaises(Exception):
+            self.finish(connection)
+
+        self.assertFalse(connection.autocommit)
+
+
+@unittest.skipUnless(
+    os.environ.get('DATASCRUBBER_TEST_POSTGRES'),
+    "Set DATASCRUBBER_TEST_POSTGRES to a Postgres connection string to run",
+)
+class TestTransformPostgres(unittest.TestCase):
+    # Runs transform() against a real database, in a scratch table
+    def setUp(self):
+        import psycopg2
+
+        self.connection = psycopg2.connect(os.environ['DATASCRUBBER_TEST_POSTGRES'])
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_test')
+        cursor.execute(
+            'CREATE TABLE datascrubber_test '
+            '(id integer PRIMARY KEY, body text, count integer)'
+        )
+        cursor.executemany(
+            'INSERT INTO datascrubber_test VALUES (%s, %s, %s)',
+            [
+                (i, [None, '', 'text'][i % 3], [None, 0, i][i % 3])
+                for i in range(1, 101)
+            ]
+        )
+        self.connection.commit()
+
+    def tearDown(self):
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_test')
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_checkpoints')
+        self.connection.commit()
+        self.connection.close()
+
+    def count(self, condition):
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM datascrubber_test WHERE ' + condition)
+        return cursor.fetchone()[0]
+
+    def transform(self, columns, function, rewrite_threshold):
+        runner = BatchRunner(
+            self.connection, 'test', batch_size=30, engine='postgres',
+            rewrite_threshold=rewrite_threshold,
+        )
+        runner.fetch_size = 7
+        rowcount = runner.transform('datascrubber_test', columns, function)
+        runner.finish('none')
+        return rowcount
+
+    def test_nulls_survive_batched_transform(self):
+        # Every row is written back, NULLs included, and even ones change
+        def upper_even(row):
+            if row['id'] % 2 == 0 and row['body']:
+                return {'body': row['body'].upper()}
+            return {'body': row['body']}
+
+        self.transform(['body', 'count'], upper_even, 2)
+
+        self.assertEqual(self.count('body IS NULL'), 33)
+        self.assertEqual(self.count("body = ''"), 34)
+        self.assertEqual(self.count('count IS NULL'), 33)
+        self.assertEqual(self.count("body = 'TEXT'"), 17)
+
+    def test_nulls_survive_copy_transform(self):
+        cursor = self.connection.cursor()
+        cursor.execute('ANALYZE datascrubber_test')
+        self.connection.commit()
+
+        self.transform(['body'], lambda row: {'body': row['body']}, 0)
+
+        self.assertEqual(self.count('body IS NULL'), 33)
+        self.assertEqual(self.count("body = ''"), 34)
+        self.assertEqual(self.count('count IS NULL'), 33)
+
+    def test_table_with_triggers_is_not_rewritten(self):
+        # Putting the rewritten rows back would fire the INSERT trigger
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_test_inserts')
+        cursor.execute('CREATE TABLE datascrubber_test_inserts (id integer)')
+        cursor.execute(
+            'CREATE FUNCTION pg_temp.datascrubber_log_insert() RETURNS trigger AS '
+            '$$ BEGIN INSERT INTO datascrubber_test_inserts VALUES (NEW.id); RETURN NEW; END $$ '
+            'LANGUAGE plpgsql'
+        )
+        cursor.execute(
+            'CREATE TRIGGER datascrubber_log_insert AFTER INSERT ON datascrubber_test '
+            'FOR EACH ROW EXECUTE FUNCTION pg_temp.datascrubber_log_insert()'
+        )
+        cursor.execute('ANALYZE datascrubber_test')
+        self.connection.commit()
+
+        try:
+            self.transform(['body'], lambda row: {'body': 'scrubbed'}, 0)
+
+            cursor.execute('SELECT COUNT(*) FROM datascrubber_test_inserts')
+            self.assertEqual(cursor.fetchone()[0], 0)
+            self.assertEqual(self.count("body = 'scrubbed'"), 100)
+        finally:
+            self.connection.rollback()
+            cursor.execute('DROP TABLE datascrubber_test_inserts')
+            self.connection.commit()
+
+
+@unittest.skipUnless(
+    os.environ.get('DATASCRUBBER_TEST_POSTGRES'),
+    "Set DATASCRUBBER_TEST_POSTGRES to a Postgres connection string to run",
+)
+class TestUuidKeyPostgres(unittest.TestCase):
+    def setUp(self):
+        import psycopg2
+
+        self.connection = psycopg2.connect(os.environ['DATASCRUBBER_TEST_POSTGRES'])
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_test')
+        cursor.execute(
+            'CREATE TABLE datascrubber_test '
+            '(id uuid PRIMARY KEY DEFAULT gen_random_uuid(), body text, keep boolean)'
+        )
+        cursor.executemany(
+            'INSERT INTO datascrubber_test (body, keep) VALUES (%s, %s)',
+            [('text', i % 2 == 0) for i in range(20)]
+        )
+        self.connection.commit()
+        self.runner = BatchRunner(self.connection, 'test', batch_size=5, engine='postgres')
+
+    def tearDown(self):
+        self.connection.rollback()
+        self.runner.finish('none')
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_test')
+        self.connection.commit()
+        self.connection.close()
+
+    def test_statement_runs_in_one_go(self):
+        rowcount = self.runner.execute_in_batches(
+            "UPDATE datascrubber_test SET body = '' WHERE {batch}",
+            table='datascrubber_test',
+        )
+        self.assertEqual(rowcount, 20)
+
+    def test_retain_deletes_in_one_go(self):
+        self.assertEqual(self.runner.retain('datascrubber_test', 'keep'), 10)
+
+    def test_transform_runs_in_one_go(self):
+        self.runner.rewrite_threshold = 2
+        self.runner.fetch_size = 3
+
+        def upper_kept(row):
+            if row['body'] == 'text':
+                return {'body': 'TEXT'}
+
+        rowcount = self.runner.transform(
+            'datascrubber_test', ['body'], upper_kept, condition='keep',
+        )
+
+        self.assertEqual(rowcount, 10)
+        self.assertEqual(self.count("body = 'TEXT' AND keep"), 10)
+        self.assertEqual(self.count("body = 'text'"), 10)
+
+    def test_transform_copies_after_retain(self):
+        # The planner still estimates the rows left by retain(), which
+        # empties the table and puts them back
+        report = RunReport()
+        self.runner.report = report
+        self.runner.rewrite_threshold = 0.5
+
+        self.runner.retain('datascrubber_test', 'keep')
+        rowcount = self.runner.transform('datascrubber_test', ['body'], lambda row: {'body': row['id']})
+
+        self.assertEqual(rowcount, 10)
+        self.assertEqual(self.count('body = id::text'), 10)
+        [transform] = [s for s in report.get_spans('statement') if s['sql'].startswith('TRANSFORM')]
+        self.assertEqual(transform['method'], 'copy')
+
+    def count(self, condition):
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM datascrubber_test WHERE ' + condition)
+        return cursor.fetchone()[0]
+
+
+@unittest.skipUnless(
+    os.environ.get('DATASCRUBBER_TEST_POSTGRES'),
+    "Set DATASCRUBBER_TEST_POSTGRES to a Postgres connection string to run",
+)
+class TestRetainGeneratedColumnsPostgres(unittest.TestCase):
+    def setUp(self):
+        import psycopg2
+
+        self.connection = psycopg2.connect(os.environ['DATASCRUBBER_TEST_POSTGRES'])
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_test')
+        cursor.execute(
+            'CREATE TABLE datascrubber_test '
+            '(id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY, keep boolean, '
+            'flag text GENERATED ALWAYS AS (CASE WHEN keep THEN \'kept\' END) STORED)'
+        )
+        cursor.executemany(
+            'INSERT INTO datascrubber_test (keep) VALUES (%s)',
+            [(i % 10 == 0,) for i in range(100)]
+        )
+        cursor.execute('ANALYZE datascrubber_test')
+        self.connection.commit()
+        self.report = RunReport()
+        self.runner = BatchRunner(self.connection, 'test', report=self.report, engine='postgres')
+
+    def tearDown(self):
+        self.connection.rollback()
+        self.runner.finish('none')
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_test')
+        self.connection.commit()
+        self.connection.close()
+
+    def test_rows_are_deleted_rather_than_copied(self):
+        self.runner.retain('datascrubber_test', 'keep')
+
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM datascrubber_test WHERE flag = 'kept'")
+        self.assertEqual(cursor.fetchone()[0], 10)
+        cursor.execute('SELECT COUNT(*) FROM datascrubber_test')
+        self.assertEqual(cursor.fetchone()[0], 10)
+        [retain] = self.report.get_spans('statement')
+        self.assertEqual(retain['method'], 'delete')
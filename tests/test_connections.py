@@ -0,0 +1,102 @@
+import threading
+import unittest
+
+from datascrubber.connections import ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.closed = False
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+def create_pool(max_size=None):
+    return ConnectionPool(FakeConnection, lambda cnx: not cnx.closed, max_size=max_size)
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_connections_are_reused_per_database(self):
+        pool = create_pool()
+
+        with pool.connection('a') as first:
+            pass
+        with pool.connection('a') as second:
+            pass
+        with pool.connection('b') as other:
+            pass
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual(first.rollbacks, 2)
+        self.assertEqual((pool.connections_opened, pool.connections_reused), (2, 1))
+
+    def test_failed_work_discards_the_connection(self):
+        pool = create_pool()
+
+        with self.assertRaises(ValueError):
+            with pool.connection('a') as cnx:
+                raise ValueError()
+
+        self.assertTrue(cnx.closed)
+        self.assertEqual(pool.open_count, 0)
+        with pool.connection('a') as replacement:
+            self.assertIsNot(replacement, cnx)
+
+    def test_closed_connections_arent_reused(self):
+        pool = create_pool()
+        cnx = pool.acquire('a')
+        pool.release('a', cnx)
+        cnx.closed = True
+
+        self.assertIsNot(pool.acquire('a'), cnx)
+        self.assertEqual(pool.open_count, 1)
+
+    def test_idle_connection_to_another_database_makes_room(self):
+        pool = create_pool(max_size=1)
+        cnx = pool.acquire('a')
+        pool.release('a', cnx)
+
+        other = pool.acquire('b')
+
+        self.assertTrue(cnx.closed)
+        self.assertEqual(other.dbname, 'b')
+        self.assertEqual(pool.open_count, 1)
+
+    def test_acquire_waits_when_full(self):
+        pool = create_pool(max_size=1)
+        cnx = pool.acquire('a')
+        acquired = []
+
+        thread = threading.Thread(target=lambda: acquired.append(pool.acquire('b')))
+        thread.start()
+        thread.join(0.2)
+        self.assertEqual(acquired, [])
+
+        pool.release('a', cnx)
+        thread.join(5)
+        self.assertEqual(acquired[0].dbname, 'b')
+
+    def test_close(self):
+        pool = create_pool()
+        idle = pool.acquire('a')
+        busy = pool.acquire('b')
+        pool.release('a', idle)
+
+        pool.close()
+        self.assertTrue(idle.closed)
+        self.assertFalse(busy.closed)
+
+        # Connections in use when the pool closed are closed when released
+        pool.release('b', busy)
+        self.assertTrue(busy.closed)
+        self.assertEqual(pool.open_count, 0)
+
+        with self.assertRaises(Exception):
+            pool.acquire('a')
@@ -0,0 +1,59 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from datascrubber.restore import run_restore_command
+
+
+class FakeDownloader:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def download_to(self, s3_url, stream):
+        if s3_url not in self.objects:
+            raise Exception("404 Not Found: {0}".format(s3_url))
+
+        stream.write(self.objects[s3_url])
+        return len(self.objects[s3_url])
+
+
+class TestRunRestoreCommand(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+        self.downloader = FakeDownloader({
+            's3://bucket/part.sql.gz': gzip.compress(b'CREATE TABLE t ();\n'),
+            's3://bucket/corrupt.sql.gz': b'not gzip',
+        })
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def restore(self, s3_url):
+        return run_restore_command(
+            'cat | gzip -dc > {0}'.format(self.path),
+            'test',
+            downloader=self.downloader,
+            s3_url=s3_url,
+        )
+
+    def test_streams_the_object_through_the_command(self):
+        self.assertTrue(self.restore('s3://bucket/part.sql.gz'))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'CREATE TABLE t ();\n')
+
+    def test_failure_in_the_middle_of_the_pipeline_fails(self):
+        self.assertFalse(run_restore_command(
+            'cat | gzip -dc | cat > {0}'.format(self.path),
+            'test',
+            downloader=self.downloader,
+            s3_url='s3://bucket/corrupt.sql.gz',
+        ))
+
+    def test_missing_object_fails(self):
+        self.assertFalse(self.restore('s3://bucket/missing.sql.gz'))
+
+    def test_command_without_input(self):
+        self.assertTrue(run_restore_command('true', 'test'))
+        self.assertFalse(run_restore_command('false | true', 'test'))
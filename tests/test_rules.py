@@ -0,0 +1,203 @@
+import os
+import unittest
+
+from datascrubber.batching import BatchRunner
+from datascrubber.rules import Ruleset, quote_identifier, refers_to_any, substitute_sets
+
+
+def rule(table, column, strategy='blank', where=None, **options):
+    r = dict(options, table=table, column=column, strategy=strategy)
+    if where is not None:
+        r['where'] = where
+    return r
+
+
+class TestRuleset(unittest.TestCase):
+    def test_unknown_strategy(self):
+        with self.assertRaises(Exception):
+            Ruleset('test', 'mysql', [rule('t', 'c', strategy='shred')])
+
+    def test_unsupported_engine(self):
+        with self.assertRaises(Exception):
+            Ruleset('test', 'oracle', [])
+
+    def test_one_update_per_table(self):
+        ruleset = Ruleset('test', 'postgres', [
+            rule('a', 'title', 'lorem'),
+            rule('b', 'x', 'nullify'),
+            rule('a', 'slug', 'value', value='slug'),
+        ])
+
+        self.assertEqual(ruleset.compile(), [
+            (
+                'UPDATE "a" SET "title" = %s, "slug" = %s WHERE {batch}',
+                ('Lorem ipsum dolor sit amet, consectetur adipiscing elit', 'slug'),
+                'a',
+            ),
+            ('UPDATE "b" SET "x" = NULL WHERE {batch}', (), 'b'),
+        ])
+
+    def test_conditions_are_merged_with_case(self):
+        ruleset = Ruleset('test', 'mysql', [
+            rule('a', 'title', where='access_limited = 1'),
+            rule('a', 'slug', 'value', where='kind = %s', value='slug', params=['news']),
+        ])
+
+        self.assertEqual(ruleset.compile(), [(
+            "UPDATE `a` SET "
+            "`title` = CASE WHEN (access_limited = 1) THEN '' ELSE `a`.`title` END, "
+            "`slug` = CASE WHEN (kind = %s) THEN %s ELSE `a`.`slug` END "
+            "WHERE ((access_limited = 1) OR (kind = %s)) AND {batch}",
+            ('news', 'slug', 'news'),
+            'a',
+        )])
+
+    def test_same_condition_with_other_params_isnt_merged(self):
+        ruleset = Ruleset('test', 'postgres', [
+            rule('a', 'title', where='kind = %s', params=['news']),
+            rule('a', 'slug', where='kind = %s', params=['guide']),
+        ])
+
+        self.assertEqual(ruleset.compile(), [(
+            'UPDATE "a" SET '
+            '"title" = CASE WHEN (kind = %s) THEN \'\' ELSE "a"."title" END, '
+            '"slug" = CASE WHEN (kind = %s) THEN \'\' ELSE "a"."slug" END '
+            'WHERE ((kind = %s) OR (kind = %s)) AND {batch}',
+            ('news', 'guide', 'news', 'guide'),
+            'a',
+        )])
+
+    def test_condition_params_must_match_placeholders(self):
+        with self.assertRaises(Exception):
+            Ruleset('test', 'mysql', [rule('a', 'title', where='kind = %s')])
+        with self.assertRaises(Exception):
+            Ruleset('test', 'mysql', [rule('a', 'title', where='kind = 1', params=['news'])])
+
+    def test_literal_percent_must_be_escaped(self):
+        with self.assertRaises(Exception):
+            Ruleset('test', 'mysql', [rule('a', 'title', where="slug LIKE 'draft-%'")])
+
+        ruleset = Ruleset('test', 'mysql', [rule('a', 'title', where="slug LIKE 'draft-%%'")])
+        self.assertEqual(ruleset.compile(), [(
+            "UPDATE `a` SET `title` = '' WHERE (slug LIKE 'draft-%%') AND {batch}",
+            (),
+            'a',
+        )])
+
+    def test_single_condition_isnt_wrapped_in_case(self):
+        ruleset = Ruleset('test', 'mysql', [
+            rule('a', 'title', where='access_limited = 1'),
+            rule('a', 'slug', where='access_limited = 1'),
+        ])
+
+        self.assertEqual(ruleset.compile(), [(
+            "UPDATE `a` SET `title` = '', `slug` = '' "
+            "WHERE (access_limited = 1) AND {batch}",
+            (),
+            'a',
+        )])
+
+    def test_same_column_needs_another_pass(self):
+        ruleset = Ruleset('test', 'mysql', [
+            rule('a', 'title', where='kind = 1'),
+            rule('a', 'title', 'nullify', where='kind = 2'),
+        ])
+
+        self.assertEqual(len(ruleset.compile()), 2)
+
+    def test_condition_on_rewritten_column_needs_another_pass(self):
+        rules = [
+            rule('a', 'title'),
+            rule('a', 'slug', where="title = ''"),
+        ]
+        passes = Ruleset('test', 'mysql', rules)._plan_passes(rules)
+
+        self.assertEqual(passes, [
+            [(None, [rules[0]])],
+            [("title = ''", [rules[1]])],
+        ])
+
+    def test_self_referencing_condition_isnt_shared(self):
+        rules = [
+            rule('a', 'body', 'nullify', where='body IS NOT NULL'),
+            rule('a', 'title'),
+            rule('a', 'slug'),
+        ]
+        passes = Ruleset('test', 'mysql', rules)._plan_passes(rules)
+
+        self.assertEqual(passes, [
+            [('body IS NOT NULL', [rules[0]])],
+            [(None, [rules[1], rules[2]])],
+        ])
+
+    def test_strategy_parameters_are_in_column_order(self):
+        ruleset = Ruleset('test', 'postgres', [
+            rule('users', 'email', 'sequence-email', domain='example.org'),
+            rule('users', 'password', 'hash', salt='salt'),
+        ])
+
+        self.assertEqual(ruleset.compile(), [(
+            'UPDATE "users" SET '
+            '"email" = CONCAT(%s, "users"."id", %s), '
+            '"password" = md5(%s || "users"."password") '
+            'WHERE {batch}',
+            ('anonymous-', '@example.org', 'salt'),
+            'users',
+        )])
+
+
+class TestHelpers(unittest.TestCase):
+    def test_quote_identifier(self):
+        self.assertEqual(quote_identifier('mysql', 'a`b'), '`a``b`')
+        self.assertEqual(quote_identifier('postgres', 'a"b'), '"a""b"')
+
+    def test_refers_to_any(self):
+        self.assertTrue(refers_to_any('title IS NULL', ['title']))
+        self.assertFalse(refers_to_any('subtitle IS NULL', ['title']))
+        self.assertFalse(refers_to_any(None, ['title']))
+
+    def test_substitute_sets(self):
+        self.assertEqual(
+            substitute_sets('id IN (SELECT id FROM {editions})', {'editions': 'datascrubber_set_editions'}),
+            'id IN (SELECT id FROM datascrubber_set_editions)',
+        )
+
+
+@unittest.skipUnless(
+    os.environ.get('DATASCRUBBER_TEST_POSTGRES'),
+    "Set DATASCRUBBER_TEST_POSTGRES to a Postgres connection string to run",
+)
+class TestScrubPostgres(unittest.TestCase):
+    def setUp(self):
+        import psycopg2
+
+        self.connection = psycopg2.connect(os.environ['DATASCRUBBER_TEST_POSTGRES'])
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_test')
+        cursor.execute('CREATE TABLE datascrubber_test (id integer PRIMARY KEY, kind text, slug text, title text)')
+        cursor.executemany(
+            "INSERT INTO datascrubber_test VALUES (%s, %s, %s, 'title')",
+            [(i, ['news', 'guide'][i % 2], ['draft-', 'live-'][i % 3 == 0] + str(i)) for i in range(1, 31)]
+        )
+        self.connection.commit()
+
+    def tearDown(self):
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS datascrubber_test')
+        self.connection.commit()
+        self.connection.close()
+
+    def test_conditions_are_bound_in_batches(self):
+        runner = BatchRunner(self.connection, 'test', batch_size=7, engine='postgres')
+        Ruleset('test', 'postgres', [
+            rule('datascrubber_test', 'title', where="slug LIKE 'draft-%%'"),
+            rule('datascrubber_test', 'slug', 'nullify', where='kind = %s', params=['news']),
+        ]).scrub(runner)
+        runner.finish('none')
+
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "SELECT COUNT(*) FILTER (WHERE title = ''), COUNT(*) FILTER (WHERE slug IS NULL) "
+            "FROM datascrubber_test"
+        )
+        self.assertEqual(cursor.fetchone(), (20, 15))
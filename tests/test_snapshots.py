@@ -0,0 +1,130 @@
+import datetime
+import unittest
+
+import botocore.session
+from botocore.stub import Stubber
+
+from datascrubber import RdsSnapshotFinder, ScrubWorkspaceInstance
+
+
+def create_rds_client():
+    return botocore.session.get_session().create_client(
+        'rds',
+        region_name='eu-west-1',
+        aws_access_key_id='testing',
+        aws_secret_access_key='testing',
+    )
+
+
+class FakeSession:
+    def __init__(self, client):
+        self.rds_client = client
+
+    def client(self, service_name, **kwargs):
+        return self.rds_client
+
+
+class FakeSnapshotFinder:
+    def get_snapshot(self):
+        return {
+            'Engine': 'postgres',
+            'EngineVersion': '13.4',
+            'DBInstanceIdentifier': 'source',
+            'DBSnapshotIdentifier': 'rds:source-2018-01-28',
+        }
+
+    def get_snapshot_identifier(self):
+        return self.get_snapshot()['DBSnapshotIdentifier']
+
+    def get_source_instance(self):
+        return {
+            'DBInstanceIdentifier': 'source',
+            'VpcSecurityGroups': [],
+            'DBParameterGroups': [{'DBParameterGroupName': 'default'}],
+            'DBSubnetGroup': {'DBSubnetGroupName': 'subnets'},
+        }
+
+
+def snapshot(identifier, day, status='available'):
+    return {
+        'DBSnapshotIdentifier': identifier,
+        'SnapshotCreateTime': datetime.datetime(2018, 1, day, tzinfo=datetime.timezone.utc),
+        'Status': status,
+    }
+
+
+def add_pages(stubber, pages, expected_params):
+    # One describe_db_snapshots response per page, each linked to the next
+    # by a Marker, as RDS paginates them
+    for (i, page) in enumerate(pages):
+        response = {'DBSnapshots': page}
+        if i < len(pages) - 1:
+            response['Marker'] = 'page-{0}'.format(i + 1)
+
+        params = dict(expected_params)
+        if i > 0:
+            params['Marker'] = 'page-{0}'.format(i)
+
+        stubber.add_response('describe_db_snapshots', response, params)
+
+
+class TestSnapshotDiscovery(unittest.TestCase):
+    def test_most_recent_snapshot_is_found_across_pages(self):
+        client = create_rds_client()
+        pages = [
+            [snapshot('s-{0}-{1}'.format(p, i), 1 + (p * 7 + i) % 27) for i in range(20)]
+            for p in range(5)
+        ]
+        pages[3].append(snapshot('s-newest', 28, status='creating'))
+        pages[4].append(snapshot('s-wanted', 28))
+
+        with Stubber(client) as stubber:
+            add_pages(stubber, pages, {
+                'DBInstanceIdentifier': 'source',
+                'SnapshotType': 'automated',
+            })
+
+            finder = RdsSnapshotFinder(
+                FakeSession(client), source_instance_identifier='source',
+            )
+            self.assertEqual(finder.get_snapshot_identifier(), 's-wanted')
+            stubber.assert_no_pending_responses()
+
+    def test_no_available_snapshots(self):
+        client = create_rds_client()
+
+        with Stubber(client) as stubber:
+            add_pages(stubber, [[snapshot('s-1', 1, status='creating')], []], {
+                'DBInstanceIdentifier': 'source',
+                'SnapshotType': 'automated',
+            })
+
+            finder = RdsSnapshotFinder(
+                FakeSession(client), source_instance_identifier='source',
+            )
+            with self.assertRaises(Exception):
+                finder.get_snapshot_identifier()
+
+    def test_old_snapshots_are_deleted_across_pages(self):
+        client = create_rds_client()
+        workspace = ScrubWorkspaceInstance(FakeSnapshotFinder(), FakeSession(client))
+        pages = [
+            [snapshot('scrubbed-{0}'.format(day), day) for day in range(start, start + 4)]
+            for start in (1, 5, 9)
+        ]
+        # Still being created, so newer than any of the others
+        pages[0].append({'DBSnapshotIdentifier': 'scrubbed-new'})
+
+        with Stubber(client) as stubber:
+            add_pages(stubber, pages, {
+                'DBInstanceIdentifier': workspace.instance_identifier,
+                'SnapshotType': 'manual',
+            })
+            for day in range(10, 0, -1):
+                stubber.add_response(
+                    'delete_db_snapshot', {},
+                    {'DBSnapshotIdentifier': 'scrubbed-{0}'.format(day)},
+                )
+
+            workspace.delete_old_snapshots(3)
+            stubber.assert_no_pending_responses()
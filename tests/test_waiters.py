@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+
+from datascrubber.waiters import Waiter
+
+
+def throttling_error():
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}},
+        'DescribeDBInstances',
+    )
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestWaiter(unittest.TestCase):
+    def wait(self, waiter, check):
+        clock = FakeClock()
+        with mock.patch('datascrubber.waiters.time', clock), \
+                mock.patch('datascrubber.waiters.random.uniform', lambda a, b: b):
+            waiter.wait(check)
+        return clock.sleeps
+
+    def test_backs_off_exponentially(self):
+        waiter = Waiter('test', timeout=3600, min_delay=2, max_delay=10, backoff=2)
+        results = iter([False] * 5 + [True])
+
+        self.assertEqual(self.wait(waiter, lambda: next(results)), [4, 8, 10, 10, 10])
+
+    def test_polls_less_often_before_expected_duration(self):
+        waiter = Waiter('test', timeout=3600, expected_duration=100, min_delay=2, max_delay=60)
+
+        self.assertEqual(waiter._get_next_delay(0, 2), 50)
+        self.assertEqual(waiter._get_next_delay(80, 2), 10)
+        self.assertEqual(waiter._get_next_delay(99, 2), 2)
+        # Past the estimate, it backs off from the previous delay
+        self.assertEqual(waiter._get_next_delay(150, 10), 15)
+
+    def test_retries_throttling_errors_with_a_doubled_delay(self):
+        waiter = Waiter('test', timeout=3600, min_delay=2, max_delay=60)
+        calls = iter([throttling_error(), throttling_error(), True])
+
+        def check():
+            result = next(calls)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.assertEqual(self.wait(waiter, check), [4, 8])
+        self.assertEqual(waiter.throttle_retries, 2)
+
+    def test_other_errors_are_raised(self):
+        waiter = Waiter('test', timeout=3600)
+
+        def check():
+            raise ValueError('broken')
+
+        with self.assertRaises(ValueError):
+            self.wait(waiter, check)
+
+    def test_times_out(self):
+        waiter = Waiter('test', timeout=30, min_delay=2, max_delay=10)
+
+        with self.assertRaises(TimeoutError):
+            self.wait(waiter, lambda: False)
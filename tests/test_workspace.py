@@ -0,0 +1,171 @@
+import unittest
+from unittest import mock
+
+from botocore.stub import ANY, Stubber
+
+from datascrubber import SOURCE_SNAPSHOT_TAG, ScrubWorkspaceInstance
+
+from .test_snapshots import FakeSession, FakeSnapshotFinder, create_rds_client
+from .test_waiters import FakeClock
+
+
+def workspace_instance(identifier, status='available', parameter_groups={}):
+    return {
+        'DBInstanceIdentifier': identifier,
+        'DBInstanceArn': 'arn:aws:rds:eu-west-1:123456789012:db:' + identifier,
+        'DBInstanceStatus': status,
+        'PendingModifiedValues': {},
+        'Endpoint': {'Address': identifier + '.example.com', 'Port': 5432},
+        'MasterUsername': 'scrubber',
+        'DBParameterGroups': [
+            {'DBParameterGroupName': name, 'ParameterApplyStatus': status}
+            for (name, status) in parameter_groups.items()
+        ],
+    }
+
+
+class FakeStandbyPool:
+    def claim(self, snapshot):
+        return 'standby'
+
+
+class TestResumeWorkspace(unittest.TestCase):
+    def setUp(self):
+        self.client = create_rds_client()
+        self.workspace = ScrubWorkspaceInstance(
+            FakeSnapshotFinder(), FakeSession(self.client),
+            keep_on_failure=True, resume=True,
+        )
+        self.identifier = self.workspace.instance_identifier
+
+    def add_existing_instance(self, stubber, restored_from):
+        stubber.add_response(
+            'describe_db_instances',
+            {'DBInstances': [workspace_instance(self.identifier)]},
+            {'DBInstanceIdentifier': self.identifier},
+        )
+        stubber.add_response(
+            'list_tags_for_resource',
+            {'TagList': [{'Key': SOURCE_SNAPSHOT_TAG, 'Value': restored_from}]},
+            {'ResourceName': ANY},
+        )
+
+    def test_existing_instance_is_adopted(self):
+        with Stubber(self.client) as stubber:
+            self.add_existing_instance(stubber, 'rds:source-2018-01-28')
+            stubber.add_response(
+                'describe_db_instances',
+                {'DBInstances': [workspace_instance(self.identifier)]},
+                {'DBInstanceIdentifier': self.identifier},
+            )
+            stubber.add_response('modify_db_instance', {}, {
+                'DBInstanceIdentifier': self.identifier,
+                'ApplyImmediately': True,
+                'MasterUserPassword': self.workspace.password,
+                'BackupRetentionPeriod': 0,
+            })
+            stubber.add_response(
+                'describe_db_instances',
+                {'DBInstances': [workspace_instance(self.identifier)]},
+                {'DBInstanceIdentifier': self.identifier},
+            )
+
+            instance = self.workspace.get_instance()
+            stubber.assert_no_pending_responses()
+
+        self.assertEqual(instance['DBInstanceIdentifier'], self.identifier)
+
+    def test_instance_restored_from_another_snapshot_is_refused(self):
+        with Stubber(self.client) as stubber:
+            self.add_existing_instance(stubber, 'rds:source-2018-01-27')
+
+            with self.assertRaises(Exception) as e:
+                self.workspace.get_instance()
+
+        self.assertIn('--postgresql-snapshots rds:source-2018-01-27', str(e.exception))
+
+    def test_instance_is_kept_after_failure(self):
+        self.workspace.instance = workspace_instance(self.identifier)
+
+        with Stubber(self.client) as stubber:
+            # No calls are expected
+            self.workspace.cleanup(create_final_snapshot=False)
+            stubber.assert_no_pending_responses()
+
+        self.assertFalse(self.workspace.deleted)
+
+
+class TestParameterGroupReboot(unittest.TestCase):
+    def setUp(self):
+        self.client = create_rds_client()
+
+    def workspace(self, **options):
+        workspace = ScrubWorkspaceInstance(
+            FakeSnapshotFinder(), FakeSession(self.client), parameter_group='bulk', **options
+        )
+        self.identifier = workspace.instance_identifier
+        return workspace
+
+    def add_instance(self, stubber, status):
+        stubber.add_response(
+            'describe_db_instances',
+            {'DBInstances': [workspace_instance(self.identifier, parameter_groups={'bulk': status})]},
+            {'DBInstanceIdentifier': self.identifier},
+        )
+
+    def add_standby_modification(self, stubber):
+        stubber.add_response('modify_db_instance', {}, {
+            'DBInstanceIdentifier': 'standby',
+            'NewDBInstanceIdentifier': self.identifier,
+            'ApplyImmediately': True,
+            'MasterUserPassword': ANY,
+            'BackupRetentionPeriod': 0,
+            'VpcSecurityGroupIds': ANY,
+            'DBParameterGroupName': 'bulk',
+        })
+
+    def get_instance(self, workspace):
+        clock = FakeClock()
+        with mock.patch('datascrubber.waiters.time', clock), \
+                mock.patch('datascrubber.waiters.random.uniform', lambda a, b: b):
+            workspace.get_instance()
+
+    def test_standby_is_rebooted_to_apply_parameter_group(self):
+        workspace = self.workspace(standby_pool=FakeStandbyPool())
+
+        with Stubber(self.client) as stubber:
+            self.add_standby_modification(stubber)
+            self.add_instance(stubber, 'pending-reboot')
+            self.add_instance(stubber, 'pending-reboot')
+            stubber.add_response('reboot_db_instance', {}, {'DBInstanceIdentifier': self.identifier})
+            self.add_instance(stubber, 'in-sync')
+
+            self.get_instance(workspace)
+            stubber.assert_no_pending_responses()
+
+    def test_reboot_waits_for_parameter_group_to_finish_applying(self):
+        workspace = self.workspace(standby_pool=FakeStandbyPool())
+
+        with Stubber(self.client) as stubber:
+            self.add_standby_modification(stubber)
+            self.add_instance(stubber, 'applying')
+            self.add_instance(stubber, 'applying')
+            self.add_instance(stubber, 'pending-reboot')
+            stubber.add_response('reboot_db_instance', {}, {'DBInstanceIdentifier': self.identifier})
+            self.add_instance(stubber, 'in-sync')
+
+            self.get_instance(workspace)
+            stubber.assert_no_pending_responses()
+
+    def test_restored_instance_is_only_rebooted_if_needed(self):
+        workspace = self.workspace()
+
+        with Stubber(self.client) as stubber:
+            stubber.add_response('restore_db_instance_from_db_snapshot', {})
+            self.add_instance(stubber, 'in-sync')
+            stubber.add_response('modify_db_instance', {})
+            self.add_instance(stubber, 'in-sync')
+            self.add_instance(stubber, 'in-sync')
+
+            self.get_instance(workspace)
+            stubber.assert_no_pending_responses()